@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a class to maintain a catalog of the model run outputs.
+"""
+__author__ = 'ajshajib'
+
+import os
+import json
+import sqlite3
+from contextlib import closing
+from contextlib import contextmanager
+import numpy as np
+
+from dolphin.processor.files import FileSystem
+from dolphin.processor.files import LazyOutput
+
+
+class Catalog(object):
+    """
+    This class maintains a persisted SQLite catalog of the h5 outputs in the
+    `outputs` directory. The catalog is updated incrementally, only the
+    output files that are new or changed since the last update are read.
+    """
+    def __init__(self, io_directory):
+        """
+
+        :param io_directory: path to the input/output directory. Should not
+            end with slash.
+        :type io_directory: `str`
+        """
+        self.file_system = FileSystem(io_directory)
+        self.catalog_file = self.file_system.get_catalog_file_path()
+
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS outputs ('
+                'file_name TEXT PRIMARY KEY, lens_name TEXT, model_id TEXT, '
+                'fitting_stages TEXT, chi2 REAL, kwargs_result TEXT, '
+                'mtime REAL, size INTEGER)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS parameters ('
+                'file_name TEXT, kwargs_key TEXT, model_index INTEGER, '
+                'parameter TEXT, value REAL)'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS parameters_file_name '
+                'ON parameters (file_name)'
+            )
+
+    @contextmanager
+    def _connect(self):
+        """
+        Connect to the catalog database. On exiting the context, the changes
+        are committed, or rolled back if an exception is raised, and the
+        connection is closed.
+
+        :return: connection
+        :rtype: `sqlite3.Connection`
+        """
+        with closing(sqlite3.connect(self.catalog_file)) as connection:
+            with connection:
+                yield connection
+
+    def update(self):
+        """
+        Update the catalog with the new and changed output files, and remove
+        the entries of the deleted ones.
+
+        :return: number of output files (re-)read
+        :rtype: `int`
+        """
+        outputs_directory = self.file_system.get_outputs_directory()
+
+        file_stats = {}
+        for file_name in os.listdir(outputs_directory):
+            if file_name.startswith('output_') and file_name.endswith('.h5'):
+                stat = os.stat(os.path.join(outputs_directory, file_name))
+                file_stats[file_name] = (stat.st_mtime, stat.st_size)
+
+        with self._connect() as connection:
+            cataloged = {
+                row[0]: (row[1], row[2]) for row in connection.execute(
+                    'SELECT file_name, mtime, size FROM outputs')
+            }
+
+            for file_name in set(cataloged) - set(file_stats):
+                self._remove_entry(connection, file_name)
+
+            num_read = 0
+            for file_name, (mtime, size) in sorted(file_stats.items()):
+                if cataloged.get(file_name) == (mtime, size):
+                    continue
+
+                self._remove_entry(connection, file_name)
+                self._add_entry(connection, file_name, mtime, size)
+                num_read += 1
+
+        return num_read
+
+    @staticmethod
+    def _remove_entry(connection, file_name):
+        """
+        Remove an output file from the catalog.
+
+        :param connection: connection to the catalog database
+        :type connection: `sqlite3.Connection`
+        :param file_name: name of the output file
+        :type file_name: `str`
+        :return: None
+        :rtype:
+        """
+        connection.execute('DELETE FROM outputs WHERE file_name = ?',
+                           (file_name,))
+        connection.execute('DELETE FROM parameters WHERE file_name = ?',
+                           (file_name,))
+
+    def _add_entry(self, connection, file_name, mtime, size):
+        """
+        Read an output file and add it to the catalog.
+
+        :param connection: connection to the catalog database
+        :type connection: `sqlite3.Connection`
+        :param file_name: name of the output file
+        :type file_name: `str`
+        :param mtime: modification time of the file
+        :type mtime: `float`
+        :param size: size of the file in bytes
+        :type size: `int`
+        :return: None
+        :rtype:
+        """
+        output = LazyOutput(os.path.join(
+            self.file_system.get_outputs_directory(), file_name))
+        lens_name, model_id = self._get_run_identifiers(output, file_name)
+        kwargs_result = output['kwargs_result']
+
+        connection.execute(
+            'INSERT INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_name, lens_name, model_id,
+             ','.join([step[0] for step in output['fit_output']]),
+             self.get_chi2(output['fit_output']),
+             json.dumps(FileSystem.encode_numpy_arrays(kwargs_result)),
+             mtime, size)
+        )
+
+        connection.executemany(
+            'INSERT INTO parameters VALUES (?, ?, ?, ?, ?)',
+            [(file_name,) + row
+             for row in self.flatten_kwargs_result(kwargs_result)]
+        )
+
+    def _get_run_identifiers(self, output, file_name):
+        """
+        Get the lens name and the model ID of an output. Files written before
+        these were stored in the attributes are identified from the longest
+        lens name in the lens list that matches the file name.
+
+        :param output: lazily loaded output
+        :type output: `LazyOutput`
+        :param file_name: name of the output file
+        :type file_name: `str`
+        :return: lens name, model ID
+        :rtype: `str`, `str`
+        """
+        attributes = output.get_attributes(['lens_name', 'model_id'])
+        if None not in attributes:
+            return attributes
+
+        run_name = file_name[len('output_'):-len('.h5')]
+
+        for lens_name in sorted(self.file_system.get_lens_list(), key=len,
+                                reverse=True):
+            if run_name.startswith(lens_name + '_'):
+                return lens_name, run_name[len(lens_name) + 1:]
+
+        lens_name, _, model_id = run_name.rpartition('_')
+        return lens_name, model_id
+
+    @staticmethod
+    def get_chi2(fit_output):
+        """
+        Get the chi^2, i.e., -2 times the log likelihood, of the best sample
+        in the last PSO or MCMC stage of the fit output.
+
+        :param fit_output: fit output
+        :type fit_output: `list`
+        :return: chi^2, `None` if there is no PSO or MCMC stage
+        :rtype: `float`
+        """
+        for step in fit_output[::-1]:
+            if step[0] == 'PSO' and len(step[1][0]) > 0:
+                # lenstronomy stores 2 * log likelihood of the global best
+                return -float(step[1][0][-1])
+            elif step[0] == 'EMCEE' and len(step[3]) > 0:
+                return -2. * float(np.max(step[3]))
+
+        return None
+
+    @staticmethod
+    def flatten_kwargs_result(kwargs_result):
+        """
+        Flatten the scalar parameters in `kwargs_result` into rows of
+        (kwargs key, model index, parameter name, value).
+
+        :param kwargs_result: lenstronomy `kwargs_result` dictionary
+        :type kwargs_result: `dict`
+        :return: list of rows
+        :rtype: `list`
+        """
+        rows = []
+
+        for kwargs_key, kwargs_list in kwargs_result.items():
+            if isinstance(kwargs_list, dict):
+                kwargs_list = [kwargs_list]
+
+            for model_index, kwargs in enumerate(kwargs_list):
+                if not isinstance(kwargs, dict):
+                    continue
+
+                for parameter, value in kwargs.items():
+                    if np.isscalar(value) and not isinstance(value, str):
+                        rows.append((kwargs_key, model_index, parameter,
+                                     float(value)))
+
+        return rows
+
+    def get_table(self, lens_name=None, model_id=None):
+        """
+        Get the catalog entries, optionally selected by lens name and model
+        ID.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: model identifier
+        :type model_id: `str`
+        :return: list of entries
+        :rtype: `list` of `dict`
+        """
+        query = 'SELECT lens_name, model_id, fitting_stages, chi2, ' \
+                'kwargs_result, mtime, size FROM outputs'
+        conditions, values = self._get_conditions(lens_name, model_id)
+
+        table = []
+        with self._connect() as connection:
+            for row in connection.execute(query + conditions
+                                          + ' ORDER BY lens_name, model_id',
+                                          values):
+                table.append({
+                    'lens_name': row[0],
+                    'model_id': row[1],
+                    'fitting_stages': row[2].split(',') if row[2] else [],
+                    'chi2': row[3],
+                    'kwargs_result': FileSystem.decode_numpy_arrays(
+                        json.loads(row[4])),
+                    'mtime': row[5],
+                    'size': row[6],
+                })
+
+        return table
+
+    def get_parameter_values(self, kwargs_key, model_index, parameter,
+                             lens_name=None, model_id=None):
+        """
+        Get the best-fit values of a parameter across the cataloged outputs.
+
+        :param kwargs_key: key in `kwargs_result`, e.g., 'kwargs_lens'
+        :type kwargs_key: `str`
+        :param model_index: index of the model profile
+        :type model_index: `int`
+        :param parameter: name of the parameter, e.g., 'theta_E'
+        :type parameter: `str`
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: model identifier
+        :type model_id: `str`
+        :return: dictionary with (lens name, model ID) keys and the
+            parameter values
+        :rtype: `dict`
+        """
+        conditions, values = self._get_conditions(lens_name, model_id)
+        conditions = conditions.replace('WHERE', 'AND')
+
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT outputs.lens_name, outputs.model_id, '
+                'parameters.value FROM parameters JOIN outputs '
+                'ON parameters.file_name = outputs.file_name '
+                'WHERE parameters.kwargs_key = ? '
+                'AND parameters.model_index = ? '
+                'AND parameters.parameter = ?' + conditions,
+                [kwargs_key, model_index, parameter] + values
+            ).fetchall()
+
+        return {(row[0], row[1]): row[2] for row in rows}
+
+    @staticmethod
+    def _get_conditions(lens_name, model_id):
+        """
+        Get the SQL conditions to select by lens name and model ID.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: model identifier
+        :type model_id: `str`
+        :return: condition string, values
+        :rtype: `str`, `list`
+        """
+        conditions = []
+        values = []
+
+        if lens_name is not None:
+            conditions.append('outputs.lens_name = ?')
+            values.append(lens_name)
+        if model_id is not None:
+            conditions.append('outputs.model_id = ?')
+            values.append(model_id)
+
+        if conditions:
+            return ' WHERE ' + ' AND '.join(conditions), values
+        else:
+            return '', values
@@ -4,6 +4,8 @@ This module provides classes to post process a model run output.
 """
 __author__ = 'ajshajib'
 
+import os
+from collections import OrderedDict
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -19,20 +21,39 @@ class Output(Processor):
     """
     This class lets
     """
-    def __init__(self, io_directory):
+    def __init__(self, io_directory, data_cache_size=512 * 1024**2,
+                 output_cache_size=8):
         """
 
         :param io_directory: path to the input/output directory. Should not
             end with slash.
         :type io_directory: `str`
+        :param data_cache_size: byte budget of the in-memory cache for the
+            image and PSF data, caching is turned off if 0
+        :type data_cache_size: `int`
+        :param output_cache_size: maximum number of loaded outputs to cache,
+            the least recently used one is closed when exceeded
+        :type output_cache_size: `int`
         """
-        super(Output, self).__init__(io_directory)
+        super(Output, self).__init__(io_directory,
+                                     data_cache_size=data_cache_size)
 
         self._fit_output = None
         self._kwargs_result = None
         self._model_settings = None
         self._samples_mcmc = None
         self._params_mcmc = None
+        self._lens_name = None
+        self._masks = None
+        self._psf_truncation = None
+        self._stage_metrics = None
+        self._model_config = None
+        self._model_config_settings = None
+        self._output = None
+        # loaded outputs cached by (lens name, model ID), in the order of
+        # their last use
+        self._output_cache = OrderedDict()
+        self.output_cache_size = output_cache_size
 
     @property
     def fit_output(self):
@@ -42,6 +63,9 @@ class Output(Processor):
         :return:
         :rtype:
         """
+        if self._fit_output is None and self._output is not None:
+            self._fit_output = self._output['fit_output']
+
         if self._fit_output is None:
             raise ValueError('Model output not specified!'
                              'Load an output using the `load_output()`'
@@ -81,6 +105,62 @@ class Output(Processor):
         else:
             return self._model_settings
 
+    @property
+    def psf_truncation(self):
+        """
+        The record of the PSF kernel truncation of the loaded output, with
+        the encircled energy fraction, and the stored and truncated kernel
+        sizes for each band. `None` if the PSF kernels were not truncated.
+
+        :return:
+        :rtype: `dict`
+        """
+        return self._psf_truncation
+
+    @property
+    def stage_metrics(self):
+        """
+        The metrics of the entries of the fitting kwargs list of the loaded
+        output, see `Processor.get_stage_metrics()`. Empty if they were not
+        recorded.
+
+        :return:
+        :rtype: `list`
+        """
+        if self._stage_metrics is None:
+            return []
+        else:
+            return self._stage_metrics
+
+    @property
+    def model_config(self):
+        """
+        The `ModelConfig` instance for the `model_settings`. The instance is
+        reused while the same output is loaded, so that its derived products
+        stay memoized. The masks stored in the output are used instead of
+        rebuilding them or loading them from the mask files.
+
+        :return:
+        :rtype: `ModelConfig`
+        """
+        if self._model_config is None \
+                or self._model_config_settings is not self.model_settings:
+            data_directory = None
+            if self._lens_name is not None:
+                data_directory = self.file_system.get_lens_data_directory(
+                    self._lens_name)
+
+            self._model_config = ModelConfig(settings=self.model_settings,
+                                             data_directory=data_directory)
+            # the config tracks a copy of the settings
+            self._model_config_settings = self.model_settings
+
+            if self._masks is not None:
+                masks = self._masks
+                self._model_config.get_memoized('get_masks', lambda: masks)
+
+        return self._model_config
+
     @property
     def samples_mcmc(self):
         """
@@ -89,6 +169,8 @@ class Output(Processor):
         :return:
         :rtype:
         """
+        self._load_mcmc_output()
+
         if self._samples_mcmc is None:
             return []
         else:
@@ -102,6 +184,8 @@ class Output(Processor):
         :return:
         :rtype:
         """
+        self._load_mcmc_output()
+
         if self._params_mcmc is None:
             return []
         else:
@@ -115,11 +199,29 @@ class Output(Processor):
         :return:
         :rtype:
         """
+        self._load_mcmc_output()
+
         if self._params_mcmc is None:
             return 0
         else:
             return len(self._params_mcmc)
 
+    def _load_mcmc_output(self):
+        """
+        Set the MCMC samples and parameters from the fit output of the
+        loaded output, when they are first accessed.
+
+        :return: None
+        :rtype:
+        """
+        if self._output is None or self._samples_mcmc is not None \
+                or self._params_mcmc is not None:
+            return
+
+        if self.fit_output and self.fit_output[-1][0] == 'EMCEE':
+            self._samples_mcmc = self.fit_output[-1][1]
+            self._params_mcmc = self.fit_output[-1][2]
+
     def swim(self, *args, **kwargs):
         """
         Override the `swim` method of the `Processor` class to make it
@@ -129,7 +231,10 @@ class Output(Processor):
 
     def load_output(self, lens_name, model_id):
         """
-        Load output from file and save in class variables.
+        Load output from file and save in class variables. The fit output
+        and the MCMC samples are only read when accessed. The lazily loaded
+        outputs are cached per (`lens_name`, `model_id`) until the output
+        file changes, for up to `output_cache_size` outputs.
 
         :param lens_name: lens name
         :type lens_name: `str`
@@ -138,15 +243,33 @@ class Output(Processor):
         :return: output dictionary
         :rtype: `dict`
         """
-        output = self.file_system.load_output(lens_name, model_id)
+        mtime = os.path.getmtime(self.file_system.get_output_file_path(
+            lens_name, model_id, file_type='h5'))
+
+        key = (lens_name, model_id)
+        cached = self._output_cache.pop(key, None)
+        if cached is not None and cached[0] == mtime:
+            output = cached[1]
+        else:
+            if cached is not None:
+                cached[1].close()
+            output = self.file_system.load_output(lens_name, model_id)
+        self._output_cache[key] = (mtime, output)
+
+        while len(self._output_cache) > max(self.output_cache_size, 1):
+            _, (_, evicted) = self._output_cache.popitem(last=False)
+            evicted.close()
 
+        self._output = output
+        self._lens_name = lens_name
         self._model_settings = output['settings']
         self._kwargs_result = output['kwargs_result']
-        self._fit_output = output['fit_output']
-
-        if self.fit_output[-1][0] == 'EMCEE':
-            self._samples_mcmc = self.fit_output[-1][1]
-            self._params_mcmc = self.fit_output[-1][2]
+        self._fit_output = None
+        self._masks = output.get('masks')
+        self._psf_truncation = output.get('psf_truncation')
+        self._stage_metrics = output.get('stage_metrics')
+        self._samples_mcmc = None
+        self._params_mcmc = None
 
         return output
 
@@ -183,7 +306,7 @@ class Output(Processor):
         multi_band_list_out = self.get_kwargs_data_joint(
                                                 lens_name)['multi_band_list']
 
-        config = ModelConfig(settings=self.model_settings)
+        config = self.model_config
 
         mask = config.get_masks()
         kwargs_model = config.get_kwargs_model()
@@ -362,39 +485,93 @@ class Output(Processor):
 
         return fig
 
+    def get_stage_metrics(self, lens_name, model_id, fitting_type=None):
+        """
+        Get the wall time, CPU time, number of likelihood evaluations,
+        evaluations per second, and peak RSS of the entries of the fitting
+        kwargs list of a model run, see `Processor.get_stage_metrics()`. The
+        likelihood evaluations and the CPU time do not include the child
+        processes of runs with `thread_count` > 1.
+
+        :param lens_name: name of the lens
+        :type lens_name: `str`
+        :param model_id: model run identifier
+        :type model_id: `str`
+        :param fitting_type: if provided, only the entries of this fitting
+            type, e.g., 'PSO', are returned
+        :type fitting_type: `str`
+        :return: metrics of the entries, in the order they were run
+        :rtype: `list`
+        """
+        self.load_output(lens_name, model_id)
+
+        return [metrics for metrics in self.stage_metrics
+                if fitting_type is None
+                or metrics['fitting_type'] == fitting_type]
+
     def get_reshaped_emcee_chain(self, lens_name, model_id, walker_ratio,
                                  burn_in=-100, verbose=True):
         """
+        Get the MCMC chain as a (num_walkers, num_steps, num_params) array.
+        The array is a strided view into `samples_mcmc`, so no copy is made.
 
-        :param lens_name:
-        :type lens_name:
-        :param model_id:
-        :type model_id:
-        :param walker_ratio:
-        :type walker_ratio:
-        :param burn_in:
-        :type burn_in:
-        :param verbose:
-        :type verbose:
-        :return:
-        :rtype:
+        :param lens_name: name of the lens
+        :type lens_name: `str`
+        :param model_id: model run identifier
+        :type model_id: `str`
+        :param walker_ratio: number of walkers per parameter in MCMC
+        :type walker_ratio: `int`
+        :param burn_in: not used, kept for backward compatibility
+        :type burn_in: `int`
+        :param verbose: not used, kept for backward compatibility
+        :type verbose: `bool`
+        :return: MCMC chain
+        :rtype: `ndarray`
         """
         self.load_output(lens_name, model_id)
 
-        num_params = self.num_params_mcmc  # self.samples_mcmc.shape[1]
+        num_params = self.num_params_mcmc
         num_walkers = walker_ratio * num_params
         num_step = int(len(self.samples_mcmc) / num_walkers)
 
-        chain = np.empty((num_walkers, num_step, num_params))
+        # emcee stores the flattened chain step by step
+        return self.samples_mcmc[:num_step * num_walkers].reshape(
+            (num_step, num_walkers, num_params)).transpose((1, 0, 2))
 
-        for i in np.arange(num_params):
-            samples = self.samples_mcmc[:, i].T
-            chain[:, :, i] = samples.reshape((num_step, num_walkers)).T
+    def get_chain_statistics(self, lens_name, model_id, walker_ratio,
+                             thin=1):
+        """
+        Compute the mean, median, standard deviation, and the 16th and 84th
+        percentiles over the walkers at every step of the MCMC chain.
 
-        return chain
+        :param lens_name: name of the lens
+        :type lens_name: `str`
+        :param model_id: model run identifier
+        :type model_id: `str`
+        :param walker_ratio: number of walkers per parameter in MCMC
+        :type walker_ratio: `int`
+        :param thin: compute the statistics at every `thin`-th step
+        :type thin: `int`
+        :return: dictionary with the 'steps' and the 'mean', 'median',
+            'std', 'q16', and 'q84' arrays with shape (num_params, num_steps)
+        :rtype: `dict`
+        """
+        chain = self.get_reshaped_emcee_chain(lens_name, model_id,
+                                              walker_ratio)[:, ::thin, :]
+
+        q16, median, q84 = np.percentile(chain, [16., 50., 84.], axis=0)
+
+        return {
+            'steps': np.arange(0, chain.shape[1] * thin, thin),
+            'mean': np.mean(chain, axis=0).T,
+            'median': median.T,
+            'std': np.std(chain, axis=0).T,
+            'q16': q16.T,
+            'q84': q84.T,
+        }
 
     def plot_mcmc_trace(self, lens_name, model_id, walker_ratio,
-                        burn_in=-100, verbose=True, fig_width=16):
+                        burn_in=-100, verbose=True, fig_width=16, thin=1):
         """
         Plot the trace of MCMC walkers.
 
@@ -411,56 +588,41 @@ class Output(Processor):
         :type verbose: `bool`
         :param fig_width: width of the figure
         :type fig_width: `float`
+        :param thin: plot every `thin`-th step
+        :type thin: `int`
         :return: `matplotlib.pyplot.figure` instance with the plots
         :rtype: `matplotlib.pyplot.figure`
         """
-        chain = self.get_reshaped_emcee_chain(lens_name, model_id,
-                                              walker_ratio,
-                                              burn_in=burn_in, verbose=verbose)
+        statistics = self.get_chain_statistics(lens_name, model_id,
+                                               walker_ratio, thin=thin)
 
         num_params = self.num_params_mcmc
-        num_step = chain.shape[1]
-
-        mean_pos = np.zeros((num_params, num_step))
-        median_pos = np.zeros((num_params, num_step))
-        std_pos = np.zeros((num_params, num_step))
-        q16_pos = np.zeros((num_params, num_step))
-        q84_pos = np.zeros((num_params, num_step))
-
-        # chain = np.empty((nwalker, nstep, ndim), dtype = np.double)
-        for i in np.arange(num_params):
-            for j in np.arange(num_step):
-                mean_pos[i][j] = np.mean(chain[:, j, i])
-                median_pos[i][j] = np.median(chain[:, j, i])
-                std_pos[i][j] = np.std(chain[:, j, i])
-                q16_pos[i][j] = np.percentile(chain[:, j, i], 16.)
-                q84_pos[i][j] = np.percentile(chain[:, j, i], 84.)
+        steps = statistics['steps']
+        median_pos = statistics['median']
+        q16_pos = statistics['q16']
+        q84_pos = statistics['q84']
+
+        num_step = len(self.samples_mcmc) // (walker_ratio * num_params)
+        # negative `burn_in` counts from the end, as in slicing
+        after_burn_in = steps >= (burn_in if burn_in >= 0
+                                  else max(num_step + burn_in, 0))
 
         fig, ax = plt.subplots(num_params, sharex='all',
                                figsize=(fig_width, int(fig_width/8) *
                                         num_params))
-        last = num_step
-        medians = []
+        medians = np.median(median_pos[:, after_burn_in], axis=1)
 
         for i in range(num_params):
             if verbose:
                 print(self.params_mcmc[i],
-                      '{:.4f} ± {:.4f}'.format(median_pos[i][last - 1],
-                                               (q84_pos[i][last - 1] -
-                                                q16_pos[i][last - 1]) / 2))
-            # ax[i].plot(mean_pos[i][:3000], c='b')
-            ax[i].plot(median_pos[i][:last], c='g')
-            # ax[i].axhline(np.mean(mean_pos[i][burnin:2900]), c='b')
-            ax[i].axhline(np.median(median_pos[i][burn_in:last]), c='r', lw=1)
-            ax[i].fill_between(np.arange(last), q84_pos[i][:last],
-                               q16_pos[i][:last], alpha=0.4)
-            # ax[i].fill_between(np.arange(last), mean_pos[i][:last] \
-            # +std_pos[i][:last], mean_pos[i][:last]-std_pos[i][:last],
-            # alpha=0.4)
+                      '{:.4f} ± {:.4f}'.format(median_pos[i][-1],
+                                               (q84_pos[i][-1] -
+                                                q16_pos[i][-1]) / 2))
+            ax[i].plot(steps, median_pos[i], c='g')
+            ax[i].axhline(medians[i], c='r', lw=1)
+            ax[i].fill_between(steps, q84_pos[i], q16_pos[i], alpha=0.4)
             ax[i].set_ylabel(self.params_mcmc[i], fontsize=10)
-            ax[i].set_xlim(0, last)
-
-            medians.append(np.median(median_pos[i][burn_in:last]))
+            ax[i].set_xlim(0, num_step)
 
         return fig
 
@@ -477,7 +639,7 @@ class Output(Processor):
         """
         self.load_output(lens_name, model_id=model_id)
 
-        config = ModelConfig(settings=self._model_settings)
+        config = self.model_config
         kwargs_params = config.get_kwargs_params()
         kwargs_model = config.get_kwargs_model()
         kwargs_constraints = config.get_kwargs_constraints()
@@ -512,7 +674,7 @@ class Output(Processor):
         kwargs = param.args2kwargs(args)
 
         if linear_solve:
-            config = ModelConfig(settings=self._model_settings)
+            config = self.model_config
 
             # kwargs_numerics = config.get_kwargs_numerics()
             kwargs_model = config.get_kwargs_model()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a class to summarize the progress of the model runs
+from their event logs.
+"""
+__author__ = 'ajshajib'
+
+import json
+
+from dolphin.processor.files import FileSystem
+
+
+class Progress(object):
+    """
+    This class reads the JSON lines event logs written by `Processor.swim`
+    in the `logs` directory, and summarizes the progress and throughput of
+    the model runs across the sample.
+    """
+    def __init__(self, io_directory):
+        """
+
+        :param io_directory: path to the input/output directory. Should not
+            end with slash.
+        :type io_directory: `str`
+        """
+        self.file_system = FileSystem(io_directory)
+
+    @staticmethod
+    def read_events(file_path):
+        """
+        Read the events from an event log. A last line that is incomplete,
+        e.g., while it is being written, is skipped.
+
+        :param file_path: path to the event log
+        :type file_path: `str`
+        :return: list of events
+        :rtype: `list` of `dict`
+        """
+        events = []
+        with open(file_path, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        return events
+
+    @staticmethod
+    def summarize_events(events):
+        """
+        Summarize the events of a model run. The status and the progress
+        are from the events since the last 'swim_start', the likelihood
+        evaluations and the stage wall time are summed over all the events,
+        including the ones of the previous runs before a resume. The
+        likelihood evaluations in the child processes of runs with
+        `thread_count` > 1 are not counted, so 'likelihood_evaluations' and
+        'evaluations_per_second' under-report these runs by up to a factor
+        of the thread count, see `Processor.get_stage_metrics()`.
+
+        :param events: list of events from `read_events()`
+        :type events: `list` of `dict`
+        :return: dictionary with 'lens_name', 'model_id', 'status'
+            ('running', 'completed', or 'failed'), 'num_completed',
+            'num_stages', 'current_stage', 'best_log_likelihood',
+            'likelihood_evaluations', 'stage_wall_time',
+            'evaluations_per_second', 'start_time', 'last_time', and 'error'
+        :rtype: `dict`
+        """
+        summary = {
+            'lens_name': None,
+            'model_id': None,
+            'status': 'running',
+            'num_completed': 0,
+            'num_stages': None,
+            'current_stage': None,
+            'best_log_likelihood': None,
+            'likelihood_evaluations': 0,
+            'stage_wall_time': 0.,
+            'evaluations_per_second': None,
+            'start_time': None,
+            'last_time': None,
+            'error': None,
+        }
+
+        for event in events:
+            name = event.get('event')
+            summary['lens_name'] = event.get('lens_name')
+            summary['model_id'] = event.get('model_id')
+            summary['last_time'] = event.get('time')
+            if summary['start_time'] is None:
+                summary['start_time'] = event.get('time')
+
+            if name == 'swim_start':
+                summary['status'] = 'running'
+                summary['error'] = None
+                summary['current_stage'] = None
+                summary['num_completed'] = event['num_completed']
+                summary['num_stages'] = event['num_stages']
+            elif name == 'stage_start':
+                summary['current_stage'] = event['fitting_type']
+            elif name == 'stage_end':
+                summary['current_stage'] = None
+                summary['num_completed'] = event['index'] + 1
+                summary['num_stages'] = event['num_stages']
+                summary['likelihood_evaluations'] += sum(
+                    event['metrics']['likelihood_evaluations'])
+                summary['stage_wall_time'] += event['metrics']['wall_time']
+                if event.get('best_log_likelihood') is not None:
+                    summary['best_log_likelihood'] = \
+                        event['best_log_likelihood']
+            elif name == 'swim_end':
+                summary['status'] = 'completed'
+                summary['best_log_likelihood'] = event['best_log_likelihood']
+            elif name == 'error':
+                summary['status'] = 'failed'
+                summary['error'] = '{}: {}'.format(event['exception'],
+                                                   event['message'])
+
+        if summary['stage_wall_time'] > 0:
+            summary['evaluations_per_second'] = \
+                summary['likelihood_evaluations'] \
+                / summary['stage_wall_time']
+
+        return summary
+
+    def get_table(self, lens_name=None, model_id=None):
+        """
+        Get the summaries of the model runs in the logs directory,
+        optionally selected by lens name and model ID.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: model identifier
+        :type model_id: `str`
+        :return: list of summaries from `summarize_events()`, sorted by lens
+            name and model ID
+        :rtype: `list` of `dict`
+        """
+        table = []
+        for file_path in self.file_system.get_event_log_list():
+            summary = self.summarize_events(self.read_events(file_path))
+
+            if summary['lens_name'] is None \
+                    or (lens_name is not None
+                        and summary['lens_name'] != lens_name) \
+                    or (model_id is not None
+                        and summary['model_id'] != model_id):
+                continue
+
+            table.append(summary)
+
+        return sorted(table, key=lambda row: (row['lens_name'],
+                                              row['model_id']))
+
+    def get_summary(self, model_id=None):
+        """
+        Get the sample-wide progress and throughput of the model runs. The
+        throughput is computed over the elapsed time from the first to the
+        last event across the runs.
+
+        :param model_id: model identifier
+        :type model_id: `str`
+        :return: dictionary with 'num_runs', 'num_running',
+            'num_completed', 'num_failed', 'num_stages_completed',
+            'likelihood_evaluations', 'elapsed_time' in seconds,
+            'evaluations_per_second', and 'runs_per_hour' of the completed
+            runs
+        :rtype: `dict`
+        """
+        table = self.get_table(model_id=model_id)
+
+        summary = {
+            'num_runs': len(table),
+            'num_running': 0,
+            'num_completed': 0,
+            'num_failed': 0,
+            'num_stages_completed': sum(row['num_completed']
+                                        for row in table),
+            'likelihood_evaluations': sum(row['likelihood_evaluations']
+                                          for row in table),
+            'elapsed_time': 0.,
+            'evaluations_per_second': None,
+            'runs_per_hour': None,
+        }
+        for row in table:
+            summary['num_' + row['status']] += 1
+
+        if table:
+            summary['elapsed_time'] = \
+                max(row['last_time'] for row in table) \
+                - min(row['start_time'] for row in table)
+
+        if summary['elapsed_time'] > 0:
+            summary['evaluations_per_second'] = \
+                summary['likelihood_evaluations'] / summary['elapsed_time']
+            summary['runs_per_hour'] = \
+                summary['num_completed'] / summary['elapsed_time'] * 3600.
+
+        return summary
@@ -4,14 +4,174 @@ This module loads settings from a configuration file.
 """
 __author__ = 'ajshajib'
 
+import os
+import pickle
+import functools
 import yaml
+import h5py
 import numpy as np
 from copy import deepcopy
 
 from lenstronomy.Data.coord_transforms import Coordinates
 from lenstronomy.Util.param_util import ellipticity2phi_q
-import lenstronomy.Util.util as util
-import lenstronomy.Util.mask_util as mask_util
+
+
+def memoize(method):
+    """
+    Decorator to memoize a `ModelConfig` method without arguments. The
+    memoized values are invalidated when the `settings` change.
+
+    :param method: method to memoize
+    :type method: `function`
+    :return: memoized method
+    :rtype: `function`
+    """
+    @functools.wraps(method)
+    def memoized_method(self):
+        return self.get_memoized(method.__name__, lambda: method(self))
+
+    return memoized_method
+
+
+def _count_change(method):
+    """
+    Decorator for the methods of `SettingsDict` and `SettingsList` that
+    change the container. The change is counted in the version shared by
+    the settings, and the dictionaries and lists added are also tracked.
+
+    :param method: method that changes the container
+    :type method: `function`
+    :return: tracked method
+    :rtype: `function`
+    """
+    @functools.wraps(method)
+    def changing_method(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.version[0] += 1
+        self.track_values()
+        return result
+
+    return changing_method
+
+
+def track_settings(value, version):
+    """
+    Track the changes of the dictionaries and lists in `value`.
+
+    :param value: settings or a value in the settings
+    :type value:
+    :param version: one-element list with the number of changes, shared by
+        all the containers of the settings
+    :type version: `list`
+    :return: `value` with the dictionaries and lists converted into
+        `SettingsDict` and `SettingsList`
+    :rtype:
+    """
+    if isinstance(value, (SettingsDict, SettingsList)) \
+            and value.version is version:
+        return value
+    elif isinstance(value, dict):
+        return SettingsDict(value, version)
+    elif isinstance(value, list):
+        return SettingsList(value, version)
+    else:
+        return value
+
+
+class SettingsDict(dict):
+    """
+    Dictionary of the settings that counts the changes made to it, so that
+    the values derived from the settings can be invalidated without
+    comparing the whole settings. Copies are plain dictionaries.
+    """
+    def __init__(self, data, version):
+        """
+
+        :param data: dictionary to track
+        :type data: `dict`
+        :param version: one-element list with the number of changes
+        :type version: `list`
+        """
+        super(SettingsDict, self).__init__(data)
+        self.version = version
+        self.track_values()
+
+    def track_values(self):
+        """
+        Track the dictionaries and lists among the values.
+
+        :return: None
+        :rtype:
+        """
+        for key, value in dict.items(self):
+            tracked = track_settings(value, self.version)
+            if tracked is not value:
+                dict.__setitem__(self, key, tracked)
+
+    def __deepcopy__(self, memo):
+        return {deepcopy(key, memo): deepcopy(value, memo)
+                for key, value in dict.items(self)}
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    __setitem__ = _count_change(dict.__setitem__)
+    __delitem__ = _count_change(dict.__delitem__)
+    __ior__ = _count_change(dict.__ior__)
+    clear = _count_change(dict.clear)
+    pop = _count_change(dict.pop)
+    popitem = _count_change(dict.popitem)
+    setdefault = _count_change(dict.setdefault)
+    update = _count_change(dict.update)
+
+
+class SettingsList(list):
+    """
+    List in the settings that counts the changes made to it, see
+    `SettingsDict`. Copies are plain lists.
+    """
+    def __init__(self, data, version):
+        """
+
+        :param data: list to track
+        :type data: `list`
+        :param version: one-element list with the number of changes
+        :type version: `list`
+        """
+        super(SettingsList, self).__init__(data)
+        self.version = version
+        self.track_values()
+
+    def track_values(self):
+        """
+        Track the dictionaries and lists among the elements.
+
+        :return: None
+        :rtype:
+        """
+        for i, value in enumerate(list.__iter__(self)):
+            tracked = track_settings(value, self.version)
+            if tracked is not value:
+                list.__setitem__(self, i, tracked)
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(value, memo) for value in list.__iter__(self)]
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    __setitem__ = _count_change(list.__setitem__)
+    __delitem__ = _count_change(list.__delitem__)
+    __iadd__ = _count_change(list.__iadd__)
+    __imul__ = _count_change(list.__imul__)
+    append = _count_change(list.append)
+    clear = _count_change(list.clear)
+    extend = _count_change(list.extend)
+    insert = _count_change(list.insert)
+    pop = _count_change(list.pop)
+    remove = _count_change(list.remove)
+    reverse = _count_change(list.reverse)
+    sort = _count_change(list.sort)
 
 
 class Config(object):
@@ -21,23 +181,120 @@ class Config(object):
     a configuration file. If the file type of the configuration files
     changes, then only this class needs to be modified.
     """
+    # settings loaded in this process, keyed by the file path, modification
+    # time, and size
+    _load_cache = {}
+
+    # if True, the parsed settings are also saved as pickle files in a
+    # `.compiled` directory next to the config files, so that the later
+    # processes can skip parsing the YAML
+    use_compiled_cache = False
+
+    # use the libyaml-based loader if PyYAML was built with it
+    yaml_loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
 
     def __init__(self):
         pass
 
     @classmethod
-    def load(cls, file):
+    def load(cls, file, use_compiled_cache=None):
         """
-        Load configuration from `file`.
+        Load configuration from `file`. A file is parsed only once per
+        process unless it is modified.
 
+        :param file: path to the config file
+        :type file: `str`
+        :param use_compiled_cache: if True, use the compiled cache next to
+            the config file, `Config.use_compiled_cache` is used if `None`
+        :type use_compiled_cache: `bool`
         :return:
         :rtype:
         """
-        with open(file, 'r') as f:
-            settings = yaml.load(f, yaml.FullLoader)
+        if use_compiled_cache is None:
+            use_compiled_cache = cls.use_compiled_cache
+
+        stat = os.stat(file)
+        key = (os.path.abspath(file), stat.st_mtime, stat.st_size)
+
+        if key not in cls._load_cache:
+            settings = None
+            if use_compiled_cache:
+                settings = cls.read_compiled_cache(file, key)
+
+            if settings is None:
+                with open(file, 'r') as f:
+                    settings = yaml.load(f, cls.yaml_loader)
+
+                if use_compiled_cache:
+                    cls.write_compiled_cache(file, key, settings)
+
+            cls._load_cache[key] = settings
+
+        return deepcopy(cls._load_cache[key])
+
+    @staticmethod
+    def get_compiled_cache_path(file):
+        """
+        Get the path of the compiled cache file for a config file.
+
+        :param file: path to the config file
+        :type file: `str`
+        :return: path to the compiled cache file
+        :rtype: `str`
+        """
+        directory, file_name = os.path.split(os.path.abspath(file))
+
+        return os.path.join(directory, '.compiled', file_name + '.pickle')
+
+    @classmethod
+    def read_compiled_cache(cls, file, key):
+        """
+        Read the settings from the compiled cache of a config file.
+
+        :param file: path to the config file
+        :type file: `str`
+        :param key: path, modification time, and size of the config file
+        :type key: `tuple`
+        :return: settings, `None` if the cache is missing or out of date
+        :rtype: `dict`
+        """
+        try:
+            with open(cls.get_compiled_cache_path(file), 'rb') as f:
+                cached_key, settings = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+
+        if cached_key != key:
+            return None
 
         return settings
 
+    @classmethod
+    def write_compiled_cache(cls, file, key, settings):
+        """
+        Write the settings into the compiled cache of a config file. Failing
+        to write, e.g., in a read-only directory, is not an error.
+
+        :param file: path to the config file
+        :type file: `str`
+        :param key: path, modification time, and size of the config file
+        :type key: `tuple`
+        :param settings: settings loaded from the config file
+        :type settings: `dict`
+        :return: None
+        :rtype:
+        """
+        cache_path = cls.get_compiled_cache_path(file)
+        temp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                pickle.dump((key, settings), f)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+
 
 class ModelConfig(Config):
     """
@@ -45,7 +302,7 @@ class ModelConfig(Config):
     settings for a particular system.
     """
 
-    def __init__(self, file=None, settings=None):
+    def __init__(self, file=None, settings=None, data_directory=None):
         """
         Initiate a Model Config object. If the file path is given, `settings`
         will be loaded from it. Otherwise, the `settings` can be
@@ -56,9 +313,19 @@ class ModelConfig(Config):
         :param settings: a dictionary containing settings. If both `file`
             and `settings` are provided, `file` will be prioritized.
         :type settings: `dict`
+        :param data_directory: directory of the lens's data files, mask
+            files referenced in the settings are looked up here
+        :type data_directory: `str`
         """
         super(ModelConfig, self).__init__()
 
+        self.data_directory = data_directory
+        self._memo = {}
+        self._memo_version = None
+        self._settings = None
+        self._settings_version = [0]
+        self._crop_boxes = None
+
         self.settings = settings
         if file is not None:
             self.load_settings_from_file(file)
@@ -74,6 +341,68 @@ class ModelConfig(Config):
         """
         self.settings = self.load(file)
 
+    @property
+    def settings(self):
+        """
+        The settings. The dictionaries and lists in the settings count the
+        changes made to them, including the ones made in place, so that the
+        memoized values are invalidated. Changes made in place to arrays in
+        the settings are not tracked, assign a new array instead.
+
+        :return: settings
+        :rtype: `SettingsDict`
+        """
+        if self._settings is not None \
+                and not isinstance(self._settings, SettingsDict):
+            # e.g., after the instance is copied, as copies are plain
+            self._settings = track_settings(self._settings,
+                                            self._settings_version)
+
+        return self._settings
+
+    @settings.setter
+    def settings(self, settings):
+        """
+        Set the settings, which invalidates the memoized values. The
+        dictionaries and lists are copied into tracked containers, the
+        other values are not copied.
+
+        :param settings: settings
+        :type settings: `dict`
+        :return: None
+        :rtype:
+        """
+        self._settings_version = [0]
+        self._settings = track_settings(settings, self._settings_version)
+        self._memo = {}
+        self._memo_version = None
+
+    def get_memoized(self, name, function):
+        """
+        Get the memoized value of a derived product of the settings, or
+        compute and memoize it. All the memoized values are dropped when the
+        settings change, including changes made in place to their
+        dictionaries and lists, see `settings`.
+
+        :param name: name of the derived product
+        :type name: `str`
+        :param function: function to compute the derived product
+        :type function: `function`
+        :return: a copy of the derived product
+        :rtype:
+        """
+        if self.settings is not None \
+                and self._settings_version[0] != self._memo_version:
+            self._memo = {}
+            self._memo_version = self._settings_version[0]
+
+        if name not in self._memo:
+            self._memo[name] = function()
+
+        # copy so that the callers can modify the returned value, bound
+        # methods in the value keep pointing to this instance
+        return deepcopy(self._memo[name], {id(self): self})
+
     @property
     def pixel_size(self):
         """
@@ -154,6 +483,7 @@ class ModelConfig(Config):
             else:
                 return num
 
+    @memoize
     def get_kwargs_model(self):
         """
         Create `kwargs_model`.
@@ -180,6 +510,7 @@ class ModelConfig(Config):
 
         return kwargs_model
 
+    @memoize
     def get_kwargs_constraints(self):
 
         """
@@ -229,6 +560,7 @@ class ModelConfig(Config):
 
         return kwargs_constraints
 
+    @memoize
     def get_kwargs_likelihood(self):
         """
         Create `kwargs_likelihood`.
@@ -408,9 +740,97 @@ class ModelConfig(Config):
 
         return prior
 
+    @property
+    def crop_to_mask(self):
+        """
+        If `True`, the images, noise maps and masks are cropped to the
+        bounding box of the unmasked pixels plus a margin, which is set by
+        `crop_to_mask` in the mask settings. Default is `False`.
+
+        :return:
+        :rtype: `bool`
+        """
+        try:
+            return bool(self.settings['mask']['crop_to_mask'])
+        except (KeyError, NameError, TypeError):
+            return False
+
+    def get_crop_boxes(self, margins):
+        """
+        Get the regions to crop the images of the bands to, from the
+        bounding boxes of the unmasked pixels of the uncropped masks. The
+        `crop_margin` in the mask settings, one value for each band,
+        replaces the provided margins if it is set.
+
+        :param margins: margins in pixels around the unmasked pixels, e.g.,
+            the half-widths of the PSF kernels
+        :type margins: `list` of `int`
+        :return: [first row, last row + 1, first column, last column + 1]
+            of the cropped region for each band
+        :rtype: `list`
+        """
+        masks = self.get_uncropped_masks()
+        if masks is None:
+            raise ValueError('Masks are needed to crop the images!')
+
+        if self.settings['mask'].get('crop_margin') is not None:
+            margins = self.settings['mask']['crop_margin']
+
+        crop_boxes = []
+        for mask, margin in zip(masks, margins):
+            mask = np.asarray(mask) > 0
+            if not np.any(mask):
+                raise ValueError('All the pixels are masked out!')
+
+            rows = np.nonzero(np.any(mask, axis=1))[0]
+            cols = np.nonzero(np.any(mask, axis=0))[0]
+            crop_boxes.append([
+                max(int(rows[0]) - int(margin), 0),
+                min(int(rows[-1]) + 1 + int(margin), mask.shape[0]),
+                max(int(cols[0]) - int(margin), 0),
+                min(int(cols[-1]) + 1 + int(margin), mask.shape[1])
+            ])
+
+        return crop_boxes
+
+    def set_crop_boxes(self, crop_boxes):
+        """
+        Set the regions the images are cropped to, so that `get_masks`
+        returns the masks cropped to the same regions.
+
+        :param crop_boxes: [first row, last row + 1, first column, last
+            column + 1] of the cropped region for each band, `None` to not
+            crop
+        :type crop_boxes: `list`
+        :return:
+        :rtype:
+        """
+        self._crop_boxes = crop_boxes
+        self._memo = {}
+
+    @memoize
     def get_masks(self):
         """
-        Create masks.
+        Create masks, cropped to the regions set with `set_crop_boxes`.
+
+        :return:
+        :rtype:
+        """
+        masks = self.get_uncropped_masks()
+
+        if masks is None or self._crop_boxes is None:
+            return masks
+
+        return [np.asarray(mask)[row_start:row_end, col_start:col_end]
+                for mask, (row_start, row_end, col_start, col_end)
+                in zip(masks, self._crop_boxes)]
+
+    @memoize
+    def get_uncropped_masks(self):
+        """
+        Create masks for the full images. The masks are built as boolean
+        arrays on one coordinate grid per band, and the circular regions are
+        rasterized together with `rasterize_circles`.
 
         :return:
         :rtype:
@@ -419,106 +839,182 @@ class ModelConfig(Config):
             if self.settings['mask'] is not None:
                 if 'provided' in self.settings['mask'] \
                         and self.settings['mask']['provided'] is not None:
-                    return self.settings['mask']['provided']
+                    provided = self.settings['mask']['provided']
+
+                    if isinstance(provided, str):
+                        # a single file has the mask of the only band, or a
+                        # stack of the masks of all the bands
+                        mask = self.load_mask_file(provided)
+                        if mask.ndim == 2:
+                            masks = [mask]
+                        elif mask.ndim == 3:
+                            masks = list(mask)
+                        else:
+                            raise ValueError('Mask in {} needs to be 2D, or '
+                                             '3D with one mask per band!'
+                                             .format(provided))
+
+                        if len(masks) != self.band_number:
+                            raise ValueError('Mask file {} has {} mask(s) '
+                                             'for {} band(s)!'.format(
+                                                provided, len(masks),
+                                                self.band_number))
+                        return masks
+                    else:
+                        return [self.load_mask_file(mask)
+                                if isinstance(mask, str) else mask
+                                for mask in provided]
                 else:
                     masks = []
-                    mask_options = deepcopy(self.settings['mask'])
+                    mask_options = self.settings['mask']
 
                     for n in range(self.band_number):
-                        ra_at_xy_0 = mask_options['ra_at_xy_0'][n]
-                        dec_at_xy_0 = mask_options['dec_at_xy_0'][n]
-                        transform_pix2angle = np.array(
-                            mask_options['transform_matrix'][n]
-                        )
                         num_pixel = mask_options['size'][n]
-                        radius = mask_options['radius'][n]
                         offset = mask_options['centroid_offset'][n]
 
-                        coords = Coordinates(transform_pix2angle,
-                                             ra_at_xy_0, dec_at_xy_0)
-
-                        x_coords, y_coords = coords.coordinate_grid(num_pixel,
-                                                                    num_pixel)
+                        coords = Coordinates(
+                            np.array(mask_options['transform_matrix'][n]),
+                            mask_options['ra_at_xy_0'][n],
+                            mask_options['dec_at_xy_0'][n]
+                        )
+                        x_coords, y_coords = coords.coordinate_grid(
+                            num_pixel, num_pixel)
 
-                        mask_outer = mask_util.mask_center_2d(
-                            self.deflector_center_ra + offset[0],
-                            self.deflector_center_dec + offset[1],
-                            radius,
-                            util.image2array(x_coords),
-                            util.image2array(y_coords)
+                        mask = self.rasterize_circles(
+                            coords, x_coords, y_coords,
+                            [[offset[0], offset[1],
+                              mask_options['radius'][n]]]
                         )
 
-                        extra_masked_regions = []
-                        try:
-                            self.settings['mask']['extra_regions']
-                        except (NameError, KeyError):
-                            pass
-                        else:
-                            if self.settings['mask']['extra_regions'] is \
-                                    not None:
-                                for reg in self.settings['mask'][
-                                                        'extra_regions'][n]:
-                                    extra_masked_regions.append(
-                                        mask_util.mask_center_2d(
-                                            self.deflector_center_ra + reg[0],
-                                            self.deflector_center_dec + reg[1],
-                                            reg[2],
-                                            util.image2array(x_coords),
-                                            util.image2array(y_coords)
-                                        )
-                                    )
-
-                        mask = 1. - mask_outer
-
-                        for extra_region in extra_masked_regions:
-                            mask *= extra_region
+                        if mask_options.get('extra_regions') is not None:
+                            mask &= ~self.rasterize_circles(
+                                coords, x_coords, y_coords,
+                                mask_options['extra_regions'][n])
+
                         # Mask Edge Pixels
-                        try:
-                            self.settings['mask']['mask_edge_pixels']
-                        except (NameError, KeyError):
-                            pass
-                        else:
+                        if 'mask_edge_pixels' in mask_options:
                             border_length = \
-                                self.settings['mask']['mask_edge_pixels'][n]
+                                mask_options['mask_edge_pixels'][n]
                             if border_length > 0:
-                                edge_mask = 0 * np.ones(
-                                 (num_pixel, num_pixel), dtype=int)
-
+                                edge_mask = np.zeros((num_pixel, num_pixel),
+                                                     dtype=bool)
                                 edge_mask[border_length:-border_length,
-                                          border_length:-border_length] = 1
-                                edge_mask = (edge_mask.flatten()).tolist()
-                            elif border_length == 0:
-                                edge_mask = 1 * np.ones(
-                                   (num_pixel, num_pixel), dtype=int)
-                                edge_mask = (edge_mask.flatten()).tolist()
-
-                            mask *= edge_mask
+                                          border_length:-border_length] = True
+                                mask &= edge_mask
+
                         # Add custom Mask
-                        try:
-                            self.settings['mask']['custom_mask']
-                        except (NameError, KeyError):
-                            pass
-                        else:
-                            if self.settings['mask']['custom_mask'][n]\
-                                    is not None:
-                                provided_mask = \
-                                    self.settings['mask']['custom_mask'][n]
-                                provided_mask = np.array(provided_mask)
-                                # make sure that mask consist of only 0 and 1
-                                provided_mask[provided_mask > 0.] = 1.
-                                provided_mask[provided_mask <= 0.] = 0.
-                                mask *= provided_mask
-
-                        # sanity check
-                        mask[mask >= 1.] = 1.
-                        mask[mask <= 0.] = 0.
-
-                        masks.append(util.array2image(mask))
+                        if 'custom_mask' in mask_options \
+                                and mask_options['custom_mask'][n] \
+                                is not None:
+                            custom_mask = mask_options['custom_mask'][n]
+                            if isinstance(custom_mask, str):
+                                custom_mask = self.load_mask_file(
+                                    custom_mask)
+
+                            # the custom mask can be given flattened
+                            mask &= np.reshape(
+                                custom_mask, (num_pixel, num_pixel)) > 0.
+
+                        masks.append(mask.astype(float))
 
                 return masks
 
         return None
 
+    def load_mask_file(self, file_name):
+        """
+        Load a mask from a `.npy` file, or from the 'mask' dataset of an
+        `.h5` file. Relative paths are looked up in the `data_directory`.
+
+        :param file_name: name of or path to the mask file
+        :type file_name: `str`
+        :return: mask
+        :rtype: `ndarray`
+        """
+        if self.data_directory is not None:
+            file_name = os.path.join(self.data_directory, file_name)
+
+        if file_name.endswith('.npy'):
+            return np.load(file_name)
+        elif file_name.endswith('.h5') or file_name.endswith('.hdf5'):
+            with h5py.File(file_name, 'r') as f:
+                if 'mask' not in f:
+                    raise ValueError('No "mask" dataset in {}!'.format(
+                        file_name))
+                return f['mask'][()]
+        else:
+            raise ValueError('Mask file {} is not a .npy or .h5 '
+                             'file!'.format(file_name))
+
+    def rasterize_circles(self, coords, x_coords, y_coords, regions):
+        """
+        Rasterize the union of circular regions on a coordinate grid. All
+        the regions are evaluated in one broadcast operation, over pixel
+        windows around the region centers that are just large enough to
+        contain the largest region, or over the full grid if that is
+        smaller.
+
+        :param coords: coordinate system of the grid
+        :type coords: `Coordinates`
+        :param x_coords: RA coordinates of the pixels
+        :type x_coords: `ndarray`
+        :param y_coords: Dec coordinates of the pixels
+        :type y_coords: `ndarray`
+        :param regions: list of [RA offset, Dec offset, radius] of the
+            regions, the offsets are relative to the deflector center
+        :type regions: `list`
+        :return: boolean array that is True inside any of the regions
+        :rtype: `ndarray`
+        """
+        regions = np.array(regions, dtype=float).reshape(-1, 3)
+        if len(regions) == 0:
+            return np.zeros(x_coords.shape, dtype=bool)
+
+        center_x = self.deflector_center_ra + regions[:, 0]
+        center_y = self.deflector_center_dec + regions[:, 1]
+        radius_squared = np.square(regions[:, 2])
+
+        # largest extent of the regions in pixels, from the smallest
+        # singular value of the pixel-to-angle transform
+        pixel_scale = np.linalg.svd(coords.transform_pix2angle,
+                                    compute_uv=False)[-1]
+        half_width = int(np.ceil(np.max(regions[:, 2]) / pixel_scale)) + 1
+        offsets = np.arange(-half_width, half_width + 1)
+
+        if len(regions) * len(offsets)**2 >= x_coords.size:
+            distance_squared = np.square(
+                x_coords[np.newaxis] - center_x[:, None, None])
+            distance_squared += np.square(
+                y_coords[np.newaxis] - center_y[:, None, None])
+
+            return np.any(distance_squared
+                          <= radius_squared[:, None, None], axis=0)
+
+        center_col, center_row = coords.map_coord2pix(center_x, center_y)
+        rows = np.round(center_row).astype(int)[:, None, None] \
+            + offsets[None, :, None]
+        cols = np.round(center_col).astype(int)[:, None, None] \
+            + offsets[None, None, :]
+        rows, cols = np.broadcast_arrays(rows, cols)
+
+        num_row, num_col = x_coords.shape
+        in_grid = (rows >= 0) & (rows < num_row) \
+            & (cols >= 0) & (cols < num_col)
+        rows = rows[in_grid]
+        cols = cols[in_grid]
+        region_index = np.broadcast_to(
+            np.arange(len(regions))[:, None, None], in_grid.shape)[in_grid]
+
+        inside = np.square(x_coords[rows, cols] - center_x[region_index]) \
+            + np.square(y_coords[rows, cols] - center_y[region_index]) \
+            <= radius_squared[region_index]
+
+        mask = np.zeros(x_coords.shape, dtype=bool)
+        mask[rows[inside], cols[inside]] = True
+
+        return mask
+
+    @memoize
     def get_kwargs_psf_iteration(self):
         """
         Create `kwargs_psf_iteration`.
@@ -550,6 +1046,7 @@ class ModelConfig(Config):
         else:
             return {}
 
+    @memoize
     def get_kwargs_numerics(self):
         """
         Create `kwargs_numerics`.
@@ -568,12 +1065,19 @@ class ModelConfig(Config):
             if supersampling_factor is None:
                 supersampling_factor = [3] * self.band_number
 
+        # supersampled convolution is optional, with one value for each band
+        options = self.settings.get('kwargs_numerics') or {}
+        supersampling_convolution = options.get(
+            'supersampling_convolution') or [False] * self.band_number
+        supersampling_kernel_size = options.get(
+            'supersampling_kernel_size') or [3] * self.band_number
+
         kwargs_numerics = []
         for n in range(self.band_number):
             kwargs_numerics.append({
                 'supersampling_factor': supersampling_factor[n],
-                'supersampling_convolution': False,
-                'supersampling_kernel_size': 3,
+                'supersampling_convolution': supersampling_convolution[n],
+                'supersampling_kernel_size': supersampling_kernel_size[n],
                 'flux_evaluate_indexes': None,
                 'point_source_supersampling_factor': 1,
                 'compute_mode': 'regular',
@@ -581,6 +1085,124 @@ class ModelConfig(Config):
 
         return kwargs_numerics
 
+    def get_kwargs_numerics_schedule(self):
+        """
+        Create the updates of `kwargs_numerics` for the epochs of the PSO
+        recipes from `kwargs_numerics['pso_epochs']` in the settings. Each
+        entry in `pso_epochs` updates the `kwargs_numerics` of one epoch,
+        the values are lists with one element for each band, e.g.,
+        `{'supersampling_factor': [1]}`. The later epochs and the sampling
+        use the `kwargs_numerics` from `get_kwargs_numerics()`.
+
+        :return: list of `kwargs_numerics` updates for the epochs, with one
+            `dict` for each band
+        :rtype: `list`
+        """
+        try:
+            pso_epochs = self.settings['kwargs_numerics']['pso_epochs']
+        except (KeyError, NameError, TypeError):
+            pso_epochs = None
+
+        if pso_epochs is None:
+            return []
+
+        schedule = []
+        for epoch_numerics in pso_epochs:
+            for key, values in epoch_numerics.items():
+                if len(values) != self.band_number:
+                    raise ValueError("'{}' in 'pso_epochs' needs one value "
+                                     "for each band!".format(key))
+
+            schedule.append([{key: values[n] for key, values
+                              in epoch_numerics.items()}
+                             for n in range(self.band_number)])
+
+        return schedule
+
+    def get_supersampled_indexes(self, kwargs_data_list, arc_masks=None):
+        """
+        Create the boolean maps of the pixels to supersample with the
+        adaptive numerics of `lenstronomy`, from
+        `kwargs_numerics['adaptive_supersampling']` in the settings. The
+        pixels within `radius` (in arcsec, one value for each band) of the
+        deflector center, the pixels on the arcs in `arc_masks`, and the
+        pixels with a signal-to-noise ratio above `threshold` (optional, one
+        value for each band) are supersampled, if they are not masked out.
+
+        :param kwargs_data_list: `kwargs_data` of the bands
+        :type kwargs_data_list: `list`
+        :param arc_masks: arc masks from `Recipe.get_arc_masks`, where the
+            arcs are set to 0
+        :type arc_masks: `list` of `ndarray`
+        :return: supersampled pixels for each band, `None` if adaptive
+            supersampling is not used
+        :rtype: `list` of `ndarray`
+        """
+        try:
+            options = self.settings['kwargs_numerics'][
+                'adaptive_supersampling']
+        except (KeyError, NameError, TypeError):
+            options = None
+
+        if options is None:
+            return None
+
+        radius = options.get('radius', [0.5] * self.band_number)
+        threshold = options.get('threshold')
+        if threshold is None:
+            threshold = [None] * self.band_number
+        masks = self.get_masks()
+
+        supersampled_indexes = []
+        for n, kwargs_data in enumerate(kwargs_data_list):
+            shape = np.shape(kwargs_data['image_data'])
+            coords = Coordinates(np.array(kwargs_data['transform_pix2angle']),
+                                 kwargs_data['ra_at_xy_0'],
+                                 kwargs_data['dec_at_xy_0'])
+            x_coords, y_coords = coords.coordinate_grid(shape[1], shape[0])
+
+            indexes = self.rasterize_circles(coords, x_coords, y_coords,
+                                             [[0., 0., radius[n]]])
+
+            if masks is None or masks[n] is None:
+                mask = np.ones(shape, dtype=bool)
+            else:
+                mask = np.reshape(masks[n], shape) > 0
+
+            if arc_masks is not None and arc_masks[n] is not None:
+                indexes |= mask & (np.reshape(arc_masks[n], shape) < 1)
+
+            if threshold[n] is not None:
+                noise = kwargs_data.get('noise_map')
+                if noise is None:
+                    noise = kwargs_data['background_rms']
+                indexes |= np.asarray(kwargs_data['image_data']) \
+                    > threshold[n] * np.asarray(noise)
+
+            supersampled_indexes.append(indexes & mask)
+
+        return supersampled_indexes
+
+    def use_arc_masks_for_supersampling(self):
+        """
+        Check if the arc masks are used to select the supersampled pixels,
+        which is set by `kwargs_numerics['adaptive_supersampling']
+        ['arc_mask']`. Default is `True` if adaptive supersampling is used.
+
+        :return: `True` if the arc masks are used
+        :rtype: `bool`
+        """
+        try:
+            options = self.settings['kwargs_numerics'][
+                'adaptive_supersampling']
+        except (KeyError, NameError, TypeError):
+            return False
+
+        if options is None:
+            return False
+
+        return bool(options.get('arc_mask', True))
+
     def get_lens_model_list(self):
         """
         Return `lens_model_list`.
@@ -951,6 +1573,7 @@ class ModelConfig(Config):
                         fixed_list[int(index)][key] = value
         return fixed_list
 
+    @memoize
     def get_kwargs_params(self):
         """
         Create `kwargs_params`.
@@ -968,6 +1591,31 @@ class ModelConfig(Config):
 
         return kwargs_params
 
+    def get_psf_encircled_energy(self):
+        """
+        Get the encircled energy fractions to truncate the PSF kernels to,
+        from `psf_truncation['encircled_energy']` in the settings, one value
+        for each band.
+
+        :return: encircled energy fractions, `None` if the PSF kernels are
+            not truncated
+        :rtype: `list`
+        """
+        try:
+            encircled_energy = self.settings['psf_truncation'][
+                'encircled_energy']
+        except (KeyError, NameError, TypeError):
+            return None
+
+        if encircled_energy is None:
+            return None
+
+        if len(encircled_energy) != self.band_number:
+            raise ValueError('Need one encircled energy fraction for each '
+                             'band to truncate the PSF!')
+
+        return encircled_energy
+
     def get_psf_supersampled_factor(self):
         """
         Retrieve PSF supersampling factor if specified in the config file.
@@ -4,15 +4,29 @@ This module loads settings from a configuration file.
 """
 __author__ = 'ajshajib'
 
+import os
 import sys
-from lenstronomy.Workflow.fitting_sequence import FittingSequence
+import time
+import traceback
+import resource
+from contextlib import redirect_stdout
+import h5py
+import numpy as np
 from schwimmbad import choose_pool
+from schwimmbad import MultiPool
+from copy import deepcopy
+from lenstronomy.ImSim.MultiBand.single_band_multi_model import \
+    SingleBandMultiModel
 
 from .files import FileSystem
 from .config import ModelConfig
 from .data import ImageData
 from .data import PSFData
+from .data import DataCache
 from .recipe import Recipe
+from .fitting import FittingSequence
+from .fitting import LikelihoodCounter
+from .events import EventLog
 
 
 class Processor(object):
@@ -20,27 +34,44 @@ class Processor(object):
     This class contains methods to model a single lens system or a bunch of
     systems from the config files.
     """
-    def __init__(self, io_directory):
+    def __init__(self, io_directory, data_cache_size=512 * 1024**2):
         """
 
         :param io_directory: path to the input/output directory. Should not
             end with slash.
         :type io_directory: `str`
+        :param data_cache_size: byte budget of the in-memory cache for the
+            image and PSF data, caching is turned off if 0
+        :type data_cache_size: `int`
         """
         self.io_directory = io_directory
         self.file_system = FileSystem(io_directory)
         self.lens_list = self.file_system.get_lens_list()
+        self.data_cache = DataCache(max_bytes=data_cache_size)
+
+    # entries of the fitting kwargs list that only change the state of the
+    # `FittingSequence`, these are replayed when resuming from a checkpoint
+    _replay_fitting_types = ['update_settings', 'set_param_value',
+                             'fix_not_computed', 'restart', 'set_resolution']
 
     def swim(self, lens_name, model_id, log=True, mpi=False,
-             recipe_name='default', sampler='EMCEE', thread_count=1):
+             recipe_name='default', sampler='EMCEE', thread_count=1,
+             resume=False):
         """
-        Run models for a single lens.
+        Run models for a single lens. A checkpoint is saved in the outputs
+        directory after each entry of the fitting kwargs list is completed,
+        and removed after the final output is saved. The wall time, and the
+        CPU time, number of likelihood evaluations, and peak RSS of each
+        rank are recorded for each entry in the 'stage_metrics' of the
+        output, see `get_stage_metrics()`.
 
         :param lens_name: lens name
         :type lens_name: `str`
         :param model_id: identifier for the model run
         :type model_id: `str`
-        :param log: if `True`, all `print` statements will be logged
+        :param log: if `True`, the events of the run are written into the
+            event log file, see `EventLog` and `_swim()`, and the printed
+            progress is discarded
         :type log: `bool`
         :param mpi: MPI option
         :type mpi: `bool`
@@ -50,17 +81,78 @@ class Processor(object):
         :param sampler: 'EMCEE' or 'COSMOHAMMER', cosmohammer is kept for
             legacy
         :type sampler: `str`
-        :param thread_count: number of threads if `multiprocess` is used
+        :param thread_count: number of threads if `multiprocess` is used,
+            the likelihood evaluations in these threads are not counted in
+            the stage metrics, see `get_stage_metrics()`
         :type thread_count: `int`
+        :param resume: if `True`, resume from the checkpoint of a previous
+            run with the same `model_id`, if it exists. The completed
+            fitting stages are skipped and fitting restarts from the last
+            best fit. The events are appended to the existing event log.
+        :type resume: `bool`
         :return:
         :rtype:
         """
         pool = choose_pool(mpi=mpi)
 
-        if log and pool.is_master():
-            log_file = open(self.file_system.get_log_file_path(lens_name,
-                                                               model_id), 'wt')
-            sys.stdout = log_file
+        event_log = EventLog(
+            self.file_system.get_event_log_file_path(lens_name, model_id)
+            if log and pool.is_master() else None,
+            lens_name, model_id, append=resume)
+
+        # the progress printed by `lenstronomy`, which does not follow the
+        # `verbose` setting, is discarded when the events are logged
+        with event_log, open(os.devnull, 'w') as devnull, \
+                redirect_stdout(devnull if log else sys.stdout):
+            try:
+                self._swim(lens_name, model_id, pool, event_log, mpi=mpi,
+                           recipe_name=recipe_name, sampler=sampler,
+                           thread_count=thread_count, resume=resume,
+                           verbose=not log)
+            except Exception as e:
+                event_log.write('error', exception=type(e).__name__,
+                                message=str(e),
+                                traceback=traceback.format_exc())
+                raise
+
+    def _swim(self, lens_name, model_id, pool, event_log, mpi=False,
+              recipe_name='default', sampler='EMCEE', thread_count=1,
+              resume=False, verbose=True):
+        """
+        Run models for a single lens, see `swim()`. The events written into
+        the event log are 'psf_truncation', 'swim_start' with the number of
+        completed and total entries of the fitting kwargs list,
+        'stage_start' and 'stage_end' for each entry, and 'swim_end'. The
+        'stage_end' event has the metrics of the entry, the best-fit log
+        likelihood and the number of PSO iterations or MCMC samples if the
+        entry is a fitting stage, and whether the epochs continue if the
+        entry is an 'epoch_check'. If the run fails, `swim()` writes an
+        'error' event with the traceback.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: identifier for the model run
+        :type model_id: `str`
+        :param pool: pool of the model run
+        :type pool: `schwimmbad` pool
+        :param event_log: event log of the model run
+        :type event_log: `EventLog`
+        :param mpi: MPI option
+        :type mpi: `bool`
+        :param recipe_name: recipe for pre-sampling optimization
+        :type recipe_name: `str`
+        :param sampler: 'EMCEE' or 'COSMOHAMMER'
+        :type sampler: `str`
+        :param thread_count: number of threads if `multiprocess` is used
+        :type thread_count: `int`
+        :param resume: if `True`, resume from the checkpoint, if it exists
+        :type resume: `bool`
+        :param verbose: if `True`, print the progress of the fitting
+        :type verbose: `bool`
+        :return:
+        :rtype:
+        """
+        time_start = time.time()
 
         config = self.get_lens_config(lens_name)
         recipe = Recipe(config, sampler=sampler, thread_count=thread_count)
@@ -68,7 +160,28 @@ class Processor(object):
         psf_supersampling_factor = config.get_psf_supersampled_factor()
         kwargs_data_joint = self.get_kwargs_data_joint(
             lens_name,
-            psf_supersampled_factor=psf_supersampling_factor)
+            psf_supersampled_factor=psf_supersampling_factor,
+            config=config)
+
+        psf_truncation = self.get_psf_truncation(lens_name,
+                                                 kwargs_data_joint,
+                                                 config=config)
+        if psf_truncation is not None:
+            event_log.write('psf_truncation', **psf_truncation)
+
+        checkpoint = None
+        if resume:
+            checkpoint = self.file_system.load_checkpoint(lens_name, model_id)
+        elif pool.is_master():
+            # the checkpoint of a previous run is not carried over to the
+            # checkpoints of this run
+            self.file_system.remove_checkpoint(lens_name, model_id)
+
+        if checkpoint is not None:
+            # restore the PSFs, which may have been updated by PSF iteration
+            for band, kwargs_psf in zip(kwargs_data_joint['multi_band_list'],
+                                        checkpoint['kwargs_psf_list']):
+                band[1] = kwargs_psf
 
         fitting_sequence = FittingSequence(
             kwargs_data_joint,
@@ -76,26 +189,541 @@ class Processor(object):
             config.get_kwargs_constraints(),
             config.get_kwargs_likelihood(),
             config.get_kwargs_params(),
-            mpi=mpi
+            mpi=mpi,
+            verbose=verbose,
+            samples_file=self.file_system.get_samples_file_path(lens_name,
+                                                                model_id)
         )
 
+        arc_masks = None
+        if (recipe_name == 'galaxy-galaxy' and recipe.do_pso) \
+                or config.use_arc_masks_for_supersampling():
+            # the worker ranks of the MPI pool are already waiting for tasks
+            # at this point, so only the master computes or loads these
+            arc_masks = self.get_arc_masks(lens_name, kwargs_data_joint,
+                                           config=config, recipe=recipe)
+
+        # supersample only around the deflector and the arcs, if set
+        supersampled_indexes = config.get_supersampled_indexes(
+            [band[0] for band in kwargs_data_joint['multi_band_list']],
+            arc_masks=arc_masks)
+        if supersampled_indexes is not None:
+            fitting_sequence.update_settings(kwargs_numerics=[
+                {'compute_mode': 'adaptive',
+                 'supersampled_indexes': indexes}
+                for indexes in supersampled_indexes])
+
         fitting_kwargs_list = recipe.get_recipe(
                                     kwargs_data_joint=kwargs_data_joint,
-                                    recipe_name=recipe_name)
-        fit_output = fitting_sequence.fit_sequence(fitting_kwargs_list)
+                                    recipe_name=recipe_name,
+                                    arc_masks=arc_masks)
+
+        fit_output = []
+        num_completed = 0
+        # best-fit log likelihoods before the first and after each epoch,
+        # for the 'epoch_check' entries of the adaptive epochs
+        epoch_log_likelihoods = []
+        stage_metrics = []
+
+        if checkpoint is not None:
+            fit_output = checkpoint['fit_output']
+            num_completed = checkpoint['num_completed']
+            epoch_log_likelihoods = checkpoint['epoch_log_likelihoods']
+            stage_metrics = checkpoint.get('stage_metrics', [])
+
+            num_checks = 0
+            i = 0
+            while i < num_completed:
+                fitting_kwargs = fitting_kwargs_list[i]
+                if fitting_kwargs[0] == 'epoch_check':
+                    # repeat the decisions made at the completed checks
+                    num_checks += 1
+                    if Recipe.continue_epochs(
+                            epoch_log_likelihoods[:num_checks + 1],
+                            **self._get_epoch_check_settings(
+                                fitting_kwargs)):
+                        Recipe.insert_epoch(fitting_kwargs_list, i)
+                elif fitting_kwargs[0] in self._replay_fitting_types:
+                    # the parameters fixed without values are fixed at the
+                    # current state
+                    fitting_sequence.update_state(
+                        checkpoint['kwargs_result'])
+                    fitting_sequence.fit_sequence([fitting_kwargs])
+                i += 1
+
+            if checkpoint.get('fitting_state') is not None:
+                # restore the fixed values and limits from the fitting
+                # results, and the alignments of the images
+                fitting_sequence.set_state(checkpoint['fitting_state'])
+            else:
+                fitting_sequence.update_state(checkpoint['kwargs_result'])
+        else:
+            epoch_checks = [fitting_kwargs for fitting_kwargs
+                            in fitting_kwargs_list
+                            if fitting_kwargs[0] == 'epoch_check']
+            if epoch_checks:
+                epoch_log_likelihoods.append(
+                    self._get_epoch_log_likelihood(fitting_sequence,
+                                                   epoch_checks[0]))
+
+        event_log.write('swim_start', recipe_name=recipe_name,
+                        sampler=sampler, mpi=mpi, resume=resume,
+                        num_completed=num_completed,
+                        num_stages=len(fitting_kwargs_list))
+
+        # the list can grow while running, when an epoch is added
+        i = num_completed
+        while i < len(fitting_kwargs_list):
+            fitting_type = fitting_kwargs_list[i][0]
+            event_log.write('stage_start', index=i,
+                            fitting_type=fitting_type)
+
+            usage_start = self._poll_usage(pool, mpi)
+            stage_time_start = time.time()
+
+            stage_output = []
+            if fitting_type == 'epoch_check':
+                epoch_log_likelihoods.append(
+                    self._get_epoch_log_likelihood(fitting_sequence,
+                                                   fitting_kwargs_list[i]))
+                continue_epochs = Recipe.continue_epochs(
+                    epoch_log_likelihoods,
+                    **self._get_epoch_check_settings(
+                        fitting_kwargs_list[i]))
+                if continue_epochs:
+                    Recipe.insert_epoch(fitting_kwargs_list, i)
+            else:
+                stage_output = fitting_sequence.fit_sequence(
+                    [fitting_kwargs_list[i]])
+                fit_output += stage_output
+
+            stage_metrics.append(self.get_stage_metrics(
+                fitting_type, time.time() - stage_time_start,
+                usage_start, self._poll_usage(pool, mpi)))
+
+            summary = {}
+            if fitting_type == 'epoch_check':
+                summary['best_log_likelihood'] = epoch_log_likelihoods[-1]
+                summary['continue_epochs'] = continue_epochs
+            elif stage_output:
+                summary['best_log_likelihood'] = \
+                    fitting_sequence.best_fit_likelihood
+                for single_output in stage_output:
+                    if single_output[0] == 'PSO':
+                        summary['num_iterations'] = len(single_output[1][0])
+                    else:
+                        summary['num_samples'] = len(single_output[1])
+            event_log.write('stage_end', index=i,
+                            num_stages=len(fitting_kwargs_list),
+                            metrics=stage_metrics[-1], **summary)
+
+            if pool.is_master():
+                self.file_system.save_checkpoint(lens_name, model_id, {
+                    'settings': config.settings,
+                    'kwargs_result': fitting_sequence.best_fit(
+                        bijective=True),
+                    'fit_output': fit_output,
+                    'num_completed': i + 1,
+                    'kwargs_psf_list': [band[1] for band in
+                                        fitting_sequence.multi_band_list],
+                    'epoch_log_likelihoods': epoch_log_likelihoods,
+                    'stage_metrics': stage_metrics,
+                    'fitting_state': fitting_sequence.get_state(),
+                })
+
+            i += 1
+
         kwargs_result = fitting_sequence.best_fit(bijective=False)
 
         output = {
             'settings': config.settings,
             'kwargs_result': kwargs_result,
             'fit_output': fit_output,
+            'masks': config.get_masks(),
+            'stage_metrics': stage_metrics,
         }
+        if psf_truncation is not None:
+            output['psf_truncation'] = psf_truncation
 
         if pool.is_master():
             self.file_system.save_output(lens_name, model_id, output)
+            self.file_system.remove_checkpoint(lens_name, model_id)
+            self.file_system.remove_samples_h5(
+                self.file_system.get_samples_file_path(lens_name, model_id))
+
+        event_log.write('swim_end', wall_time=time.time() - time_start,
+                        best_log_likelihood=fitting_sequence
+                        .best_fit_likelihood)
+
+    # maximum number of `pool.map` calls to poll the resource usage of the
+    # MPI worker ranks
+    _usage_poll_rounds = 3
+
+    @classmethod
+    def _poll_usage(cls, pool, mpi):
+        """
+        Get the resource usage of the master process and, with MPI, of each
+        worker rank. `MPIPool.map` does not guarantee which worker runs each
+        call, so a worker may be polled more than once and another one not
+        at all. The first usage of each rank is kept, and the ranks that
+        are still missing are polled again, up to `_usage_poll_rounds`
+        times. The ranks that could not be polled have `None` values.
+
+        :param pool: pool of the model run
+        :type pool: `schwimmbad` pool
+        :param mpi: MPI option
+        :type mpi: `bool`
+        :return: resource usage for each rank, see `_get_process_usage()`
+        :rtype: `dict`
+        """
+        usages = {0: _get_process_usage()}
+
+        if mpi:
+            worker_ranks = range(1, pool.size + 1)
+            for _ in range(cls._usage_poll_rounds):
+                num_missing = len([rank for rank in worker_ranks
+                                   if rank not in usages])
+                if num_missing == 0:
+                    break
+
+                for usage in pool.map(_get_process_usage,
+                                      [True] * num_missing):
+                    usages.setdefault(usage['rank'], usage)
+
+            for rank in worker_ranks:
+                usages.setdefault(rank, None)
+
+        return usages
+
+    @staticmethod
+    def get_stage_metrics(fitting_type, wall_time, usage_start, usage_end):
+        """
+        Get the metrics of an entry of the fitting kwargs list from the
+        resource usages polled before and after running it.
+
+        :param fitting_type: fitting type of the entry
+        :type fitting_type: `str`
+        :param wall_time: wall time in seconds
+        :type wall_time: `float`
+        :param usage_start: resource usage of each rank before the entry
+        :type usage_start: `dict`
+        :param usage_end: resource usage of each rank after the entry
+        :type usage_end: `dict`
+        :return: dictionary with 'fitting_type', 'wall_time',
+            'evaluations_per_second', the lists over the ranks in 'rank'
+            of 'cpu_time' in seconds, 'likelihood_evaluations', and
+            'peak_rss' in bytes, which is the peak since the start of the
+            process, and 'missing_ranks' that were not polled before or
+            after the entry. With `thread_count` > 1 in `swim`, the
+            likelihood evaluations and the CPU time of the child processes
+            of the multiprocessing pool are not included, so the counts and
+            'evaluations_per_second' are lower than the actual ones by up to
+            a factor of the thread count. The MPI ranks are counted.
+        :rtype: `dict`
+        """
+        all_ranks = sorted(set(usage_start) | set(usage_end))
+        ranks = [r for r in all_ranks if usage_start.get(r) is not None
+                 and usage_end.get(r) is not None]
+
+        metrics = {
+            'fitting_type': str(fitting_type),
+            'wall_time': float(wall_time),
+            'rank': ranks,
+            'missing_ranks': [r for r in all_ranks if r not in ranks],
+            'cpu_time': [usage_end[r]['cpu_time']
+                         - usage_start[r]['cpu_time'] for r in ranks],
+            'likelihood_evaluations': [
+                usage_end[r]['likelihood_evaluations']
+                - usage_start[r]['likelihood_evaluations'] for r in ranks],
+            'peak_rss': [usage_end[r]['peak_rss'] for r in ranks],
+        }
+        metrics['evaluations_per_second'] = sum(
+            metrics['likelihood_evaluations']) / wall_time \
+            if wall_time > 0 else 0.
+
+        return metrics
+
+    @staticmethod
+    def _get_epoch_check_settings(epoch_check):
+        """
+        Get the keyword arguments for `Recipe.continue_epochs` from an
+        'epoch_check' entry of the fitting kwargs list.
+
+        :param epoch_check: 'epoch_check' entry
+        :type epoch_check: `list`
+        :return: keyword arguments
+        :rtype: `dict`
+        """
+        return {key: epoch_check[1][key] for key in
+                ['min_log_likelihood_gain', 'min_epochs', 'max_epochs']}
 
-        if log and pool.is_master():
-            log_file.close()
+    @staticmethod
+    def _get_epoch_log_likelihood(fitting_sequence, epoch_check):
+        """
+        Get the best-fit log likelihood at an 'epoch_check' entry of the
+        fitting kwargs list. The likelihood is evaluated with the
+        configured `kwargs_numerics` in the entry, if any, instead of the
+        numerics of the current epoch of a numerics schedule, so that the
+        gain between two checks is not from a change of the numerics.
+
+        :param fitting_sequence: fitting sequence
+        :type fitting_sequence: `FittingSequence`
+        :param epoch_check: 'epoch_check' entry
+        :type epoch_check: `list`
+        :return: log likelihood
+        :rtype: `float`
+        """
+        return fitting_sequence.get_best_fit_likelihood(
+            kwargs_numerics=epoch_check[1].get('kwargs_numerics'))
+
+    def swim_all(self, model_id, workers=1, log=True,
+                 recipe_name='default', sampler='EMCEE', resume=False):
+        """
+        Run models for all the lenses in the lens list on a local process
+        pool. The lenses are scheduled longest-job-first, using the estimate
+        from `get_job_cost()`, so that the pool stays saturated until the
+        end of the sample.
+
+        :param model_id: identifier for the model run
+        :type model_id: `str`
+        :param workers: number of worker processes, each models one lens at
+            a time
+        :type workers: `int`
+        :param log: if `True`, the events of each run are written into its
+            event log file
+        :type log: `bool`
+        :param recipe_name: recipe for pre-sampling optimization, supported
+            ones now: 'default' and 'galaxy-galaxy'
+        :type recipe_name: `str`
+        :param sampler: 'EMCEE' or 'COSMOHAMMER', cosmohammer is kept for
+            legacy
+        :type sampler: `str`
+        :param resume: if `True`, resume each lens from its checkpoint, if it
+            exists
+        :type resume: `bool`
+        :return: dictionary with the lens names as keys, values are `None`
+            for successful runs or the traceback of the failed runs
+        :rtype: `dict`
+        """
+        kwargs_swim = {
+            'log': log,
+            'recipe_name': recipe_name,
+            'sampler': sampler,
+            'resume': resume,
+        }
+
+        lens_list = sorted(self.lens_list, key=self.get_job_cost,
+                           reverse=True)
+        tasks = [(self.io_directory, lens_name, model_id, kwargs_swim)
+                 for lens_name in lens_list]
+
+        pool = choose_pool(mpi=False, processes=workers)
+
+        if isinstance(pool, MultiPool):
+            # dispatch one lens at a time to keep the longest-first order
+            results = pool.map(_swim_lens, tasks, chunksize=1)
+        else:
+            results = pool.map(_swim_lens, tasks)
+
+        pool.close()
+
+        return dict(results)
+
+    def get_job_cost(self, lens_name):
+        """
+        Estimate the relative computational cost to model a lens. The cost
+        is the total number of image pixels summed over all the bands. If the
+        image file cannot be read, the mask size from the config is used.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :return: estimated cost
+        :rtype: `int`
+        """
+        config = self.get_lens_config(lens_name)
+
+        cost = 0
+        for n, band in enumerate(config.settings['band']):
+            try:
+                with h5py.File(self.file_system.get_image_file_path(
+                        lens_name, band), 'r') as f:
+                    shape = f['image_data'].shape
+            except (OSError, KeyError):
+                try:
+                    shape = (config.settings['mask']['size'][n],) * 2
+                except (KeyError, TypeError, IndexError):
+                    shape = (0, 0)
+
+            cost += int(shape[0]) * int(shape[1])
+
+        return cost
+
+    def tune_numerics(self, lens_name, supersampling_factors=(1, 2, 3, 4, 6),
+                      supersampling_convolutions=(False, True),
+                      reference_supersampling_factor=8, tolerance=1.,
+                      num_repeats=5, save_config=True):
+        """
+        Benchmark `kwargs_numerics` options for a lens, and suggest the
+        fastest option within the tolerance for each band. The model images
+        with the linear amplitudes solved are computed at the initial values
+        of `kwargs_params`, for a grid of supersampling factors and
+        supersampled convolution options. Each option is compared with a
+        reference image computed with `reference_supersampling_factor`, and
+        with supersampled convolution over the full PSF kernel if the PSF is
+        supersampled. The supersampled convolution options are only
+        benchmarked for supersampled PSFs. If no option is within the
+        tolerance, the most accurate option is suggested.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param supersampling_factors: supersampling factors to benchmark
+        :type supersampling_factors: `list`
+        :param supersampling_convolutions: supersampled convolution options
+            to benchmark
+        :type supersampling_convolutions: `list`
+        :param reference_supersampling_factor: supersampling factor of the
+            reference image
+        :type reference_supersampling_factor: `int`
+        :param tolerance: largest chi^2 of the difference from the
+            reference image within the likelihood mask
+        :type tolerance: `float`
+        :param num_repeats: number of timed model evaluations, the fastest
+            one is used
+        :type num_repeats: `int`
+        :param save_config: if `True`, the config with the suggested
+            `kwargs_numerics` is saved as
+            `settings/<lens_name>_config_suggested.yml`
+        :type save_config: `bool`
+        :return: suggested `kwargs_numerics` settings, and the benchmarks of
+            each band with 'supersampling_factor',
+            'supersampling_convolution', 'time', and 'delta_chi2' of the
+            options
+        :rtype: `dict`, `list`
+        """
+        config = self.get_lens_config(lens_name)
+        kwargs_data_joint = self.get_kwargs_data_joint(
+            lens_name,
+            psf_supersampled_factor=config.get_psf_supersampled_factor(),
+            config=config)
+        multi_band_list = kwargs_data_joint['multi_band_list']
+        kwargs_model = config.get_kwargs_model()
+        masks = config.get_masks()
+
+        fitting_sequence = FittingSequence(
+            kwargs_data_joint, kwargs_model,
+            config.get_kwargs_constraints(),
+            config.get_kwargs_likelihood(),
+            config.get_kwargs_params(),
+            verbose=False)
+        kwargs_init = fitting_sequence.best_fit(bijective=False)
+
+        suggestion = {'supersampling_factor': [],
+                      'supersampling_convolution': []}
+        benchmarks = []
+
+        for n, band in enumerate(multi_band_list):
+            # supersampled convolution only adds accuracy with a
+            # supersampled PSF kernel, instead of an interpolated one
+            psf_supersampled = band[1].get(
+                'point_source_supersampling_factor', 1) > 1
+
+            reference_image, variance, _ = self._time_model_image(
+                multi_band_list, kwargs_model, kwargs_init, masks, n, {
+                    'supersampling_factor': reference_supersampling_factor,
+                    'supersampling_convolution': psf_supersampled,
+                    'supersampling_kernel_size': np.shape(
+                        band[1]['kernel_point_source'])[0]
+                }, 1)
+
+            if masks is None or masks[n] is None:
+                mask = np.ones_like(reference_image)
+            else:
+                mask = np.reshape(masks[n], np.shape(reference_image))
+
+            band_benchmarks = []
+            for factor in supersampling_factors:
+                for convolution in supersampling_convolutions:
+                    if convolution and (int(factor) == 1
+                                        or not psf_supersampled):
+                        continue
+
+                    image, _, run_time = self._time_model_image(
+                        multi_band_list, kwargs_model, kwargs_init, masks, n,
+                        {'supersampling_factor': int(factor),
+                         'supersampling_convolution': bool(convolution)},
+                        num_repeats)
+
+                    band_benchmarks.append({
+                        'supersampling_factor': int(factor),
+                        'supersampling_convolution': bool(convolution),
+                        'time': run_time,
+                        'delta_chi2': float(np.sum(
+                            mask * (image - reference_image)**2 / variance))
+                    })
+
+            within_tolerance = [benchmark for benchmark in band_benchmarks
+                                if benchmark['delta_chi2'] <= tolerance]
+            if within_tolerance:
+                best = min(within_tolerance,
+                           key=lambda benchmark: benchmark['time'])
+            else:
+                best = min(band_benchmarks,
+                           key=lambda benchmark: benchmark['delta_chi2'])
+
+            for key in suggestion:
+                suggestion[key].append(best[key])
+            benchmarks.append(band_benchmarks)
+
+        if save_config:
+            settings = deepcopy(config.settings)
+            if settings.get('kwargs_numerics') is None:
+                settings['kwargs_numerics'] = {}
+            settings['kwargs_numerics'].update(suggestion)
+            self.file_system.save_suggested_config(lens_name, settings)
+
+        return suggestion, benchmarks
+
+    @staticmethod
+    def _time_model_image(multi_band_list, kwargs_model, kwargs_result,
+                          masks, band_index, kwargs_numerics, num_repeats):
+        """
+        Compute the model image of a band with the linear amplitudes
+        solved, and time the computation.
+
+        :param multi_band_list: `multi_band_list` of `kwargs_data_joint`
+        :type multi_band_list: `list`
+        :param kwargs_model: `kwargs_model` dictionary
+        :type kwargs_model: `dict`
+        :param kwargs_result: model parameters
+        :type kwargs_result: `dict`
+        :param masks: likelihood masks
+        :type masks: `list`
+        :param band_index: index of the band
+        :type band_index: `int`
+        :param kwargs_numerics: updates of the band's `kwargs_numerics`
+        :type kwargs_numerics: `dict`
+        :param num_repeats: number of timed evaluations
+        :type num_repeats: `int`
+        :return: model image, variance of the data, and the fastest
+            evaluation time in seconds
+        :rtype: `ndarray`, `ndarray`, `float`
+        """
+        bands = list(multi_band_list)
+        band = bands[band_index]
+        bands[band_index] = [band[0], band[1],
+                             dict(band[2], **kwargs_numerics)]
+
+        im_sim = SingleBandMultiModel(bands, kwargs_model,
+                                      likelihood_mask_list=masks,
+                                      band_index=band_index)
+
+        run_times = []
+        for _ in range(num_repeats):
+            start = time.perf_counter()
+            image = im_sim.image_linear_solve(**kwargs_result)[0]
+            run_times.append(time.perf_counter() - start)
+
+        return image, im_sim.Data.C_D, min(run_times)
 
     def get_lens_config(self, lens_name):
         """
@@ -106,40 +734,70 @@ class Processor(object):
         :return: `ModelConfig` instance
         :rtype:
         """
-        return ModelConfig(self.file_system.get_config_file_path(lens_name))
+        return ModelConfig(
+            self.file_system.get_config_file_path(lens_name),
+            data_directory=self.file_system.get_lens_data_directory(
+                lens_name))
 
-    def get_kwargs_data_joint(self, lens_name, psf_supersampled_factor=1):
+    def get_kwargs_data_joint(self, lens_name, psf_supersampled_factor=1,
+                              config=None):
         """
-        Create `kwargs_data` for a lens and given filters.
+        Create `kwargs_data` for a lens and given filters. The PSF kernels
+        are truncated if `psf_truncation` is set in the settings. If
+        `crop_to_mask` is set in the mask settings, the images are cropped
+        to the unmasked region plus the half-width of the PSF kernel, and
+        the crop is set in `config` to crop the masks the same way.
 
         :param lens_name: lens name
         :type lens_name: `str`
         :param psf_supersampled_factor: Supersampled factor of given PSF.
         :rtype psf_supersampled_factor: `float`
+        :param config: `ModelConfig` instance for the lens, loaded from the
+            config file if not provided
+        :type config: `ModelConfig`
         :return:
         :rtype:
         """
-        config = self.get_lens_config(lens_name)
+        if config is None:
+            config = self.get_lens_config(lens_name)
 
         bands = config.settings['band']
 
         kwargs_numerics = config.get_kwargs_numerics()
+        encircled_energy = config.get_psf_encircled_energy()
+        if encircled_energy is None:
+            encircled_energy = [None] * len(bands)
 
         multi_band_list = []
 
-        for b, kwargs_num in zip(bands, kwargs_numerics):
+        for b, kwargs_num, energy in zip(bands, kwargs_numerics,
+                                         encircled_energy):
             image_data = self.get_image_data(lens_name, b)
             psf_data = self.get_psf_data(lens_name, b)
 
-            psf_data.kwargs_psf['point_source_supersampling_factor'] = \
+            kwargs_psf = psf_data.kwargs_psf
+            kwargs_psf['point_source_supersampling_factor'] = \
                 psf_supersampled_factor
+            if energy is not None:
+                kwargs_psf = PSFData.truncate_kwargs_psf(kwargs_psf, energy)
 
             multi_band_list.append([
                 image_data.kwargs_data,
-                psf_data.kwargs_psf,
+                kwargs_psf,
                 kwargs_num
             ])
 
+        if config.crop_to_mask:
+            # crop to the fitted region, with a margin to convolve the
+            # light from just outside the mask into it
+            crop_boxes = config.get_crop_boxes(
+                [PSFData.get_kernel_radius(band[1])
+                 for band in multi_band_list])
+            config.set_crop_boxes(crop_boxes)
+
+            for band, crop_box in zip(multi_band_list, crop_boxes):
+                band[0] = ImageData.crop_kwargs_data(band[0], crop_box)
+
         kwargs_data_joint = {
             'multi_band_list': multi_band_list,
             'multi_band_type': 'multi-linear'
@@ -147,6 +805,97 @@ class Processor(object):
 
         return kwargs_data_joint
 
+    def get_psf_truncation(self, lens_name, kwargs_data_joint, config=None):
+        """
+        Get the record of the PSF kernel truncation of a lens, with the
+        encircled energy fraction, and the stored and truncated kernel
+        sizes for each band.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param kwargs_data_joint: `kwargs_data_joint` dictionary with the
+            truncated PSFs
+        :type kwargs_data_joint: `dict`
+        :param config: `ModelConfig` instance for the lens, loaded from the
+            config file if not provided
+        :type config: `ModelConfig`
+        :return: truncation record, `None` if the PSF kernels are not
+            truncated
+        :rtype: `dict`
+        """
+        if config is None:
+            config = self.get_lens_config(lens_name)
+
+        encircled_energy = config.get_psf_encircled_energy()
+        if encircled_energy is None:
+            return None
+
+        return {
+            'band': list(config.settings['band']),
+            'encircled_energy': list(encircled_energy),
+            'stored_kernel_size': [
+                int(np.shape(self.get_psf_data(lens_name, b).kwargs_psf[
+                    'kernel_point_source'])[0])
+                for b in config.settings['band']],
+            'kernel_size': [
+                int(np.shape(band[1]['kernel_point_source'])[0])
+                for band in kwargs_data_joint['multi_band_list']],
+        }
+
+    def get_arc_masks(self, lens_name, kwargs_data_joint, config=None,
+                      recipe=None):
+        """
+        Get the arc masks of a lens for the 'galaxy-galaxy' recipe. The arc
+        masks are saved in the data directory of the lens with the hash of
+        the image, mask, and parameters they were computed from. Only the
+        arc masks that are missing or out of date are computed.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param kwargs_data_joint: `kwargs_data_joint` dictionary
+        :type kwargs_data_joint: `dict`
+        :param config: `ModelConfig` instance for the lens, loaded from the
+            config file if not provided
+        :type config: `ModelConfig`
+        :param recipe: `Recipe` instance to compute the arc masks with
+        :type recipe: `Recipe`
+        :return: arc masks for all the bands
+        :rtype: `list` of `ndarray`
+        """
+        if config is None:
+            config = self.get_lens_config(lens_name)
+        if recipe is None:
+            recipe = Recipe(config)
+
+        bands = config.settings['band']
+        images = [band_item[0]['image_data'] for band_item
+                  in kwargs_data_joint['multi_band_list']]
+        masks = config.get_masks()
+        if masks is None:
+            masks = [None] * len(images)
+
+        hashes = [recipe.get_arc_mask_hash(image, mask=mask)
+                  for image, mask in zip(images, masks)]
+
+        saved_arc_masks = self.file_system.load_arc_masks(lens_name)
+
+        missing = [i for i, band in enumerate(bands)
+                   if band not in saved_arc_masks
+                   or saved_arc_masks[band][0] != hashes[i]]
+
+        if missing:
+            computed_arc_masks = recipe.get_arc_masks(
+                [images[i] for i in missing],
+                masks=None if masks[missing[0]] is None
+                else [masks[i] for i in missing])
+
+            for i, arc_mask in zip(missing, computed_arc_masks):
+                saved_arc_masks[bands[i]] = (hashes[i], arc_mask)
+
+            self.file_system.save_arc_masks(lens_name, saved_arc_masks)
+
+        return [saved_arc_masks[band][1] for band in bands]
+
     def get_image_data(self, lens_name, band):
         """
         Get the `ImageData` instance.
@@ -158,7 +907,9 @@ class Processor(object):
         :return: `ImageData` instance
         :rtype:
         """
-        return ImageData(self.file_system.get_image_file_path(lens_name, band))
+        return self._get_cached_data(
+            ImageData, self.file_system.get_image_file_path(lens_name, band),
+            ('image', lens_name, band))
 
     def get_psf_data(self, lens_name, band):
         """
@@ -171,4 +922,82 @@ class Processor(object):
         :return: `PSFData` instance
         :rtype:
         """
-        return PSFData(self.file_system.get_psf_file_path(lens_name, band))
+        return self._get_cached_data(
+            PSFData, self.file_system.get_psf_file_path(lens_name, band),
+            ('psf', lens_name, band))
+
+    def _get_cached_data(self, data_class, file_path, key):
+        """
+        Get a data instance from the data cache, or load it from the file
+        if it is not cached or the file changed since it was cached.
+
+        :param data_class: `ImageData` or `PSFData`
+        :type data_class: `class`
+        :param file_path: path to the data file
+        :type file_path: `str`
+        :param key: (kind, lens name, band) to identify the data
+        :type key: `tuple`
+        :return: data instance
+        :rtype: `ImageData` or `PSFData`
+        """
+        key = key + (os.path.getmtime(file_path),)
+
+        data = self.data_cache.get(key)
+        if data is None:
+            data = data_class(file_path)
+            self.data_cache.add(key, data)
+
+        return data
+
+
+def _get_process_usage(mpi=False):
+    """
+    Get the resource usage of the current process. With MPI, the call
+    waits briefly before returning, which makes it likely that the MPI pool
+    dispatches the other calls to the other idle workers, see
+    `Processor._poll_usage()`.
+
+    :param mpi: if `True`, get the rank from MPI
+    :type mpi: `bool`
+    :return: dictionary with 'rank', 'cpu_time' in seconds, the number of
+        'likelihood_evaluations', and 'peak_rss' in bytes
+    :rtype: `dict`
+    """
+    rank = 0
+    if mpi:
+        from mpi4py import MPI
+        rank = MPI.COMM_WORLD.Get_rank()
+        time.sleep(0.05)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # `ru_maxrss` is in bytes on macOS, and in kilobytes on Linux
+    peak_rss = usage.ru_maxrss if sys.platform == 'darwin' \
+        else usage.ru_maxrss * 1024
+
+    return {
+        'rank': rank,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'likelihood_evaluations': LikelihoodCounter.num_evaluations,
+        'peak_rss': int(peak_rss),
+    }
+
+
+def _swim_lens(task):
+    """
+    Run `Processor.swim` for a single lens. This function is mapped over
+    the worker processes by `Processor.swim_all`.
+
+    :param task: tuple of io_directory, lens name, model_id, and the keyword
+        arguments for `Processor.swim`
+    :type task: `tuple`
+    :return: lens name, `None` or traceback if the run failed
+    :rtype: `tuple`
+    """
+    io_directory, lens_name, model_id, kwargs_swim = task
+
+    try:
+        Processor(io_directory).swim(lens_name, model_id, **kwargs_swim)
+    except Exception:
+        return lens_name, traceback.format_exc()
+
+    return lens_name, None
@@ -4,8 +4,12 @@ This module loads data and psfs from data files.
 """
 __author__ = 'ajshajib'
 
+from collections import OrderedDict
 import h5py
+import numpy as np
 from copy import deepcopy
+from lenstronomy.Util import kernel_util
+from lenstronomy.Util import image_util
 
 
 class Data(object):
@@ -35,11 +39,65 @@ class Data(object):
 
         return data
 
+    @staticmethod
+    def set_read_only(data):
+        """
+        Make the arrays in a data dictionary read-only, so that they can be
+        shared without copying.
+
+        :param data: dictionary of arrays
+        :type data: `dict`
+        :return: the same dictionary
+        :rtype: `dict`
+        """
+        for value in data.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+
+        return data
+
+    @staticmethod
+    def bin_array(array, binning, function=np.sum):
+        """
+        Bin a 2D array by combining `binning` x `binning` blocks of pixels.
+        The rows and columns at the end that do not fill a whole block are
+        cropped.
+
+        :param array: 2D array
+        :type array: `ndarray`
+        :param binning: number of pixels to combine along each axis
+        :type binning: `int`
+        :param function: function to combine the pixels in a block with,
+            that accepts the `axis` keyword argument
+        :type function: `function`
+        :return: binned array
+        :rtype: `ndarray`
+        """
+        array = np.asarray(array)
+        ny, nx = array.shape[0] // binning, array.shape[1] // binning
+
+        return function(array[:ny * binning, :nx * binning].reshape(
+            ny, binning, nx, binning), axis=(1, 3))
+
+    @property
+    def nbytes(self):
+        """
+        Get the memory size of the loaded arrays.
+
+        :return: number of bytes
+        :rtype: `int`
+        """
+        return int(sum([np.asarray(value).nbytes
+                        for value in self._data.values()]))
+
 
 class ImageData(Data):
     """
     This class contains the image of a lens system.
     """
+    # arrays that `lenstronomy` modifies in place, these are always copied
+    _writable_keys = ['exposure_time']
+
     def __init__(self, data_file_path):
         """
 
@@ -48,28 +106,129 @@ class ImageData(Data):
         """
         super(ImageData, self).__init__()
 
-        self._data = self.load_from_file(data_file_path)
+        self._data = self.set_read_only(self.load_from_file(data_file_path))
 
     @property
     def kwargs_data(self):
+        """
+        Get `kwargs_data` dictionary with read-only views of the arrays,
+        except the ones in `_writable_keys`.
+
+        :return: `kwargs_data`
+        :rtype: `dict`
+        """
+        return self.get_kwargs_data()
+
+    def get_kwargs_data(self, copy=False):
         """
         Get `kwargs_data` dictionary.
 
+        :param copy: if True, return writable copies of the arrays instead
+            of read-only views. The arrays in `_writable_keys`, which
+            `lenstronomy` modifies in place, are always copied.
+        :type copy: `bool`
         :return: `kwargs_data`
         :rtype: `dict`
         """
-        kwargs_data = deepcopy(self._data)
+        if copy:
+            return deepcopy(self._data)
+
+        kwargs_data = dict(self._data)
+        for key in self._writable_keys:
+            if isinstance(kwargs_data.get(key), np.ndarray):
+                kwargs_data[key] = np.copy(kwargs_data[key])
 
         return kwargs_data
 
-    def get_image(self):
+    @classmethod
+    def bin_kwargs_data(cls, kwargs_data, binning):
+        """
+        Bin the image in `kwargs_data`. The counts are summed, so the noise
+        of the binned pixels is propagated by scaling the background RMS and
+        keeping the exposure time. The coordinate system is kept, with the
+        pixel size scaled.
+
+        :param kwargs_data: `kwargs_data` dictionary
+        :type kwargs_data: `dict`
+        :param binning: number of pixels to combine along each axis
+        :type binning: `int`
+        :return: binned `kwargs_data`
+        :rtype: `dict`
+        """
+        kwargs_binned = dict(kwargs_data)
+
+        kwargs_binned['image_data'] = cls.bin_array(kwargs_data['image_data'],
+                                                    binning)
+        kwargs_binned['background_rms'] = kwargs_data['background_rms'] \
+            * binning
+
+        if np.ndim(kwargs_data.get('exposure_time')) == 2:
+            kwargs_binned['exposure_time'] = cls.bin_array(
+                kwargs_data['exposure_time'], binning, np.mean)
+
+        if kwargs_data.get('noise_map') is not None:
+            kwargs_binned['noise_map'] = np.sqrt(cls.bin_array(
+                np.square(kwargs_data['noise_map']), binning))
+
+        # the center of the first binned pixel is at the center of the first
+        # `binning` x `binning` block
+        transform_pix2angle = np.array(kwargs_data['transform_pix2angle'])
+        offset = (binning - 1) / 2.
+        kwargs_binned['ra_at_xy_0'] = kwargs_data['ra_at_xy_0'] \
+            + offset * np.sum(transform_pix2angle[0])
+        kwargs_binned['dec_at_xy_0'] = kwargs_data['dec_at_xy_0'] \
+            + offset * np.sum(transform_pix2angle[1])
+        kwargs_binned['transform_pix2angle'] = transform_pix2angle * binning
+
+        return kwargs_binned
+
+    @staticmethod
+    def crop_kwargs_data(kwargs_data, crop_box):
+        """
+        Crop the image, and the noise map and exposure time map if provided,
+        in `kwargs_data`. The coordinate system is shifted to keep the
+        coordinates of the cropped pixels.
+
+        :param kwargs_data: `kwargs_data` dictionary
+        :type kwargs_data: `dict`
+        :param crop_box: [first row, last row + 1, first column, last
+            column + 1] of the cropped region
+        :type crop_box: `list`
+        :return: cropped `kwargs_data`
+        :rtype: `dict`
+        """
+        row_start, row_end, col_start, col_end = crop_box
+        kwargs_cropped = dict(kwargs_data)
+
+        for key in ['image_data', 'noise_map', 'exposure_time']:
+            if np.ndim(kwargs_data.get(key)) == 2:
+                kwargs_cropped[key] = np.asarray(kwargs_data[key])[
+                    row_start:row_end, col_start:col_end]
+
+        transform_pix2angle = np.array(kwargs_data['transform_pix2angle'])
+        kwargs_cropped['ra_at_xy_0'] = kwargs_data['ra_at_xy_0'] \
+            + transform_pix2angle[0, 0] * col_start \
+            + transform_pix2angle[0, 1] * row_start
+        kwargs_cropped['dec_at_xy_0'] = kwargs_data['dec_at_xy_0'] \
+            + transform_pix2angle[1, 0] * col_start \
+            + transform_pix2angle[1, 1] * row_start
+
+        return kwargs_cropped
+
+    def get_image(self, copy=False):
         """
         Get image `ndarray` from the saved in the class instance.
 
+        :param copy: if True, return a writable copy instead of a read-only
+            view
+        :type copy: `bool`
         :return: image
         :rtype: `ndarray`
         """
-        return deepcopy(self._data['image_data'])
+        if copy:
+            return np.copy(self._data['image_data'])
+        else:
+            return self._data['image_data']
 
 
 class PSFData(Data):
@@ -84,18 +243,226 @@ class PSFData(Data):
         """
         super(PSFData, self).__init__()
 
-        self._data = self.load_from_file(psf_file_path)
+        self._data = self.set_read_only(self.load_from_file(psf_file_path))
 
     @property
     def kwargs_psf(self):
+        """
+        Get `kwargs_psf` dictionary with read-only views of the arrays.
+
+        :return: `kwargs_psf`
+        :rtype: `dict`
+        """
+        return self.get_kwargs_psf()
+
+    def get_kwargs_psf(self, copy=False):
         """
         Get `kwargs_psf` dictionary.
 
+        :param copy: if True, return writable copies of the arrays instead
+            of read-only views
+        :type copy: `bool`
         :return: `kwargs_psf`
         :rtype: `dict`
         """
-        kwargs_psf = deepcopy(self._data)
+        if copy:
+            kwargs_psf = deepcopy(self._data)
+            kwargs_psf['kernel_point_source_init'] = np.copy(
+                kwargs_psf['kernel_point_source'])
+        else:
+            kwargs_psf = dict(self._data)
+            kwargs_psf['kernel_point_source_init'] = \
+                kwargs_psf['kernel_point_source']
+
         kwargs_psf['psf_type'] = 'PIXEL'
-        kwargs_psf['kernel_point_source_init'] = deepcopy(
-                                        kwargs_psf['kernel_point_source'])
+
         return kwargs_psf
+
+    @staticmethod
+    def bin_kwargs_psf(kwargs_psf, binning):
+        """
+        Degrade the PSF in `kwargs_psf` to the pixels of an image binned by
+        `binning`. The supersampling factor of the PSF is unchanged, as the
+        kernel is degraded by the same factor as the pixels. The PSF error
+        map is not kept.
+
+        :param kwargs_psf: `kwargs_psf` dictionary
+        :type kwargs_psf: `dict`
+        :param binning: number of pixels to combine along each axis
+        :type binning: `int`
+        :return: binned `kwargs_psf`
+        :rtype: `dict`
+        """
+        kwargs_binned = dict(kwargs_psf)
+
+        if kwargs_psf.get('psf_type') == 'PIXEL':
+            kernel = kernel_util.degrade_kernel(
+                np.array(kwargs_psf['kernel_point_source']), binning)
+            kwargs_binned['kernel_point_source'] = kernel / np.sum(kernel)
+            kwargs_binned.pop('kernel_point_source_init', None)
+            kwargs_binned.pop('psf_error_map', None)
+
+        if kwargs_psf.get('pixel_size') is not None:
+            kwargs_binned['pixel_size'] = kwargs_psf['pixel_size'] * binning
+
+        return kwargs_binned
+
+    @staticmethod
+    def truncate_kwargs_psf(kwargs_psf, encircled_energy):
+        """
+        Truncate the PSF kernel in `kwargs_psf` to the smallest centered
+        square that contains the pixels within the radius enclosing the
+        `encircled_energy` fraction of the kernel. The truncated kernel is
+        renormalized, and the PSF error map is truncated the same way.
+
+        :param kwargs_psf: `kwargs_psf` dictionary
+        :type kwargs_psf: `dict`
+        :param encircled_energy: fraction of the kernel to keep, between 0
+            and 1
+        :type encircled_energy: `float`
+        :return: truncated `kwargs_psf`
+        :rtype: `dict`
+        """
+        if not 0. < encircled_energy <= 1.:
+            raise ValueError('Encircled energy fraction {} is not '
+                             'valid!'.format(encircled_energy))
+
+        kwargs_truncated = dict(kwargs_psf)
+        if kwargs_psf.get('psf_type') != 'PIXEL' or encircled_energy == 1.:
+            return kwargs_truncated
+
+        kernel = np.array(kwargs_psf['kernel_point_source'])
+        offsets = np.arange(kernel.shape[0]) - (kernel.shape[0] - 1) / 2.
+        radius = np.hypot(offsets[:, None], offsets[None, :]).ravel()
+        order = np.argsort(radius, kind='stable')
+        energy = np.cumsum(np.abs(kernel).ravel()[order])
+        energy /= energy[-1]
+
+        index = min(np.searchsorted(energy, encircled_energy),
+                    len(order) - 1)
+        enclosed = radius <= radius[order[index]]
+
+        # half-width of the square containing the enclosed pixels
+        extent = np.max(np.maximum(np.abs(offsets)[:, None],
+                                   np.abs(offsets)[None, :]).ravel()[enclosed])
+        size = int(round(2 * extent + 1))
+
+        if size < kernel.shape[0]:
+            kwargs_truncated['kernel_point_source'] = kernel_util.cut_psf(
+                kernel, size)
+            if kwargs_psf.get('kernel_point_source_init') is not None:
+                kwargs_truncated['kernel_point_source_init'] = \
+                    kwargs_truncated['kernel_point_source']
+            if np.shape(kwargs_psf.get('psf_error_map')) == kernel.shape:
+                kwargs_truncated['psf_error_map'] = image_util.cut_edges(
+                    np.array(kwargs_psf['psf_error_map']), size)
+
+        return kwargs_truncated
+
+    @staticmethod
+    def get_kernel_radius(kwargs_psf):
+        """
+        Get the half-width of the PSF kernel in image pixels, taking into
+        account the supersampling factor of the kernel.
+
+        :param kwargs_psf: `kwargs_psf` dictionary
+        :type kwargs_psf: `dict`
+        :return: half-width of the kernel in image pixels, 0 if the PSF is
+            not given as a pixelated kernel
+        :rtype: `int`
+        """
+        if kwargs_psf.get('kernel_point_source') is None:
+            return 0
+
+        supersampling_factor = kwargs_psf.get(
+            'point_source_supersampling_factor', 1)
+        kernel_width = np.shape(kwargs_psf['kernel_point_source'])[0]
+
+        return int(np.ceil(kernel_width / supersampling_factor / 2.))
+
+
+class DataCache(object):
+    """
+    This class is a least-recently-used cache for `ImageData` and `PSFData`
+    instances. The least recently used entries are dropped when the total
+    size of the cached arrays exceeds the byte budget.
+    """
+    def __init__(self, max_bytes=512 * 1024**2):
+        """
+
+        :param max_bytes: byte budget of the cache, caching is turned off if
+            0
+        :type max_bytes: `int`
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """
+        Get the total size of the cached arrays.
+
+        :return: number of bytes
+        :rtype: `int`
+        """
+        return self._nbytes
+
+    def __len__(self):
+        """
+        Get the number of cached entries.
+
+        :return: number of entries
+        :rtype: `int`
+        """
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get a cached entry and mark it as the most recently used.
+
+        :param key: key of the entry, e.g., (kind, lens name, band, mtime)
+        :type key: `tuple`
+        :return: cached data, `None` if not cached
+        :rtype: `Data`
+        """
+        if key not in self._entries:
+            return None
+
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def add(self, key, data):
+        """
+        Add an entry to the cache. Entries larger than the byte budget are
+        not cached.
+
+        :param key: key of the entry, e.g., (kind, lens name, band, mtime)
+        :type key: `tuple`
+        :param data: data to cache
+        :type data: `Data`
+        :return: None
+        :rtype:
+        """
+        if data.nbytes > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key).nbytes
+
+        self._entries[key] = data
+        self._nbytes += data.nbytes
+
+        while self._nbytes > self.max_bytes:
+            _, dropped = self._entries.popitem(last=False)
+            self._nbytes -= dropped.nbytes
+
+    def clear(self):
+        """
+        Empty the cache.
+
+        :return: None
+        :rtype:
+        """
+        self._entries.clear()
+        self._nbytes = 0
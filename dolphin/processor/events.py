@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+This module has a class to write the events of a model run into a log file.
+"""
+__author__ = 'ajshajib'
+
+import time
+import json
+import numpy as np
+
+
+class EventLog(object):
+    """
+    This class writes the events of a model run, e.g., the start and end of
+    each fitting stage, as JSON lines into a log file. Each line has the
+    'time', 'event', 'lens_name', and 'model_id' keys, and the keys specific
+    to the event. The file is line buffered, so that each event is written
+    with a single write call and can be read while the run continues. The
+    log is turned off if no file path is provided.
+    """
+    def __init__(self, file_path, lens_name, model_id, append=False):
+        """
+
+        :param file_path: path to the log file, the log is turned off if
+            `None`
+        :type file_path: `str`
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: identifier for the model run
+        :type model_id: `str`
+        :param append: if `True`, append to an existing log file, e.g., when
+            resuming a run
+        :type append: `bool`
+        """
+        self.file_path = file_path
+        self.lens_name = lens_name
+        self.model_id = model_id
+
+        if file_path is None:
+            self._file = None
+        else:
+            self._file = open(file_path, 'at' if append else 'wt',
+                              buffering=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write(self, event, **kwargs):
+        """
+        Write an event into the log.
+
+        :param event: name of the event
+        :type event: `str`
+        :param kwargs: values specific to the event
+        :type kwargs: `dict`
+        :return: None
+        :rtype:
+        """
+        if self._file is None:
+            return
+
+        record = {
+            'time': time.time(),
+            'event': event,
+            'lens_name': self.lens_name,
+            'model_id': self.model_id,
+        }
+        record.update(kwargs)
+
+        self._file.write(json.dumps(record, default=self.encode_value,
+                                    ensure_ascii=False) + '\n')
+
+    def close(self):
+        """
+        Close the log file.
+
+        :return: None
+        :rtype:
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def encode_value(value):
+        """
+        Encode the numpy values that are not JSON serializable.
+
+        :param value: value
+        :type value:
+        :return: JSON serializable value
+        :rtype:
+        """
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        elif isinstance(value, np.generic):
+            return value.item()
+        else:
+            raise TypeError('Object of type {} is not JSON serializable!'
+                            .format(type(value).__name__))
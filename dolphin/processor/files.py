@@ -5,7 +5,10 @@ This module has a class for maintaining the file system.
 __author__ = 'ajshajib'
 
 from pathlib import Path
+from collections.abc import Mapping
+import os
 import json
+import yaml
 import numpy as np
 import h5py
 
@@ -73,6 +76,39 @@ class FileSystem(object):
         return self.path2str(self._root_path / 'settings'
                              / '{}_config.yml'.format(lens_name))
 
+    def get_suggested_config_file_path(self, lens_name):
+        """
+        Get the file path to the config file for `lens_name` with the
+        settings suggested by `Processor.tune_numerics`.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :return: path to the suggested config file
+        :rtype: `str`
+        """
+        return self.path2str(self._root_path / 'settings'
+                             / '{}_config_suggested.yml'.format(lens_name))
+
+    def save_suggested_config(self, lens_name, settings):
+        """
+        Save the settings suggested for `lens_name` into a YAML file next to
+        the config file.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param settings: settings to save
+        :type settings: `dict`
+        :return: path to the suggested config file
+        :rtype: `str`
+        """
+        file_path = self.get_suggested_config_file_path(lens_name)
+
+        with open(file_path, 'w') as f:
+            yaml.safe_dump(settings, f, default_flow_style=None,
+                           sort_keys=False)
+
+        return file_path
+
     def get_logs_directory(self):
         """
         Get directory for logs folder. If the directory doesn't exist,
@@ -137,6 +173,18 @@ class FileSystem(object):
 
         return data_dir
 
+    def get_lens_data_directory(self, lens_name):
+        """
+        Get the directory of the data files for `lens_name`.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :return: directory path
+        :rtype: `str`
+        """
+        return self.path2str(Path(self.get_data_directory())
+                             / '{}'.format(lens_name))
+
     def get_image_file_path(self, lens_name, band):
         """
         Get the file path for the imaging data for `lens_name`.
@@ -169,6 +217,20 @@ class FileSystem(object):
                              / 'psf_{}_{}.h5'.format(lens_name, band)
                              )
 
+    def get_arc_masks_file_path(self, lens_name):
+        """
+        Get the file path for the cached arc masks of `lens_name`.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :return: file path
+        :rtype: `str`
+        """
+        return self.path2str(Path(self.get_data_directory())
+                             / '{}'.format(lens_name)
+                             / 'arc_masks_{}.h5'.format(lens_name)
+                             )
+
     def get_log_file_path(self, lens_name, model_id):
         """
         Get the file path for the PSF data for `lens_name`.
@@ -183,6 +245,37 @@ class FileSystem(object):
         return self.path2str(Path(self.get_logs_directory())) \
             + '/log_{}_{}.txt'.format(lens_name, model_id)
 
+    def get_event_log_file_path(self, lens_name, model_id):
+        """
+        Get the file path for the JSON lines event log of a model run.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: identifier for run model
+        :type model_id: `str`
+        :return: file path
+        :rtype: `str`
+        """
+        return self.path2str(Path(self.get_logs_directory())) \
+            + '/events_{}_{}.jsonl'.format(lens_name, model_id)
+
+    def get_event_log_list(self):
+        """
+        Get the file paths of the event logs in the logs directory.
+
+        :return: sorted list of file paths
+        :rtype: `list`
+        """
+        logs_dir = self.get_logs_directory()
+        if not os.path.isdir(logs_dir):
+            return []
+
+        return sorted(
+            self.path2str(Path(logs_dir) / file_name)
+            for file_name in os.listdir(logs_dir)
+            if file_name.startswith('events_')
+            and file_name.endswith('.jsonl'))
+
     def get_output_file_path(self, lens_name, model_id, file_type='json'):
         """
         Get the file path for the PSF data for `lens_name`.
@@ -199,6 +292,61 @@ class FileSystem(object):
         return self.path2str(Path(self.get_outputs_directory())) \
             + '/output_{}_{}.{}'.format(lens_name, model_id, file_type)
 
+    def get_catalog_file_path(self):
+        """
+        Get the file path for the catalog of the outputs.
+
+        :return: file path
+        :rtype: `str`
+        """
+        return self.path2str(Path(self.get_outputs_directory())) \
+            + '/catalog.sqlite'
+
+    def get_checkpoint_file_path(self, lens_name, model_id):
+        """
+        Get the file path for the checkpoint of a model run.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: identifier for run model
+        :type model_id: `str`
+        :return: file path
+        :rtype: `str`
+        """
+        return self.path2str(Path(self.get_outputs_directory())) \
+            + '/checkpoint_{}_{}.h5'.format(lens_name, model_id)
+
+    def get_checkpoint_stage_file_path(self, lens_name, model_id, index):
+        """
+        Get the file path for an entry of the fit output in the checkpoint of
+        a model run.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: identifier for run model
+        :type model_id: `str`
+        :param index: index of the entry in the fit output
+        :type index: `int`
+        :return: file path
+        :rtype: `str`
+        """
+        return self.path2str(Path(self.get_outputs_directory())) \
+            + '/checkpoint_{}_{}_fit_{}.h5'.format(lens_name, model_id, index)
+
+    def get_samples_file_path(self, lens_name, model_id):
+        """
+        Get the file path for the MCMC samples streamed during sampling.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: identifier for run model
+        :type model_id: `str`
+        :return: file path
+        :rtype: `str`
+        """
+        return self.path2str(Path(self.get_outputs_directory())) \
+            + '/samples_{}_{}.h5'.format(lens_name, model_id)
+
     def save_output(self, lens_name, model_id, output, file_type='h5'):
         """
         Save output from fitting sequence.
@@ -256,6 +404,241 @@ class FileSystem(object):
         save_file = self.get_output_file_path(lens_name, model_id,
                                               file_type='h5')
 
+        def write_output(temp_file):
+            self.write_output_h5(temp_file, output)
+
+            # identify the run in the file, lens names and model IDs may
+            # both contain underscores
+            with h5py.File(temp_file, 'a') as f:
+                f.attrs['lens_name'] = lens_name
+                f.attrs['model_id'] = model_id
+
+        # write into a new file and move it in place, so that the arrays
+        # memory-mapped from a previously loaded output stay valid
+        self.write_replace(save_file, write_output)
+
+    def save_checkpoint(self, lens_name, model_id, checkpoint):
+        """
+        Save the checkpoint of a model run. Each entry of the fit output is
+        written only once into its own file, which the checkpoint file links
+        to, so that the samples of the completed entries are not rewritten
+        at every checkpoint. The entries already in the previous checkpoint
+        are taken to be unchanged. Each file is first written into a
+        temporary file and then moved in place, so that a job killed while
+        writing does not corrupt the previous checkpoint.
+
+        :param lens_name: name of the lens
+        :type lens_name: `str`
+        :param model_id: identifier for model run
+        :type model_id: `str`
+        :param checkpoint: dictionary with the same keys as the output
+            dictionary, and additionally 'num_completed' for the number of
+            completed entries in the fitting kwargs list and
+            'kwargs_psf_list' for the current PSFs of all the bands, and
+            optionally 'epoch_log_likelihoods' for the best-fit log
+            likelihoods at the epoch checks, 'stage_metrics' for the
+            metrics of the completed entries, and 'fitting_state' for the
+            state of the fitting sequence from `FittingSequence.get_state()`
+        :type checkpoint: `dict`
+        :return: None
+        :rtype:
+        """
+        save_file = self.get_checkpoint_file_path(lens_name, model_id)
+
+        num_saved = 0
+        if os.path.isfile(save_file):
+            with h5py.File(save_file, 'r') as f:
+                num_saved = len(f['fit_output'])
+
+        stage_files = []
+        for i, single_output in enumerate(checkpoint['fit_output']):
+            stage_file = self.get_checkpoint_stage_file_path(lens_name,
+                                                             model_id, i)
+            stage_files.append(os.path.basename(stage_file))
+
+            if i < num_saved and os.path.isfile(stage_file):
+                continue
+
+            def write_stage(temp_file):
+                with h5py.File(temp_file, 'w') as f:
+                    self.write_fitting_step_h5(f.create_group('fit_output'),
+                                               i, single_output)
+
+            self.write_replace(stage_file, write_stage)
+
+        def write_checkpoint(temp_file):
+            self.write_output_h5(temp_file, dict(checkpoint, fit_output=[]))
+
+            with h5py.File(temp_file, 'a') as f:
+                # the links are relative to the directory of the checkpoint
+                for i, stage_file in enumerate(stage_files):
+                    f['fit_output']['{}'.format(i)] = h5py.ExternalLink(
+                        stage_file, '/fit_output/{}'.format(i))
+
+                f.attrs['num_completed'] = checkpoint['num_completed']
+                f.attrs['kwargs_psf_list'] = json.dumps(
+                    self.encode_numpy_arrays(checkpoint['kwargs_psf_list']),
+                    ensure_ascii=False)
+                f.attrs['epoch_log_likelihoods'] = np.array(
+                    checkpoint.get('epoch_log_likelihoods', []), dtype=float)
+                if checkpoint.get('fitting_state') is not None:
+                    f.attrs['fitting_state'] = json.dumps(
+                        self.encode_numpy_arrays(
+                            checkpoint['fitting_state']),
+                        ensure_ascii=False)
+
+        self.write_replace(save_file, write_checkpoint)
+
+    @staticmethod
+    def write_replace(save_file, write):
+        """
+        Write a file into a temporary file and then move it in place. The
+        temporary file is removed if writing fails.
+
+        :param save_file: path to the file
+        :type save_file: `str`
+        :param write: function that writes the file at the path given to it
+        :type write: `function`
+        :return: None
+        :rtype:
+        """
+        temp_file = save_file + '.tmp'
+
+        try:
+            write(temp_file)
+        except BaseException:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            raise
+
+        os.replace(temp_file, save_file)
+
+    def load_checkpoint(self, lens_name, model_id):
+        """
+        Load the checkpoint of a model run.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: model identifier provided at run initiation
+        :type model_id: `str`
+        :return: checkpoint dictionary, `None` if no checkpoint exists
+        :rtype: `dict`
+        """
+        load_file = self.get_checkpoint_file_path(lens_name, model_id)
+
+        if not os.path.isfile(load_file):
+            return None
+
+        checkpoint = self.read_output_h5(load_file)
+
+        with h5py.File(load_file, 'r') as f:
+            checkpoint['num_completed'] = int(f.attrs['num_completed'])
+            checkpoint['kwargs_psf_list'] = self.decode_numpy_arrays(
+                json.loads(str(f.attrs['kwargs_psf_list']))
+            )
+            checkpoint['epoch_log_likelihoods'] = [
+                float(log_likelihood) for log_likelihood
+                in f.attrs.get('epoch_log_likelihoods', [])
+            ]
+            if 'fitting_state' in f.attrs:
+                checkpoint['fitting_state'] = self.decode_numpy_arrays(
+                    json.loads(str(f.attrs['fitting_state'])))
+
+        return checkpoint
+
+    def remove_checkpoint(self, lens_name, model_id):
+        """
+        Remove the checkpoint of a model run, if it exists.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: model identifier provided at run initiation
+        :type model_id: `str`
+        :return: None
+        :rtype:
+        """
+        checkpoint_file = self.get_checkpoint_file_path(lens_name, model_id)
+
+        if os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+
+        i = 0
+        stage_file = self.get_checkpoint_stage_file_path(lens_name, model_id,
+                                                         i)
+        while os.path.isfile(stage_file):
+            os.remove(stage_file)
+            i += 1
+            stage_file = self.get_checkpoint_stage_file_path(lens_name,
+                                                             model_id, i)
+
+    def save_arc_masks(self, lens_name, arc_masks):
+        """
+        Save the arc masks of a lens in the data directory. Each mask is
+        stored with the hash of the image, mask, and parameters it was
+        computed from. Failing to write, e.g., in a read-only data
+        directory, is not an error.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param arc_masks: dictionary with the band names as keys, and the
+            values are tuples of the hash and the arc mask
+        :type arc_masks: `dict`
+        :return: None
+        :rtype:
+        """
+        save_file = self.get_arc_masks_file_path(lens_name)
+        temp_file = '{}.{}.tmp'.format(save_file, os.getpid())
+
+        try:
+            with h5py.File(temp_file, 'w') as f:
+                for band, (arc_mask_hash, arc_mask) in arc_masks.items():
+                    dataset = f.create_dataset(band, data=arc_mask,
+                                               compression='gzip')
+                    dataset.attrs['hash'] = arc_mask_hash
+
+            os.replace(temp_file, save_file)
+        except OSError:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+
+    def load_arc_masks(self, lens_name):
+        """
+        Load the arc masks of a lens saved by `save_arc_masks`.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :return: dictionary with the band names as keys, and the values are
+            tuples of the hash and the arc mask, empty if no arc masks are
+            saved
+        :rtype: `dict`
+        """
+        load_file = self.get_arc_masks_file_path(lens_name)
+
+        arc_masks = {}
+        if not os.path.isfile(load_file):
+            return arc_masks
+
+        try:
+            with h5py.File(load_file, 'r') as f:
+                for band in f:
+                    arc_masks[band] = (str(f[band].attrs['hash']),
+                                       f[band][()])
+        except (OSError, KeyError):
+            return {}
+
+        return arc_masks
+
+    def write_output_h5(self, save_file, output):
+        """
+        Write an output dictionary into an h5 file.
+
+        :param save_file: path to the h5 file
+        :type save_file: `str`
+        :param output: output dictionary
+        :type output: `dict`
+        :return: None
+        :rtype:
+        """
         with h5py.File(save_file, 'w') as f:
             f.attrs['settings'] = json.dumps(
                 self.encode_numpy_arrays(output['settings']),
@@ -266,41 +649,172 @@ class FileSystem(object):
 
             group = f.create_group('fit_output')
             for i, single_output in enumerate(output['fit_output']):
-                subgroup = group.create_group('{}'.format(i))
-                subgroup.attrs['fitting_type'] = np.string_(single_output[0])
-
-                if single_output[0] == 'PSO':
-                    subgroup.create_dataset('chi2',
-                                            data=np.array(single_output[1][0])
-                                            )
-                    subgroup.create_dataset('position',
-                                            data=np.array(single_output[1][1])
-                                            )
-                    subgroup.create_dataset('velocity',
-                                            data=np.array(single_output[1][2])
-                                            )
-                    subgroup.create_dataset('param_list',
-                                            data=np.array(single_output[2],
-                                                          dtype='S10')
-                                            )
-                elif single_output[0] == 'EMCEE':
-                    subgroup.create_dataset('samples',
-                                            data=np.array(single_output[1],
-                                                          )
-                                            )
-                    subgroup.create_dataset('param_list',
-                                            data=np.array(single_output[2],
-                                                          dtype='S10')
-                                            )
-                    subgroup.create_dataset('log_likelihood',
-                                            data=np.array(single_output[3],
-                                                          )
-                                            )
-                else:
-                    raise ValueError('Fitting type {} not recognized for '
-                                     'saving output!'.format(single_output[0]))
-
-    def load_output(self, lens_name, model_id, file_type='h5'):
+                self.write_fitting_step_h5(group, i, single_output)
+
+            for key in LazyOutput.optional_attrs:
+                if output.get(key) is not None:
+                    f.attrs[key] = json.dumps(output[key])
+
+            # the likelihood masks are stored once as datasets, as they can
+            # be referenced from files in the settings
+            if output.get('masks') is not None:
+                group = f.create_group('masks')
+                for i, mask in enumerate(output['masks']):
+                    group.create_dataset('{}'.format(i),
+                                         data=np.asarray(mask, dtype=float),
+                                         compression='gzip')
+
+    @staticmethod
+    def write_fitting_step_h5(group, index, single_output):
+        """
+        Write an entry of the fit output into a group of an h5 file.
+
+        :param group: h5 group of the fit output
+        :type group: `h5py.Group`
+        :param index: index of the entry in the fit output
+        :type index: `int`
+        :param single_output: entry of the fit output
+        :type single_output: `list`
+        :return: None
+        :rtype:
+        """
+        subgroup = group.create_group('{}'.format(index))
+        subgroup.attrs['fitting_type'] = np.string_(single_output[0])
+
+        if single_output[0] == 'PSO':
+            # the number of iterations run, as a PSO stage may stop
+            # early
+            subgroup.attrs['num_iteration'] = len(single_output[1][0])
+            subgroup.create_dataset('chi2',
+                                    data=np.array(single_output[1][0])
+                                    )
+            subgroup.create_dataset('position',
+                                    data=np.array(single_output[1][1])
+                                    )
+            subgroup.create_dataset('velocity',
+                                    data=np.array(single_output[1][2])
+                                    )
+            subgroup.create_dataset('param_list',
+                                    data=np.array(single_output[2],
+                                                  dtype='S10')
+                                    )
+        elif single_output[0] == 'EMCEE':
+            subgroup.create_dataset('samples',
+                                    data=np.array(single_output[1],
+                                                  )
+                                    )
+            subgroup.create_dataset('param_list',
+                                    data=np.array(single_output[2],
+                                                  dtype='S10')
+                                    )
+            subgroup.create_dataset('log_likelihood',
+                                    data=np.array(single_output[3],
+                                                  )
+                                    )
+        else:
+            raise ValueError('Fitting type {} not recognized for '
+                             'saving output!'.format(single_output[0]))
+
+    def load_samples(self, lens_name, model_id, name='mcmc_0'):
+        """
+        Load the MCMC samples streamed into file so far. This can be used to
+        inspect a partial chain while the sampling is still running.
+
+        :param lens_name: lens name
+        :type lens_name: `str`
+        :param model_id: model identifier provided at run initiation
+        :type model_id: `str`
+        :param name: name of the sampling stage, 'mcmc_{i}' for the i-th MCMC
+            stage in the fitting sequence
+        :type name: `str`
+        :return: samples, log likelihoods
+        :rtype: `ndarray`, `ndarray`
+        """
+        return self.read_samples_h5(
+            self.get_samples_file_path(lens_name, model_id), name=name)
+
+    @staticmethod
+    def append_samples_h5(file_path, samples, log_likelihood, name='mcmc_0'):
+        """
+        Append MCMC samples to chunked, resizable, and compressed datasets
+        in an h5 file. The datasets are created on the first call.
+
+        :param file_path: path to the h5 file
+        :type file_path: `str`
+        :param samples: array of samples with shape (n_samples, n_params)
+        :type samples: `ndarray`
+        :param log_likelihood: log likelihoods of the samples
+        :type log_likelihood: `ndarray`
+        :param name: name of the group to hold the datasets
+        :type name: `str`
+        :return: None
+        :rtype:
+        """
+        samples = np.atleast_2d(samples)
+        log_likelihood = np.atleast_1d(log_likelihood)
+        num_sample, num_param = samples.shape
+
+        with h5py.File(file_path, 'a') as f:
+            if name not in f:
+                group = f.create_group(name)
+                group.create_dataset('samples', shape=(0, num_param),
+                                     maxshape=(None, num_param),
+                                     chunks=(max(num_sample, 1), num_param),
+                                     dtype=samples.dtype,
+                                     compression='gzip', shuffle=True)
+                group.create_dataset('log_likelihood', shape=(0,),
+                                     maxshape=(None,),
+                                     chunks=(max(num_sample, 1),),
+                                     dtype=log_likelihood.dtype,
+                                     compression='gzip', shuffle=True)
+
+            group = f[name]
+            n = group['samples'].shape[0]
+
+            group['samples'].resize(n + num_sample, axis=0)
+            group['samples'][n:] = samples
+            group['log_likelihood'].resize(n + num_sample, axis=0)
+            group['log_likelihood'][n:] = log_likelihood
+
+    @staticmethod
+    def read_samples_h5(file_path, name='mcmc_0'):
+        """
+        Read MCMC samples written with `append_samples_h5`.
+
+        :param file_path: path to the h5 file
+        :type file_path: `str`
+        :param name: name of the group that holds the datasets
+        :type name: `str`
+        :return: samples, log likelihoods
+        :rtype: `ndarray`, `ndarray`
+        """
+        with h5py.File(file_path, 'r') as f:
+            return f[name]['samples'][:], f[name]['log_likelihood'][:]
+
+    @staticmethod
+    def remove_samples_h5(file_path, name=None):
+        """
+        Remove the streamed samples from an h5 file.
+
+        :param file_path: path to the h5 file
+        :type file_path: `str`
+        :param name: name of the group to remove, if `None` the whole file is
+            removed
+        :type name: `str`
+        :return: None
+        :rtype:
+        """
+        if not os.path.isfile(file_path):
+            return
+
+        if name is None:
+            os.remove(file_path)
+        else:
+            with h5py.File(file_path, 'a') as f:
+                if name in f:
+                    del f[name]
+
+    def load_output(self, lens_name, model_id, file_type='h5', lazy=True):
         """
         Load from saved output file.
 
@@ -309,11 +823,14 @@ class FileSystem(object):
         :param model_id: model identifier provided at run initiation
         :type model_id: `str`
         :param file_type: type of file, 'h5' or 'json'
+        :param lazy: if True, load an h5 output lazily, see
+            `load_output_h5`
+        :type lazy: `bool`
         :return: output dictionary
         :rtype: `dict`
         """
         if file_type == 'h5':
-            return self.load_output_h5(lens_name, model_id)
+            return self.load_output_h5(lens_name, model_id, lazy=lazy)
         elif file_type == 'json':
             return self.load_output_json(lens_name, model_id)
         else:
@@ -338,20 +855,39 @@ class FileSystem(object):
 
         return self.decode_numpy_arrays(output)
 
-    def load_output_h5(self, lens_name, model_id):
+    def load_output_h5(self, lens_name, model_id, lazy=True):
         """
-        Load from saved output file.
+        Load from saved output file. If `lazy` is True, a `LazyOutput` is
+        returned, which decodes 'settings' and 'kwargs_result' only when
+        accessed and memory-maps the arrays in 'fit_output' instead of
+        reading them into the memory.
 
         :param lens_name: lens name
         :type lens_name: `str`
         :param model_id: model identifier provided at run initiation
         :type model_id: `str`
+        :param lazy: if True, load the output lazily
+        :type lazy: `bool`
         :return: output dictionary
-        :rtype: `dict`
+        :rtype: `dict` or `LazyOutput`
         """
         load_file = self.get_output_file_path(lens_name, model_id,
                                               file_type='h5')
 
+        if lazy:
+            return LazyOutput(load_file)
+        else:
+            return self.read_output_h5(load_file)
+
+    def read_output_h5(self, load_file):
+        """
+        Read an output dictionary from an h5 file.
+
+        :param load_file: path to the h5 file
+        :type load_file: `str`
+        :return: output dictionary
+        :rtype: `dict`
+        """
         with h5py.File(load_file, 'r') as f:
             settings = self.decode_numpy_arrays(
                 json.loads(str(f.attrs['settings']))
@@ -401,6 +937,13 @@ class FileSystem(object):
                 'fit_output': fit_output
             }
 
+            if 'masks' in f:
+                output['masks'] = LazyOutput.read_masks(f)
+
+            for key in LazyOutput.optional_attrs:
+                if key in f.attrs:
+                    output[key] = json.loads(str(f.attrs[key]))
+
             return output
 
     @classmethod
@@ -458,3 +1001,201 @@ class FileSystem(object):
             return decoded
         else:
             return obj
+
+
+class LazyOutput(Mapping):
+    """
+    This class provides read-only, dictionary-like access to an output saved
+    in an h5 file. The JSON-encoded attributes are decoded only when
+    accessed, and the arrays in the fit output are returned as memory-mapped
+    arrays, so that only the metadata is read until the array values are
+    used. The file is mapped once, when the fit output is first accessed,
+    and all the arrays are views into this mapping, so that an output holds
+    at most one file descriptor. `close()` releases the cached values and
+    the mapping. Datasets that cannot be memory-mapped, e.g., compressed
+    ones, are read when the fit output is accessed. The likelihood masks,
+    the record of the PSF truncation, and the metrics of the fitting stages,
+    if stored, are available with the 'masks', 'psf_truncation', and
+    'stage_metrics' keys.
+    """
+    _keys = ('settings', 'kwargs_result', 'fit_output')
+    # JSON-encoded attributes that are only stored in some outputs
+    optional_attrs = ('psf_truncation', 'stage_metrics')
+
+    def __init__(self, file_path):
+        """
+
+        :param file_path: path to the output h5 file
+        :type file_path: `str`
+        """
+        self.file_path = file_path
+        self._cache = {}
+        self._file_keys = None
+        self._mapping = None
+
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError('No output file {}!'.format(file_path))
+
+    def __getitem__(self, key):
+        """
+        Get a value from the output, the value is cached after the first
+        access.
+
+        :param key: 'settings', 'kwargs_result', or 'fit_output'
+        :type key: `str`
+        :return: value
+        :rtype:
+        """
+        if key not in self._get_keys():
+            raise KeyError(key)
+
+        if key not in self._cache:
+            if key == 'fit_output':
+                self._cache[key] = self._read_fit_output()
+            elif key == 'masks':
+                with h5py.File(self.file_path, 'r') as f:
+                    self._cache[key] = self.read_masks(f)
+            else:
+                with h5py.File(self.file_path, 'r') as f:
+                    self._cache[key] = FileSystem.decode_numpy_arrays(
+                        json.loads(str(f.attrs[key]))
+                    )
+
+        return self._cache[key]
+
+    def __iter__(self):
+        """
+        Iterate over the keys.
+
+        :return: iterator over the keys
+        :rtype:
+        """
+        return iter(self._get_keys())
+
+    def __len__(self):
+        """
+        Number of keys.
+
+        :return: number of keys
+        :rtype: `int`
+        """
+        return len(self._get_keys())
+
+    def _get_keys(self):
+        """
+        Get the keys, 'masks' and the `optional_attrs` are included only if
+        they are stored.
+
+        :return: keys
+        :rtype: `tuple`
+        """
+        if self._file_keys is None:
+            with h5py.File(self.file_path, 'r') as f:
+                self._file_keys = self._keys
+                if 'masks' in f:
+                    self._file_keys += ('masks',)
+                self._file_keys += tuple(key for key in self.optional_attrs
+                                         if key in f.attrs)
+
+        return self._file_keys
+
+    @staticmethod
+    def read_masks(f):
+        """
+        Read the likelihood masks from an opened output file.
+
+        :param f: opened h5 file
+        :type f: `h5py.File`
+        :return: list of masks
+        :rtype: `list`
+        """
+        return [f['masks']['{}'.format(i)][()]
+                for i in range(len(f['masks'].keys()))]
+
+    def get_attributes(self, names):
+        """
+        Read plain attributes of the h5 file.
+
+        :param names: names of the attributes
+        :type names: `list`
+        :return: values of the attributes, `None` for missing ones
+        :rtype: `list`
+        """
+        with h5py.File(self.file_path, 'r') as f:
+            return [f.attrs[name] if name in f.attrs else None
+                    for name in names]
+
+    def _read_fit_output(self):
+        """
+        Read the fit output with memory-mapped arrays.
+
+        :return: fit output
+        :rtype: `list`
+        """
+        fit_output = []
+
+        with h5py.File(self.file_path, 'r') as f:
+            group = f['fit_output']
+
+            for i in range(len(group.keys())):
+                subgroup = group['{}'.format(i)]
+                fitting_step = [str(subgroup.attrs['fitting_type'],
+                                    encoding='utf-8')]
+
+                if fitting_step[0] == 'PSO':
+                    fitting_step.append([
+                        self._map_dataset(subgroup['chi2']),
+                        self._map_dataset(subgroup['position']),
+                        self._map_dataset(subgroup['velocity'])
+                    ])
+                    fitting_step.append([str(s, encoding='utf-8') for s in
+                                         subgroup['param_list'][:]])
+                elif fitting_step[0] == 'EMCEE':
+                    fitting_step.append(self._map_dataset(
+                        subgroup['samples']))
+                    fitting_step.append([str(s, encoding='utf-8') for s in
+                                         subgroup['param_list'][:]])
+                    fitting_step.append(self._map_dataset(
+                        subgroup['log_likelihood']))
+
+                fit_output.append(fitting_step)
+
+        return fit_output
+
+    def _map_dataset(self, dataset):
+        """
+        Get a dataset of the h5 file as a view into the memory-mapped file.
+        Chunked, compressed, or empty datasets are read into the memory
+        instead.
+
+        :param dataset: h5py dataset
+        :type dataset: `h5py.Dataset`
+        :return: read-only array
+        :rtype: `ndarray`
+        """
+        offset = dataset.id.get_offset()
+
+        if dataset.chunks is not None or offset is None \
+                or dataset.size == 0:
+            return dataset[()]
+
+        if self._mapping is None:
+            self._mapping = np.memmap(self.file_path, mode='r',
+                                      dtype=np.uint8)
+
+        num_bytes = dataset.size * dataset.dtype.itemsize
+
+        return self._mapping[offset:offset + num_bytes].view(
+            dataset.dtype).reshape(dataset.shape)
+
+    def close(self):
+        """
+        Release the cached values and the memory-mapped file. The file is
+        unmapped when the arrays previously returned are no longer
+        referenced.
+
+        :return: None
+        :rtype:
+        """
+        self._cache = {}
+        self._mapping = None
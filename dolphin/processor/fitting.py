@@ -0,0 +1,637 @@
+# -*- coding: utf-8 -*-
+"""
+This module extends `lenstronomy`'s fitting sequence with the features
+needed by `dolphin`.
+"""
+__author__ = 'ajshajib'
+
+import time
+from copy import deepcopy
+import numpy as np
+from lenstronomy.Workflow.fitting_sequence import FittingSequence \
+    as LenstronomyFittingSequence
+from lenstronomy.Sampling.sampler import Sampler
+from lenstronomy.Sampling.Samplers.pso import ParticleSwarmOptimizer
+from lenstronomy.Sampling.Pool.pool import choose_pool
+from lenstronomy.Util import sampling_util
+
+from .files import FileSystem
+from .data import Data
+from .data import ImageData
+from .data import PSFData
+
+
+class LikelihoodCounter(object):
+    """
+    Wrapper of a log likelihood function that counts its evaluations in the
+    process it is evaluated in. The count is kept in a class attribute, so
+    that the evaluations on the MPI workers, which receive pickled copies of
+    the wrapper, are counted on each rank. The evaluations in the child
+    processes of a multiprocessing pool, i.e., with `threadCount` > 1, are
+    not counted, as the pool is created and closed within each sampler or
+    optimizer run and the counts of its processes are not collected.
+    """
+    num_evaluations = 0
+
+    def __init__(self, log_likelihood):
+        """
+
+        :param log_likelihood: log likelihood function
+        :type log_likelihood: `callable`
+        """
+        self._log_likelihood = log_likelihood
+
+    def __call__(self, *args, **kwargs):
+        """
+        Evaluate the log likelihood and increment the count.
+
+        :return: log likelihood
+        :rtype: `float`
+        """
+        LikelihoodCounter.num_evaluations += 1
+        return self._log_likelihood(*args, **kwargs)
+
+
+class FittingSequence(LenstronomyFittingSequence):
+    """
+    Fitting sequence that can stream the MCMC samples into an h5 file while
+    the sampler is running, stop the PSO early when it has converged, and
+    evaluate the likelihood on binned images for a coarse-to-fine
+    optimization.
+    """
+    def __init__(self, kwargs_data_joint, kwargs_model, kwargs_constraints,
+                 kwargs_likelihood, kwargs_params, mpi=False,
+                 verbose=True, samples_file=None):
+        """
+
+        :param kwargs_data_joint: keyword arguments of the data
+        :type kwargs_data_joint: `dict`
+        :param kwargs_model: keyword arguments of the model
+        :type kwargs_model: `dict`
+        :param kwargs_constraints: keyword arguments of the constraints
+        :type kwargs_constraints: `dict`
+        :param kwargs_likelihood: keyword arguments of the likelihood
+        :type kwargs_likelihood: `dict`
+        :param kwargs_params: keyword arguments of the parameters
+        :type kwargs_params: `dict`
+        :param mpi: if True, run with MPI
+        :type mpi: `bool`
+        :param verbose: if True, print progress
+        :type verbose: `bool`
+        :param samples_file: path to the h5 file to stream the MCMC samples
+            into, streaming is turned off if `None`
+        :type samples_file: `str`
+        """
+        super(FittingSequence, self).__init__(
+            kwargs_data_joint, kwargs_model, kwargs_constraints,
+            kwargs_likelihood, kwargs_params, mpi=mpi, verbose=verbose)
+
+        self._samples_file = samples_file
+        self._mcmc_stage_count = 0
+        # if True, the likelihood evaluations are counted, see
+        # `likelihoodModule`
+        self._count_evaluations = True
+
+        # binning factor of the images the likelihood is evaluated on, the
+        # full-resolution data and likelihood masks are kept to bin from
+        self._binning = 1
+        self._full_kwargs_data_joint = self.kwargs_data_joint
+        self._full_likelihood_masks = None
+
+    # entries of the fitting kwargs list that need the full-resolution data
+    _full_resolution_fitting_types = ['psf_iteration', 'align_images']
+
+    def fit_sequence(self, fitting_list):
+        """
+        Run the fitting sequence. In addition to the fitting types of
+        `lenstronomy`, ['set_resolution', {'binning': n}] switches the
+        likelihood to the images binned by `n`, see `set_resolution`.
+
+        :param fitting_list: list of [fitting type, keyword arguments]
+        :type fitting_list: `list`
+        :return: fitting outputs
+        :rtype: `list`
+        """
+        chain_list = []
+
+        for fitting in fitting_list:
+            if fitting[0] == 'set_resolution':
+                self.set_resolution(**fitting[1])
+            elif fitting[0] in self._full_resolution_fitting_types \
+                    and self._binning != 1:
+                raise ValueError("'{}' needs to be run at full resolution!"
+                                 .format(fitting[0]))
+            else:
+                chain_list += super(FittingSequence, self).fit_sequence(
+                    [fitting])
+
+        return chain_list
+
+    def set_resolution(self, binning=1):
+        """
+        Evaluate the likelihood on the images, noise, PSFs, and likelihood
+        masks binned by `binning`, or on the full-resolution data if
+        `binning` is 1. The binned data is created from the current state of
+        the full-resolution data, e.g., after a PSF iteration.
+
+        :param binning: number of pixels to combine along each axis
+        :type binning: `int`
+        :return: None
+        :rtype:
+        """
+        binning = int(binning)
+        if binning < 1:
+            raise ValueError('Binning factor {} is not valid!'.format(
+                binning))
+
+        if binning == self._binning:
+            return
+
+        if self._binning == 1:
+            self._full_likelihood_masks = \
+                self._updateManager.kwargs_likelihood.get(
+                    'image_likelihood_mask_list')
+
+        self._binning = binning
+        self._bin_data()
+
+        if self._full_likelihood_masks is not None:
+            self._updateManager.update_options(kwargs_likelihood={
+                'image_likelihood_mask_list': self.bin_masks(
+                    self._full_likelihood_masks)
+            })
+
+    def _bin_data(self):
+        """
+        Set the data the likelihood is evaluated on from the full-resolution
+        data binned to the current resolution.
+
+        :return: None
+        :rtype:
+        """
+        if self._binning == 1:
+            self.kwargs_data_joint = self._full_kwargs_data_joint
+        else:
+            self.kwargs_data_joint = dict(self._full_kwargs_data_joint)
+            self.kwargs_data_joint['multi_band_list'] = [
+                self.bin_band(band, self._binning) for band
+                in self._full_kwargs_data_joint['multi_band_list']
+            ]
+
+    @staticmethod
+    def bin_band(band, binning):
+        """
+        Bin the data, PSF, and numerics settings of a band.
+
+        :param band: [`kwargs_data`, `kwargs_psf`, `kwargs_numerics`]
+        :type band: `list`
+        :param binning: number of pixels to combine along each axis
+        :type binning: `int`
+        :return: binned band
+        :rtype: `list`
+        """
+        kwargs_numerics = dict(band[2])
+        for key in ['supersampled_indexes', 'flux_evaluate_indexes']:
+            if kwargs_numerics.get(key) is not None:
+                kwargs_numerics[key] = Data.bin_array(
+                    kwargs_numerics[key], binning, np.any)
+
+        return [ImageData.bin_kwargs_data(band[0], binning),
+                PSFData.bin_kwargs_psf(band[1], binning),
+                kwargs_numerics]
+
+    def bin_masks(self, masks):
+        """
+        Bin full-resolution likelihood masks to the current resolution. A
+        binned pixel is masked if any of its pixels is masked.
+
+        :param masks: likelihood masks
+        :type masks: `list` of `ndarray`
+        :return: binned masks
+        :rtype: `list` of `ndarray`
+        """
+        if self._binning == 1 or masks is None:
+            return masks
+
+        return [None if mask is None else Data.bin_array(
+                    mask, self._binning, np.min) for mask in masks]
+
+    def update_settings(self, kwargs_likelihood=None, kwargs_numerics=None,
+                        **kwargs):
+        """
+        Update the settings of the fitting sequence, see `lenstronomy`'s
+        `FittingSequence.update_settings`. Likelihood masks are provided at
+        full resolution, and binned to the current resolution. The
+        `kwargs_numerics` of the bands can also be updated.
+
+        :param kwargs_likelihood: keyword arguments of the likelihood to
+            update
+        :type kwargs_likelihood: `dict`
+        :param kwargs_numerics: keyword arguments of the numerics to update,
+            one `dict` or None for each band
+        :type kwargs_numerics: `list`
+        :param kwargs: other keyword arguments of `update_settings`
+        :type kwargs: `dict`
+        :return: 0
+        :rtype: `int`
+        """
+        if kwargs_likelihood is not None \
+                and 'image_likelihood_mask_list' in kwargs_likelihood:
+            kwargs_likelihood = dict(kwargs_likelihood)
+            self._full_likelihood_masks = kwargs_likelihood[
+                'image_likelihood_mask_list']
+            kwargs_likelihood['image_likelihood_mask_list'] = \
+                self.bin_masks(self._full_likelihood_masks)
+
+        if kwargs_numerics is not None:
+            self.update_numerics(kwargs_numerics)
+
+        return super(FittingSequence, self).update_settings(
+            kwargs_likelihood=kwargs_likelihood, **kwargs)
+
+    def update_numerics(self, kwargs_numerics):
+        """
+        Update the `kwargs_numerics` of the bands. The bands are copied, so
+        that the `kwargs_data_joint` provided at initialization keeps its
+        numerics.
+
+        :param kwargs_numerics: keyword arguments of the numerics to update,
+            one `dict` or None for each band
+        :type kwargs_numerics: `list`
+        :return: None
+        :rtype:
+        """
+        multi_band_list = self._full_kwargs_data_joint['multi_band_list']
+        if len(kwargs_numerics) != len(multi_band_list):
+            raise ValueError('Need one kwargs_numerics for each band!')
+
+        bands = []
+        for band, kwargs in zip(multi_band_list, kwargs_numerics):
+            if kwargs is not None:
+                band = [band[0], band[1], dict(band[2], **kwargs)]
+            bands.append(band)
+
+        self._full_kwargs_data_joint = dict(self._full_kwargs_data_joint)
+        self._full_kwargs_data_joint['multi_band_list'] = bands
+        # `lenstronomy` updates the PSFs and alignments in this list
+        self.multi_band_list = bands
+        self._bin_data()
+
+    @property
+    def likelihoodModule(self):
+        """
+        Get the likelihood module for the current state. The log
+        likelihood evaluations of the samplers and optimizers are counted
+        by `LikelihoodCounter`, the ones for `best_fit_likelihood` are not.
+
+        :return: likelihood module
+        :rtype: `LikelihoodModule`
+        """
+        likelihood_module = super(FittingSequence, self).likelihoodModule
+        if self._count_evaluations:
+            likelihood_module.logL = LikelihoodCounter(
+                likelihood_module.logL)
+
+        return likelihood_module
+
+    @property
+    def best_fit_likelihood(self):
+        """
+        Get the log likelihood of the current best fit, always evaluated on
+        the full-resolution data.
+
+        :return: log likelihood
+        :rtype: `float`
+        """
+        binning = self._binning
+        self.set_resolution(1)
+        self._count_evaluations = False
+        try:
+            log_likelihood = super(FittingSequence, self).best_fit_likelihood
+        finally:
+            self._count_evaluations = True
+        self.set_resolution(binning)
+
+        return log_likelihood
+
+    def get_best_fit_likelihood(self, kwargs_numerics=None):
+        """
+        Get the log likelihood of the current best fit on the
+        full-resolution data, optionally with the `kwargs_numerics` of the
+        bands updated only for this evaluation, e.g., to compare the
+        likelihoods across the epochs of a numerics schedule at the same
+        numerics.
+
+        :param kwargs_numerics: keyword arguments of the numerics to update,
+            one `dict` or None for each band, the current numerics are used
+            if `None`
+        :type kwargs_numerics: `list`
+        :return: log likelihood
+        :rtype: `float`
+        """
+        if kwargs_numerics is None:
+            return self.best_fit_likelihood
+
+        full_kwargs_data_joint = self._full_kwargs_data_joint
+        self.update_numerics(kwargs_numerics)
+        try:
+            log_likelihood = self.best_fit_likelihood
+        finally:
+            self._full_kwargs_data_joint = full_kwargs_data_joint
+            self.multi_band_list = full_kwargs_data_joint['multi_band_list']
+            self._bin_data()
+
+        return log_likelihood
+
+    # names of the fixed, lower, and upper kwargs of the model types in the
+    # `UpdateManager`, in the order of its `fixed_kwargs`
+    _update_manager_model_types = ['lens', 'source', 'lens_light', 'ps',
+                                   'special', 'extinction']
+
+    def get_state(self):
+        """
+        Get the state of the fitting sequence set by the entries of a
+        fitting kwargs list, that cannot be recovered by replaying the
+        entries without their fitting results. These are the current
+        parameter values, the fixed parameters and the limits of the
+        parameters, and the shifts of the band coordinates from aligning the
+        images.
+
+        :return: dictionary with 'kwargs_result', 'kwargs_fixed',
+            'kwargs_lower', 'kwargs_upper', and 'kwargs_shift_list'
+        :rtype: `dict`
+        """
+        update_manager = self._updateManager
+        state = {
+            'kwargs_result': self.best_fit(bijective=True),
+            'kwargs_shift_list': [
+                {'ra_shift': band[0].get('ra_shift', 0),
+                 'dec_shift': band[0].get('dec_shift', 0)}
+                for band in self._full_kwargs_data_joint['multi_band_list']
+            ],
+        }
+        for limit in ['fixed', 'lower', 'upper']:
+            state['kwargs_' + limit] = {
+                model_type: deepcopy(getattr(update_manager, '_{}_{}'.format(
+                    model_type, limit)))
+                for model_type in self._update_manager_model_types
+            }
+
+        return state
+
+    def set_state(self, state):
+        """
+        Set the state of the fitting sequence from `get_state()`, e.g.,
+        when resuming from a checkpoint.
+
+        :param state: state from `get_state()`
+        :type state: `dict`
+        :return: None
+        :rtype:
+        """
+        update_manager = self._updateManager
+        for limit in ['fixed', 'lower', 'upper']:
+            for model_type in self._update_manager_model_types:
+                setattr(update_manager, '_{}_{}'.format(model_type, limit),
+                        deepcopy(state['kwargs_' + limit][model_type]))
+
+        bands = [[dict(band[0], **kwargs_shift), band[1], band[2]]
+                 for band, kwargs_shift in zip(
+                    self._full_kwargs_data_joint['multi_band_list'],
+                    state['kwargs_shift_list'])]
+
+        self._full_kwargs_data_joint = dict(self._full_kwargs_data_joint)
+        self._full_kwargs_data_joint['multi_band_list'] = bands
+        self.multi_band_list = bands
+        self._bin_data()
+
+        self.update_state(state['kwargs_result'])
+
+    def pso(self, n_particles, n_iterations, sigma_scale=1, print_key='PSO',
+            threadCount=1, early_stop_tolerance=None, early_stop_window=10):
+        """
+        Particle swarm optimization. If `early_stop_tolerance` is provided,
+        the optimization stops when the log likelihood of the global best
+        improves by less than `early_stop_tolerance` over the last
+        `early_stop_window` iterations. Otherwise, `lenstronomy`'s PSO
+        routine is used. The number of iterations actually run is the
+        length of the chain.
+
+        :param n_particles: number of particles
+        :type n_particles: `int`
+        :param n_iterations: maximum number of iterations
+        :type n_iterations: `int`
+        :param sigma_scale: scaling of the initial parameter spread
+        :type sigma_scale: `float`
+        :param print_key: name of the routine to print
+        :type print_key: `str`
+        :param threadCount: number of CPU threads
+        :type threadCount: `int`
+        :param early_stop_tolerance: minimum improvement of the log
+            likelihood over `early_stop_window` iterations to continue
+        :type early_stop_tolerance: `float`
+        :param early_stop_window: number of iterations to compare the
+            improvement over
+        :type early_stop_window: `int`
+        :return: result of the best fit, chain of [2 * log likelihood,
+            positions, velocities] of the global best after each iteration,
+            parameter names
+        :rtype: `tuple`
+        """
+        if early_stop_tolerance is None:
+            return super(FittingSequence, self).pso(
+                n_particles, n_iterations, sigma_scale=sigma_scale,
+                print_key=print_key, threadCount=threadCount)
+
+        param_class = self.param_class
+        init_pos = np.array(param_class.kwargs2args(
+            **self._updateManager.parameter_state))
+        sigma_start = np.array(param_class.kwargs2args(
+            **self._updateManager.sigma_kwargs))
+        _, param_list = param_class.num_param()
+
+        sampler = Sampler(likelihoodModule=self.likelihoodModule)
+        lower_start = np.maximum(init_pos - sigma_start * sigma_scale,
+                                 sampler.lower_limit)
+        upper_start = np.minimum(init_pos + sigma_start * sigma_scale,
+                                 sampler.upper_limit)
+
+        pool = choose_pool(mpi=self._mpi, processes=threadCount,
+                           use_dill=True)
+
+        pso = ParticleSwarmOptimizer(sampler.chain.logL, lower_start,
+                                     upper_start, n_particles, pool=pool)
+        pso.set_global_best(init_pos, [0] * len(init_pos),
+                            sampler.chain.logL(init_pos))
+
+        time_start = time.time()
+
+        chi2_list = []
+        pos_list = []
+        vel_list = []
+
+        for _ in pso.sample(n_iterations):
+            # lenstronomy stores 2 * log likelihood of the global best
+            chi2_list.append(pso.global_best.fitness * 2)
+            pos_list.append(pso.global_best.position)
+            vel_list.append(pso.global_best.velocity)
+
+            if len(chi2_list) > early_stop_window \
+                    and (chi2_list[-1] - chi2_list[-1 - early_stop_window]) \
+                    / 2. < early_stop_tolerance:
+                break
+
+        if not self._mpi:
+            # the MPI workers are kept alive for the later stages
+            pool.close()
+
+        if self._verbose:
+            print('Computing the {}...'.format(print_key))
+            print(pso.global_best.fitness, 'logL')
+            print('{} of maximum {} iterations run'.format(len(chi2_list),
+                                                           n_iterations))
+            print(time.time() - time_start, 'time used for', print_key)
+            print('===================')
+
+        kwargs_result = param_class.args2kwargs(pso.global_best.position,
+                                                bijective=True)
+        return kwargs_result, [chi2_list, pos_list, vel_list], param_list
+
+    def mcmc(self, n_burn, n_run, walkerRatio=None, n_walkers=None,
+             sigma_scale=1, threadCount=1, init_samples=None,
+             re_use_samples=True, sampler_type='EMCEE', progress=True,
+             save_every=None, **kwargs):
+        """
+        MCMC routine. If `save_every` is provided and `sampler_type` is
+        'EMCEE', the samples after burn-in are appended to the samples file
+        every `save_every` steps, so that the sampler does not hold the chain
+        in the memory and a partial chain can be inspected during the run.
+        Otherwise, `lenstronomy`'s MCMC routine is used.
+
+        Note that the full chain after burn-in is read back from the samples
+        file into the memory once the sampling ends, as the returned samples
+        are used for the best fit, the initial samples of a following MCMC
+        stage, and the output.
+
+        :param n_burn: number of burn-in iterations (will not be saved)
+        :type n_burn: `int`
+        :param n_run: number of MCMC iterations that are saved
+        :type n_run: `int`
+        :param walkerRatio: ratio of walkers/number of free parameters
+        :type walkerRatio: `int`
+        :param n_walkers: number of walkers, overwrites `walkerRatio` if set
+        :type n_walkers: `int`
+        :param sigma_scale: scaling of the initial parameter spread
+        :type sigma_scale: `float`
+        :param threadCount: number of CPU threads
+        :type threadCount: `int`
+        :param init_samples: initial samples to start the MCMC from
+        :type init_samples: `ndarray`
+        :param re_use_samples: if True, re-use the `init_samples`
+        :type re_use_samples: `bool`
+        :param sampler_type: 'EMCEE' or 'ZEUS'
+        :type sampler_type: `str`
+        :param progress: if True, show a progress bar
+        :type progress: `bool`
+        :param save_every: number of steps between two writes to the
+            samples file
+        :type save_every: `int`
+        :param kwargs: other keyword arguments for `lenstronomy`'s MCMC
+        :type kwargs: `dict`
+        :return: sampler type, samples, parameter names, log likelihoods,
+            with the samples and the log likelihoods of the full chain in the
+            memory
+        :rtype: `list`
+        """
+        stage_name = 'mcmc_{}'.format(self._mcmc_stage_count)
+        self._mcmc_stage_count += 1
+
+        if save_every is None or sampler_type != 'EMCEE' \
+                or self._samples_file is None:
+            return super(FittingSequence, self).mcmc(
+                n_burn, n_run, walkerRatio=walkerRatio, n_walkers=n_walkers,
+                sigma_scale=sigma_scale, threadCount=threadCount,
+                init_samples=init_samples, re_use_samples=re_use_samples,
+                sampler_type=sampler_type, progress=progress, **kwargs)
+
+        import emcee
+
+        param_class = self.param_class
+        sampler = Sampler(likelihoodModule=self.likelihoodModule)
+        mean_start = param_class.kwargs2args(
+            **self._updateManager.parameter_state)
+        sigma_start = np.array(param_class.kwargs2args(
+            **self._updateManager.sigma_kwargs)) * sigma_scale
+        num_param, param_list = param_class.num_param()
+
+        if n_walkers is None:
+            if walkerRatio is None:
+                raise ValueError('MCMC sampler needs either n_walkers or '
+                                 'walkerRatio as input argument!')
+            n_walkers = num_param * walkerRatio
+
+        if init_samples is not None and re_use_samples:
+            if np.shape(init_samples)[1] != num_param:
+                raise ValueError('Can not re-use previous MCMC samples as '
+                                 'number of parameters have changed!')
+            init_position = init_samples[
+                np.random.choice(len(init_samples), n_walkers)]
+        else:
+            init_position = sampling_util.sample_ball_truncated(
+                mean_start, sigma_start, sampler.lower_limit,
+                sampler.upper_limit, size=n_walkers)
+
+        pool = choose_pool(mpi=self._mpi, processes=threadCount,
+                           use_dill=True)
+
+        FileSystem.remove_samples_h5(self._samples_file, name=stage_name)
+
+        time_start = time.time()
+
+        ensemble_sampler = emcee.EnsembleSampler(n_walkers, num_param,
+                                                 sampler.chain.logL,
+                                                 pool=pool)
+
+        coords_buffer = []
+        log_prob_buffer = []
+
+        for step, state in enumerate(ensemble_sampler.sample(
+                init_position, iterations=n_burn + n_run, store=False,
+                progress=progress)):
+            if step < n_burn:
+                continue
+
+            coords_buffer.append(np.copy(state.coords))
+            log_prob_buffer.append(np.copy(state.log_prob))
+
+            if len(coords_buffer) == save_every \
+                    or step == n_burn + n_run - 1:
+                FileSystem.append_samples_h5(
+                    self._samples_file,
+                    np.concatenate(coords_buffer),
+                    np.concatenate(log_prob_buffer),
+                    name=stage_name
+                )
+                coords_buffer = []
+                log_prob_buffer = []
+
+        if not self._mpi:
+            # the MPI workers are kept alive for the later stages
+            pool.close()
+
+        if n_run > 0:
+            samples, log_likelihood = FileSystem.read_samples_h5(
+                self._samples_file, name=stage_name)
+        else:
+            samples = np.empty((0, num_param))
+            log_likelihood = np.empty(0)
+
+        if self._verbose:
+            print('Computing the MCMC...')
+            print('Number of walkers = ', n_walkers)
+            print('Burn-in iterations: ', n_burn)
+            print('Sampling iterations (in current run):', n_burn + n_run)
+            print(time.time() - time_start, 'time taken for MCMC sampling')
+
+        self._mcmc_init_samples = samples
+        return [sampler_type, samples, param_list, log_likelihood]
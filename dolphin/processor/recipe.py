@@ -5,6 +5,7 @@ with pre-defined recipes.
 """
 __author__ = 'ajshajib'
 
+import hashlib
 from copy import deepcopy
 import numpy as np
 from scipy import ndimage
@@ -18,6 +19,8 @@ class Recipe(object):
     Then, the sampling can be done starting from the neighborhood of this
     point.
     """
+    # radius and polar angle grids for the arc masks, cached for each shape
+    _arc_mask_grids = {}
 
     def __init__(self, config, sampler='EMCEE', thread_count=1):
         """
@@ -44,9 +47,36 @@ class Recipe(object):
             self._pso_num_iteration = self._config.settings['fitting'][
                 'pso_settings']['num_iteration']
 
+            # stop a PSO stage early if the best log-likelihood improves by
+            # less than `early_stop_tolerance` over `early_stop_window`
+            # iterations
+            self._pso_early_stop_tolerance = self._config.settings[
+                'fitting']['pso_settings'].get('early_stop_tolerance')
+            self._pso_early_stop_window = self._config.settings['fitting'][
+                'pso_settings'].get('early_stop_window', 10)
+
+            # binning factors of the images for the first epochs of the
+            # PSO recipes, for a coarse-to-fine optimization
+            self._pso_pyramid_binning = [
+                int(binning) for binning in self._config.settings['fitting'][
+                    'pso_settings'].get('pyramid_binning', [])
+            ]
+
             if self.do_pso is None:
                 self.do_pso = False
 
+        # `kwargs_numerics` for the first epochs of the PSO recipes, e.g.,
+        # with lower supersampling than the final stages
+        self._numerics_schedule = config.get_kwargs_numerics_schedule()
+
+        # if provided, the number of epochs of the PSO recipes is decided
+        # from the gain in the best-fit log likelihood after each epoch
+        try:
+            self.epoch_settings = deepcopy(
+                config.settings['fitting']['epoch_settings'])
+        except (NameError, KeyError):
+            self.epoch_settings = None
+
         try:
             config.settings['fitting']['psf_iteration']
         except (NameError, KeyError):
@@ -80,7 +110,8 @@ class Recipe(object):
             except (NameError, KeyError):
                 self.guess_params[component] = None
 
-    def get_recipe(self, kwargs_data_joint=None, recipe_name='default'):
+    def get_recipe(self, kwargs_data_joint=None, recipe_name='default',
+                   arc_masks=None):
         """
         Get `fitting_kwargs_list` according to the requested `recipe`.
         `default` will first search for specified recipe in the settings,
@@ -92,6 +123,9 @@ class Recipe(object):
         :type kwargs_data_joint:
         :param recipe_name: recipe name, 'default' or 'galaxy-galaxy'
         :type recipe_name: `str`
+        :param arc_masks: precomputed arc masks for the 'galaxy-galaxy'
+            recipe, computed from the images if `None`
+        :type arc_masks: `list` of `ndarray`
         :return: fitting kwargs list
         :rtype: `list`
         """
@@ -114,7 +148,7 @@ class Recipe(object):
                 raise ValueError('kwargs_data_joint is necessary to use '
                                  'galaxy-galaxy optimization recipe!')
             fitting_kwargs_list += self.get_galaxy_galaxy_recipe(
-                kwargs_data_joint)
+                kwargs_data_joint, arc_masks=arc_masks)
         elif recipe_name == 'skip':
             pass
         else:
@@ -125,6 +159,30 @@ class Recipe(object):
 
         return fitting_kwargs_list
 
+    def _get_pso_kwargs(self, sigma_scale=1.):
+        """
+        Get the keyword arguments for a PSO entry in the fitting kwargs list.
+
+        :param sigma_scale: scaling of the initial parameter spread
+        :type sigma_scale: `float`
+        :return: keyword arguments of the PSO
+        :rtype: `dict`
+        """
+        kwargs_pso = {
+            'sigma_scale': sigma_scale,
+            'n_particles': self._pso_num_particle,
+            'n_iterations': self._pso_num_iteration,
+            'threadCount': self._thread_count
+        }
+
+        if self._pso_early_stop_tolerance is not None:
+            kwargs_pso['early_stop_tolerance'] = float(
+                self._pso_early_stop_tolerance)
+            kwargs_pso['early_stop_window'] = int(
+                self._pso_early_stop_window)
+
+        return kwargs_pso
+
     def _get_power_law_model_index(self):
         """
         Get the index of the power-law model, if included in the lens model
@@ -192,54 +250,285 @@ class Recipe(object):
         fitting_kwargs_list = []
 
         if self.do_pso:
-            pso_range_multipliers = [1., 0.1, 0.1]
-
-            pl_model_index = self._get_power_law_model_index()
-
-            for epoch in range(2):
-                if epoch == 0 and pl_model_index is not None:
-                    fitting_kwargs_list.append([
-                        'update_settings',
-                        {'lens_add_fixed': [[pl_model_index, ['gamma']]]}
-
-                    ])
-                elif pl_model_index is not None:
-                    fitting_kwargs_list.append([
-                        'update_settings',
-                        {'lens_remove_fixed': [[pl_model_index, ['gamma']]]}
-                    ])
-
-                for multiplier in pso_range_multipliers:
-                    # if multiplier in [10., 1.]:
-                    #     fitting_kwargs_list.append([
-                    #         'update_settings',
-                    #         {'lens_add_fixed': [[index, ['gamma']]]}
-                    #
-                    #     ])
-                    # elif multiplier == .1:
-                    #     fitting_kwargs_list.append([
-                    #         'update_settings',
-                    #         {'lens_remove_fixed': [[index, ['gamma']]]}
-                    #     ])
-
-                    fitting_kwargs_list.append([
-                        'PSO',
-                        {
-                            'sigma_scale': multiplier,
-                            'n_particles': self._pso_num_particle,
-                            'n_iterations': self._pso_num_iteration,
-                            'threadCount': self._thread_count
-                        }
-                    ])
-
-                    if self.reconstruct_psf:
-                        fitting_kwargs_list.append(
-                            ['psf_iteration',
-                             self._config.get_kwargs_psf_iteration()]
-                        )
+            if self.epoch_settings is None:
+                for epoch in range(2):
+                    fitting_kwargs_list += self._set_epoch_settings(
+                        self._get_default_epoch(epoch), epoch)
+            else:
+                # the first epoch with fixed power-law slope is always
+                # followed by at least one epoch with free slope
+                fitting_kwargs_list += self._set_epoch_settings(
+                    self._get_default_epoch(0), 0)
+                fitting_kwargs_list.append(self._get_epoch_check(
+                    self._set_epoch_settings(self._get_default_epoch(1)),
+                    min_epochs=2))
+
+            fitting_kwargs_list += self._reset_epoch_settings()
 
         return fitting_kwargs_list
 
+    def _set_epoch_settings(self, epoch_fitting_kwargs_list, epoch=None):
+        """
+        Set the numerics and the resolution of the images for an epoch of a
+        PSO recipe, see `_set_epoch_numerics` and `_set_epoch_resolution`.
+
+        :param epoch_fitting_kwargs_list: fitting kwargs list of the epoch
+        :type epoch_fitting_kwargs_list: `list`
+        :param epoch: index of the epoch, `None` for the epochs added by the
+            adaptive epoch checks
+        :type epoch: `int`
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        return self._set_epoch_numerics(
+            self._set_epoch_resolution(epoch_fitting_kwargs_list, epoch),
+            epoch)
+
+    def _reset_epoch_settings(self):
+        """
+        Get the entries to return to the configured numerics and the
+        full-resolution images after the epochs of a PSO recipe.
+
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        return self._reset_numerics() + self._reset_resolution()
+
+    def _set_epoch_numerics(self, epoch_fitting_kwargs_list, epoch=None):
+        """
+        Set the `kwargs_numerics` for an epoch of a PSO recipe, from
+        `kwargs_numerics['pso_epochs']` in the settings. The epochs after
+        the scheduled ones, and the ones added by the adaptive epoch checks,
+        use the configured `kwargs_numerics`.
+
+        :param epoch_fitting_kwargs_list: fitting kwargs list of the epoch
+        :type epoch_fitting_kwargs_list: `list`
+        :param epoch: index of the epoch
+        :type epoch: `int`
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        if not self._numerics_schedule:
+            return epoch_fitting_kwargs_list
+
+        if epoch is not None and epoch < len(self._numerics_schedule):
+            kwargs_numerics = deepcopy(self._numerics_schedule[epoch])
+        else:
+            kwargs_numerics = self._get_configured_numerics()
+
+        return [['update_settings', {'kwargs_numerics': kwargs_numerics}]] \
+            + epoch_fitting_kwargs_list
+
+    def _reset_numerics(self):
+        """
+        Get the entry to return to the configured `kwargs_numerics` after
+        the epochs of a PSO recipe, if a numerics schedule is used.
+
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        if self._numerics_schedule:
+            return [['update_settings', {
+                'kwargs_numerics': self._get_configured_numerics()}]]
+        else:
+            return []
+
+    def _get_configured_numerics(self):
+        """
+        Get the configured values of the `kwargs_numerics` settings that are
+        changed by the numerics schedule. The other settings, e.g., the
+        adaptive supersampling regions, are left unchanged.
+
+        :return: `kwargs_numerics` updates for each band
+        :rtype: `list`
+        """
+        keys = set()
+        for kwargs_numerics in self._numerics_schedule:
+            for kwargs_numerics_band in kwargs_numerics:
+                keys.update(kwargs_numerics_band.keys())
+
+        return [{key: kwargs_numerics_band[key] for key in keys
+                 if key in kwargs_numerics_band}
+                for kwargs_numerics_band
+                in deepcopy(self._config.get_kwargs_numerics())]
+
+    def _set_epoch_resolution(self, epoch_fitting_kwargs_list, epoch=None):
+        """
+        Set the resolution of the images for an epoch of a PSO recipe, from
+        the `pyramid_binning` factors in the PSO settings. The entries that
+        need the full-resolution images, e.g., PSF iteration, are run at
+        full resolution.
+
+        :param epoch_fitting_kwargs_list: fitting kwargs list of the epoch
+        :type epoch_fitting_kwargs_list: `list`
+        :param epoch: index of the epoch, the epochs added by the adaptive
+            epoch checks have `None` and run at full resolution
+        :type epoch: `int`
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        if not self._pso_pyramid_binning:
+            return epoch_fitting_kwargs_list
+
+        if epoch is not None and epoch < len(self._pso_pyramid_binning):
+            binning = self._pso_pyramid_binning[epoch]
+        else:
+            binning = 1
+
+        fitting_kwargs_list = [['set_resolution', {'binning': binning}]]
+        for fitting_kwargs in epoch_fitting_kwargs_list:
+            if binning != 1 and fitting_kwargs[0] in ['psf_iteration',
+                                                      'align_images']:
+                fitting_kwargs_list += [
+                    ['set_resolution', {'binning': 1}],
+                    fitting_kwargs,
+                    ['set_resolution', {'binning': binning}]
+                ]
+            else:
+                fitting_kwargs_list.append(fitting_kwargs)
+
+        return fitting_kwargs_list
+
+    def _reset_resolution(self):
+        """
+        Get the entry to return to the full-resolution images after the
+        epochs of a PSO recipe, if the image pyramid is used.
+
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        if self._pso_pyramid_binning:
+            return [['set_resolution', {'binning': 1}]]
+        else:
+            return []
+
+    def _get_default_epoch(self, epoch):
+        """
+        Get the fitting kwargs list for one epoch of the default recipe. The
+        power-law slope is fixed in the first epoch and freed in the later
+        ones.
+
+        :param epoch: index of the epoch
+        :type epoch: `int`
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        fitting_kwargs_list = []
+        pso_range_multipliers = [1., 0.1, 0.1]
+
+        pl_model_index = self._get_power_law_model_index()
+
+        if epoch == 0 and pl_model_index is not None:
+            fitting_kwargs_list.append([
+                'update_settings',
+                {'lens_add_fixed': [[pl_model_index, ['gamma']]]}
+
+            ])
+        elif pl_model_index is not None:
+            fitting_kwargs_list.append([
+                'update_settings',
+                {'lens_remove_fixed': [[pl_model_index, ['gamma']]]}
+            ])
+
+        for multiplier in pso_range_multipliers:
+            # if multiplier in [10., 1.]:
+            #     fitting_kwargs_list.append([
+            #         'update_settings',
+            #         {'lens_add_fixed': [[index, ['gamma']]]}
+            #
+            #     ])
+            # elif multiplier == .1:
+            #     fitting_kwargs_list.append([
+            #         'update_settings',
+            #         {'lens_remove_fixed': [[index, ['gamma']]]}
+            #     ])
+
+            fitting_kwargs_list.append([
+                'PSO', self._get_pso_kwargs(sigma_scale=multiplier)
+            ])
+
+            if self.reconstruct_psf:
+                fitting_kwargs_list.append(
+                    ['psf_iteration',
+                     self._config.get_kwargs_psf_iteration()]
+                )
+
+        return fitting_kwargs_list
+
+    def _get_epoch_check(self, epoch_fitting_kwargs_list, min_epochs=1):
+        """
+        Get an 'epoch_check' entry for the fitting kwargs list. When
+        `Processor.swim` reaches this entry, it evaluates the best-fit log
+        likelihood and runs `epoch_fitting_kwargs_list` followed by another
+        check if `continue_epochs` decides so. If a numerics schedule is
+        used, the entry has the configured `kwargs_numerics` to evaluate the
+        likelihood with, so that the likelihoods of all the checks are
+        compared at the same numerics.
+
+        :param epoch_fitting_kwargs_list: fitting kwargs list of one epoch
+        :type epoch_fitting_kwargs_list: `list`
+        :param min_epochs: minimum number of epochs to run
+        :type min_epochs: `int`
+        :return: 'epoch_check' entry
+        :rtype: `list`
+        """
+        return ['epoch_check', {
+            'fitting_kwargs_list': epoch_fitting_kwargs_list,
+            'min_log_likelihood_gain': float(self.epoch_settings.get(
+                'min_log_likelihood_gain', 1.)),
+            'min_epochs': max(int(self.epoch_settings.get('min_epochs', 1)),
+                              min_epochs),
+            'max_epochs': int(self.epoch_settings.get('max_epochs', 4)),
+            'kwargs_numerics': self._get_configured_numerics()
+            if self._numerics_schedule else None,
+        }]
+
+    @staticmethod
+    def continue_epochs(epoch_log_likelihoods, min_log_likelihood_gain,
+                        min_epochs, max_epochs):
+        """
+        Decide whether to run another epoch at an 'epoch_check' entry.
+
+        :param epoch_log_likelihoods: best-fit log likelihoods before the
+            first epoch and after each completed epoch
+        :type epoch_log_likelihoods: `list`
+        :param min_log_likelihood_gain: minimum gain in the log likelihood
+            in the last epoch to run another one
+        :type min_log_likelihood_gain: `float`
+        :param min_epochs: minimum number of epochs
+        :type min_epochs: `int`
+        :param max_epochs: maximum number of epochs
+        :type max_epochs: `int`
+        :return: `True` to run another epoch
+        :rtype: `bool`
+        """
+        num_epochs = len(epoch_log_likelihoods) - 1
+
+        if num_epochs < min_epochs:
+            return True
+        if num_epochs >= max_epochs:
+            return False
+
+        return epoch_log_likelihoods[-1] - epoch_log_likelihoods[-2] \
+            >= min_log_likelihood_gain
+
+    @staticmethod
+    def insert_epoch(fitting_kwargs_list, index):
+        """
+        Insert the epoch of the 'epoch_check' entry at `index`, followed by
+        a copy of the check, right after the entry.
+
+        :param fitting_kwargs_list: fitting kwargs list
+        :type fitting_kwargs_list: `list`
+        :param index: index of the 'epoch_check' entry
+        :type index: `int`
+        :return: None
+        :rtype:
+        """
+        epoch_check = fitting_kwargs_list[index]
+        fitting_kwargs_list[index + 1:index + 1] = \
+            deepcopy(epoch_check[1]['fitting_kwargs_list']) + [epoch_check]
+
     def get_sampling_sequence(self):
         """
         Get the sampling sequence. Currently only MCMC with emcee is supported.
@@ -282,13 +571,21 @@ class Recipe(object):
                                                             'init_samples'])
 
                         fitting_kwargs_list[-1][1]['re_use_samples'] = True
+
+                # stream the samples into file every `save_every` steps
+                if self._config.settings['fitting']['mcmc_settings'].get(
+                        'save_every') is not None:
+                    fitting_kwargs_list[-1][1]['save_every'] = int(
+                        self._config.settings['fitting']['mcmc_settings'][
+                            'save_every'])
             else:
                 raise ValueError("{} sampler not implemented yet!".format(
                     self._config.settings['fitting']['sampler']))
 
         return fitting_kwargs_list
 
-    def get_galaxy_galaxy_recipe(self, kwargs_data_joint, epochs=2):
+    def get_galaxy_galaxy_recipe(self, kwargs_data_joint, epochs=2,
+                                 arc_masks=None):
         """
         Get the pre-sampling optimization routine for a galaxy-galaxy lens.
         PSF iteration is not added.
@@ -297,148 +594,162 @@ class Recipe(object):
         :type kwargs_data_joint:
         :param epochs: number of times to repeat the fitting sequence
         :type epochs: `int`
+        :param arc_masks: precomputed arc masks, computed from the images in
+            `kwargs_data_joint` if `None`
+        :type arc_masks: `list` of `ndarray`
         :return:
         :rtype:
         """
         fitting_kwargs_list = []
 
         if self.do_pso:
-            arc_masks = []
             masks = self._config.get_masks()
-            for band_item, mask in zip(kwargs_data_joint['multi_band_list'],
-                                       masks):
-                image = band_item[0]['image_data']
-                arc_masks.append(self.get_arc_mask(image, mask=mask))
-
-            pl_model_index = self._get_power_law_model_index()
-            external_shear_model_index = self._get_external_shear_model_index()
-            shapelets_index = self._get_shapelet_model_index()
-
-            temp_constraints = self._config.get_kwargs_constraints()
-            for epoch in range(epochs):
-                # first fix everything else except for lens light and use arc
-                # mask to fit the lens light only. Join the centroids of lens
-                # and lens light
-                fitting_kwargs_list += [
-                    self.fix_params('lens'),
-                    self.fix_params('source'),
-                    ['update_settings',
-                     {'kwargs_likelihood': {
-                        'image_likelihood_mask_list': arc_masks}
-                      }],
-                    ['update_settings', {'kwargs_constraints': {
-                        'joint_lens_with_light': [[0, 0, ['center_x',
-                                                          'center_y']
-                                                   ]]}}],
-                    ['PSO', {'sigma_scale': 1.0,
-                             'n_particles': self._pso_num_particle,
-                             'n_iterations': self._pso_num_iteration,
-                             'threadCount': self._thread_count
-                             }]
-                ]
-
-                # unfix the source except for beta, keep lens fixed, fix lens
-                # light, use regular mask
-                fitting_kwargs_list += [
-                    self.unfix_params('source')
-                ]
-
-                # fix the shapelets beta parameter
-                if shapelets_index is not None:
-                    fitting_kwargs_list += [
-                        ['update_settings',
-                         {'source_add_fixed': [[shapelets_index, ['beta'],
-                                                [0.1]]]}]
-                    ]
-
-                fitting_kwargs_list += [
-                    # self.unfix_params('lens'),
-                    self.fix_params('lens_light'),
-                    ['update_settings', {'kwargs_likelihood': {
-                        'image_likelihood_mask_list': masks}}],
-                ]
-
-                # set lens parameter values to guess values, if provided
-                if self.guess_params['lens'] is not None:
-                    param_list = []
-                    for index, params in self.guess_params['lens'].items():
-                        param_list.append([index, list(params.keys()),
-                                           list(params.values())])
-
-                    fitting_kwargs_list += [
-                        ['update_settings', {'lens_add_fixed': param_list}]
-                    ]
-
-                # optimize for the source only
-                fitting_kwargs_list += [
-                    # self.fix_params('lens'),
-                    ['PSO', {'sigma_scale': 1.0,
-                             'n_particles': self._pso_num_particle,
-                             'n_iterations': self._pso_num_iteration,
-                             'threadCount': self._thread_count
-                             }],
-                ]
-
-                # unfix the central deflector parameters, keep beta fixed
-                fitting_kwargs_list += [
-                    self.unfix_params('lens'),
-                    self.fix_params('lens', external_shear_model_index)
-                ]
+            if arc_masks is None:
+                arc_masks = self.get_arc_masks(
+                    [band_item[0]['image_data'] for band_item
+                     in kwargs_data_joint['multi_band_list']],
+                    masks=masks)
+
+            if self.epoch_settings is None:
+                for epoch in range(epochs):
+                    fitting_kwargs_list += self._set_epoch_settings(
+                        self._get_galaxy_galaxy_epoch(arc_masks, masks),
+                        epoch)
+            else:
+                fitting_kwargs_list += self._set_epoch_settings(
+                    self._get_galaxy_galaxy_epoch(arc_masks, masks), 0)
+                fitting_kwargs_list.append(self._get_epoch_check(
+                    self._set_epoch_settings(
+                        self._get_galaxy_galaxy_epoch(arc_masks, masks))))
 
-                # optimize for lens and source together, fix power-law gamma to
-                # 2, as all the lens parameters are unfixed
-                if pl_model_index is not None:
-                    fitting_kwargs_list += [['update_settings',
-                                             {'lens_add_fixed': [
-                                                 [pl_model_index, ['gamma'],
-                                                  [2.]]
-                                             ]}]]
+            fitting_kwargs_list += self._reset_epoch_settings()
 
-                fitting_kwargs_list += [
-                    ['PSO', {'sigma_scale': 1.0,
-                             'n_particles': self._pso_num_particle,
-                             'n_iterations': self._pso_num_iteration,
-                             'threadCount': self._thread_count
-                             }],
-                ]
+            # fitting_kwargs_list += self.get_default_recipe()
 
-                # unfix the shapelets beta parameter
-                if shapelets_index is not None:
-                    fitting_kwargs_list += [
-                        ['update_settings',
-                         {'source_remove_fixed': [
-                             [shapelets_index, ['beta']]]}]
-                    ]
+        return fitting_kwargs_list
 
-                # finally optimize with all of lens, lens light and source free
-                fitting_kwargs_list += [
-                    ['PSO', {'sigma_scale': 1.0,
-                             'n_particles': self._pso_num_particle,
-                             'n_iterations': self._pso_num_iteration,
-                             'threadCount': self._thread_count
-                             }],
-                    self.unfix_params('lens_light'),
-                    ['PSO', {'sigma_scale': 1.0,
-                             'n_particles': self._pso_num_particle,
-                             'n_iterations': self._pso_num_iteration,
-                             'threadCount': self._thread_count
-                             }],
-                ]
+    def _get_galaxy_galaxy_epoch(self, arc_masks, masks):
+        """
+        Get the fitting kwargs list for one epoch of the galaxy-galaxy
+        recipe.
 
-                # finally, relax shear parameters for MCMC later
-                # disjoin lens and lens light centroids
-                fitting_kwargs_list += [
-                    self.unfix_params('lens'),
-                    ['update_settings',
-                     {'kwargs_constraints': temp_constraints}
-                     ],
-                ]
+        :param arc_masks: arc masks
+        :type arc_masks: `list` of `ndarray`
+        :param masks: likelihood masks
+        :type masks: `list` of `ndarray`
+        :return: fitting kwargs list
+        :rtype: `list`
+        """
+        fitting_kwargs_list = []
 
-            # fitting_kwargs_list += self.get_default_recipe()
+        pl_model_index = self._get_power_law_model_index()
+        external_shear_model_index = self._get_external_shear_model_index()
+        shapelets_index = self._get_shapelet_model_index()
+
+        temp_constraints = self._config.get_kwargs_constraints()
+
+        # first fix everything else except for lens light and use arc
+        # mask to fit the lens light only. Join the centroids of lens
+        # and lens light
+        fitting_kwargs_list += [
+            self.fix_params('lens'),
+            self.fix_params('source'),
+            ['update_settings',
+             {'kwargs_likelihood': {
+                'image_likelihood_mask_list': arc_masks}
+              }],
+            ['update_settings', {'kwargs_constraints': {
+                'joint_lens_with_light': [[0, 0, ['center_x',
+                                                  'center_y']
+                                           ]]}}],
+            ['PSO', self._get_pso_kwargs()]
+        ]
+
+        # unfix the source except for beta, keep lens fixed, fix lens
+        # light, use regular mask
+        fitting_kwargs_list += [
+            self.unfix_params('source')
+        ]
+
+        # fix the shapelets beta parameter
+        if shapelets_index is not None:
+            fitting_kwargs_list += [
+                ['update_settings',
+                 {'source_add_fixed': [[shapelets_index, ['beta'],
+                                        [0.1]]]}]
+            ]
+
+        fitting_kwargs_list += [
+            # self.unfix_params('lens'),
+            self.fix_params('lens_light'),
+            ['update_settings', {'kwargs_likelihood': {
+                'image_likelihood_mask_list': masks}}],
+        ]
+
+        # set lens parameter values to guess values, if provided
+        if self.guess_params['lens'] is not None:
+            param_list = []
+            for index, params in self.guess_params['lens'].items():
+                param_list.append([index, list(params.keys()),
+                                   list(params.values())])
+
+            fitting_kwargs_list += [
+                ['update_settings', {'lens_add_fixed': param_list}]
+            ]
+
+        # optimize for the source only
+        fitting_kwargs_list += [
+            # self.fix_params('lens'),
+            ['PSO', self._get_pso_kwargs()],
+        ]
+
+        # unfix the central deflector parameters, keep beta fixed
+        fitting_kwargs_list += [
+            self.unfix_params('lens'),
+            self.fix_params('lens', external_shear_model_index)
+        ]
+
+        # optimize for lens and source together, fix power-law gamma to
+        # 2, as all the lens parameters are unfixed
+        if pl_model_index is not None:
+            fitting_kwargs_list += [['update_settings',
+                                     {'lens_add_fixed': [
+                                         [pl_model_index, ['gamma'],
+                                          [2.]]
+                                     ]}]]
+
+        fitting_kwargs_list += [
+            ['PSO', self._get_pso_kwargs()],
+        ]
+
+        # unfix the shapelets beta parameter
+        if shapelets_index is not None:
+            fitting_kwargs_list += [
+                ['update_settings',
+                 {'source_remove_fixed': [
+                     [shapelets_index, ['beta']]]}]
+            ]
+
+        # finally optimize with all of lens, lens light and source free
+        fitting_kwargs_list += [
+            ['PSO', self._get_pso_kwargs()],
+            self.unfix_params('lens_light'),
+            ['PSO', self._get_pso_kwargs()],
+        ]
+
+        # finally, relax shear parameters for MCMC later
+        # disjoin lens and lens light centroids
+        fitting_kwargs_list += [
+            self.unfix_params('lens'),
+            ['update_settings',
+             {'kwargs_constraints': temp_constraints}
+             ],
+        ]
 
         return fitting_kwargs_list
 
-    def get_arc_mask(self, image, clear_center=0.4, mask=None):
+    def get_arc_mask(self, image, clear_center=0.4, mask=None,
+                     dilation_size=8):
         """
         Create a mask for lensed galaxy arcs from the image of the lens. The
         lens galaxy is required to be close to the center (within a few
@@ -452,82 +763,208 @@ class Recipe(object):
             region is masked out in `mask`, then a circle with radius
             `clear_center` will be unmasked.
         :type mask: `ndarray`
+        :param dilation_size: size in pixels of the structuring elements to
+            dilate the arcs radially outward
+        :type dilation_size: `int`
         :return: mask for the lensed galaxy arcs
         :rtype: `ndarray`
         """
-        # take x- and y- gradient of the image
-        x_diff = np.diff(image, axis=1)[1:, :]
-        y_diff = np.diff(image, axis=0)[:, 1:]
+        return self.get_arc_masks([image], clear_center=clear_center,
+                                  masks=None if mask is None else [mask],
+                                  dilation_size=dilation_size)[0]
+
+    def get_arc_masks(self, images, clear_center=0.4, masks=None,
+                      dilation_size=8):
+        """
+        Create the masks for lensed galaxy arcs from the images of the lens
+        in multiple bands, see `get_arc_mask`. The images with the same shape
+        are processed together in a single batch. The images can have any
+        size, but the lens galaxy needs to be close to the center.
+
+        :param images: images of the lensing system
+        :type images: `list` of `ndarray`
+        :param clear_center: radius of the central region to **not** mask
+        :type clear_center: `float`
+        :param masks: masks to multiply with the arc masks
+        :type masks: `list` of `ndarray`
+        :param dilation_size: size in pixels of the structuring elements to
+            dilate the arcs radially outward
+        :type dilation_size: `int`
+        :return: masks for the lensed galaxy arcs
+        :rtype: `list` of `ndarray`
+        """
+        clear_radius = int(clear_center / np.max(self._config.pixel_size))
+
+        shapes = [np.shape(image) for image in images]
+        arc_masks = [None] * len(images)
+
+        for shape in sorted(set(shapes)):
+            indices = [i for i, s in enumerate(shapes) if s == shape]
+            batch = np.array([images[i] for i in indices], dtype=float)
+
+            marked_map = self._get_arc_marked_map(batch, clear_radius)
+            dilated = self._dilate_radially(marked_map, dilation_size)
+
+            # increase the size by 1 along both axes to match the image size
+            # the mask is the negative of the marked pixel-map
+            batch_arc_masks = 1. - np.pad(dilated, ((0, 0), (0, 1), (0, 1)),
+                                          'minimum')
+
+            if masks is not None:
+                batch_arc_masks *= np.array([np.reshape(masks[i], shape)
+                                             for i in indices])
+
+                radius = self._get_arc_mask_grids(shape)[0]
+                batch_arc_masks[:, radius < clear_radius] = 1.
+
+            for i, arc_mask in zip(indices, batch_arc_masks):
+                arc_masks[i] = arc_mask
+
+        return arc_masks
+
+    def get_arc_mask_hash(self, image, clear_center=0.4, mask=None,
+                          dilation_size=8):
+        """
+        Get a hash of the image, mask, and parameters that an arc mask is
+        computed from, to identify a cached arc mask.
+
+        :param image: image of the lensing system
+        :type image: `ndarray`
+        :param clear_center: radius of the central region to **not** mask
+        :type clear_center: `float`
+        :param mask: a mask to multiply with the arc mask
+        :type mask: `ndarray`
+        :param dilation_size: size in pixels of the structuring elements to
+            dilate the arcs radially outward
+        :type dilation_size: `int`
+        :return: hash
+        :rtype: `str`
+        """
+        image = np.ascontiguousarray(image, dtype=float)
+
+        arc_mask_hash = hashlib.sha1()
+        arc_mask_hash.update(repr((
+            image.shape, clear_center, dilation_size,
+            float(np.max(self._config.pixel_size)), mask is None
+        )).encode())
+        arc_mask_hash.update(image.tobytes())
+        if mask is not None:
+            arc_mask_hash.update(np.ascontiguousarray(
+                np.reshape(mask, image.shape), dtype=float).tobytes())
+
+        return arc_mask_hash.hexdigest()
+
+    @classmethod
+    def _get_arc_mask_grids(cls, shape):
+        """
+        Get the radius, and the cosine and the sine of the polar angle, of
+        the pixels in a grid centered at the center of the grid. The grids
+        are cached for each shape.
+
+        :param shape: shape of the grid
+        :type shape: `tuple`
+        :return: radius, cosine, sine
+        :rtype: `ndarray`, `ndarray`, `ndarray`
+        """
+        if shape not in cls._arc_mask_grids:
+            y, x = np.indices(shape, dtype=float)
+            x -= (shape[1] - 1) / 2.
+            y -= (shape[0] - 1) / 2.
+            r = np.sqrt(x * x + y * y)
+
+            softening = 1e-10
+            grids = (r, x / (r + softening), y / (r + softening))
+            for grid in grids:
+                grid.setflags(write=False)
+
+            cls._arc_mask_grids[shape] = grids
+
+        return cls._arc_mask_grids[shape]
+
+    def _get_arc_marked_map(self, images, clear_radius):
+        """
+        Mark the inner edges of the arcs, where the radial gradient of the
+        images is positive, and remove the marked regions created by noise.
+
+        :param images: images with the same shape stacked along the first
+            axis
+        :type images: `ndarray`
+        :param clear_radius: radius in pixels of the central region to not
+            mark
+        :type clear_radius: `int`
+        :return: marked-pixel maps, smaller by 1 pixel along the image axes
+        :rtype: `ndarray`
+        """
+        # take x- and y- gradient of the images
+        x_diff = np.diff(images, axis=2)[:, 1:, :]
+        y_diff = np.diff(images, axis=1)[:, :, 1:]
 
-        w = len(x_diff) - 1
-        x, y = np.meshgrid(np.linspace(-w / 2, w / 2, int(w + 1)),
-                           np.linspace(-w / 2, w / 2, int(w + 1)))
-        r = np.sqrt(x * x + y * y)
+        r, cos, sin = self._get_arc_mask_grids(x_diff.shape[1:])
 
-        # compute the radial gradient of the image
-        softening = 1e-10
-        radial_gradient = -(x_diff * x / (r + softening)
-                            + y_diff * y / (r + softening))
+        # compute the radial gradient of the images
+        radial_gradient = -(x_diff * cos + y_diff * sin)
 
-        # convert radial_gradient to binary map (+ve to 0 and -ve to 1).
         # where the arc starts when going radially outward, the gradient
         # will be +ve, so this operation marks the inner edge of the arcs
-        radial_gradient[np.isnan(radial_gradient)] = 0
-        radial_gradient[radial_gradient > 0] = 1
-        radial_gradient[radial_gradient <= 0] = 0
-        radial_gradient = 1 - radial_gradient
+        with np.errstate(invalid='ignore'):
+            marked_map = ~(radial_gradient > 0)
 
         # unmark any marked pixels from the central region
-        radial_gradient[r < int(clear_center /
-                                np.max(self._config.pixel_size))] = 0
+        marked_map[:, r < clear_radius] = False
 
         # remove connected regions with area less than 5 pixels to remove
-        # masked regions created by noise
-        structure = np.ones((3, 3))
-        filtered_map = deepcopy(radial_gradient)
-        id_regions, num_ids = ndimage.label(filtered_map, structure=structure)
-        id_sizes = np.array(ndimage.sum(radial_gradient, id_regions,
-                                        range(num_ids + 1)))
-        area_mask = (id_sizes < 5)
-        filtered_map[area_mask[id_regions]] = 0
-
-        # dilate the binary marked-pixel map
-        dilated = np.zeros_like(filtered_map)
-
+        # masked regions created by noise. The regions are not connected
+        # across the images.
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[1] = True
+        id_regions, _ = ndimage.label(marked_map, structure=structure)
+        id_sizes = np.bincount(id_regions.ravel())
+        marked_map[(id_sizes < 5)[id_regions]] = False
+
+        return marked_map
+
+    @staticmethod
+    def _dilate_radially(marked_maps, dilation_size):
+        """
+        Dilate the marked-pixel maps radially outward, using a separate
+        structuring element for each of the four quadrants around the
+        center.
+
+        :param marked_maps: marked-pixel maps stacked along the first axis
+        :type marked_maps: `ndarray`
+        :param dilation_size: size in pixels of the structuring elements
+        :type dilation_size: `int`
+        :return: dilated maps
+        :rtype: `ndarray`
+        """
         # create structural elements for dilating the image radially outward
         # in each of the four quadrants separately
-        a2 = np.tril(np.ones((8, 8)))
-        np.fill_diagonal(a2, 0)
+        a2 = np.tril(np.ones((dilation_size, dilation_size), dtype=bool))
+        np.fill_diagonal(a2, False)
         a2 = np.flip(a2, axis=1)  # 1's at lower than anti-diagonal
         a4 = np.flip(a2)  # 1's at upper than anti-diagonal
         a3 = np.rot90(a2)  # 1's at upper than the diagonal
         a1 = np.flip(a3)  # 1's at lower than the diagonal
 
-        dilated[:50, :50] = ndimage.binary_dilation(filtered_map[:50, :50], a4)
-        dilated[:50, 50:] = ndimage.binary_dilation(filtered_map[:50, 50:], a3)
-        dilated[50:, :50] = ndimage.binary_dilation(filtered_map[50:, :50], a1)
-        dilated[50:, 50:] = ndimage.binary_dilation(filtered_map[50:, 50:], a2)
-
-        # increase the size by 1 along both axes to match the image size
-        # the mask is the negative of the marked pixel-map
-        arc_mask = 1 - np.pad(dilated, ((0, 1), (0, 1)), 'minimum')
-
-        # check for bad values
-        arc_mask[arc_mask > 0] = 1
-        arc_mask[arc_mask <= 0] = 0
-
-        if mask is not None:
-            arc_mask *= mask
-
-            w = len(arc_mask) - 1
-            x, y = np.meshgrid(np.linspace(-w / 2, w / 2, int(w + 1)),
-                               np.linspace(-w / 2, w / 2, int(w + 1)))
-            r = np.sqrt(x * x + y * y)
-
-            arc_mask[r < int(clear_center /
-                             np.max(self._config.pixel_size))] = 1
-
-        return arc_mask
+        # the quadrants are split at the center, the pixels on the central
+        # row and column belong to the upper and left quadrants
+        ny, nx = marked_maps.shape[1:]
+        upper, lower = slice(None, (ny - 1) // 2 + 1), \
+            slice((ny - 1) // 2 + 1, None)
+        left, right = slice(None, (nx - 1) // 2 + 1), \
+            slice((nx - 1) // 2 + 1, None)
+
+        dilated = np.zeros_like(marked_maps)
+        for rows, columns, structure in [(upper, left, a4),
+                                         (upper, right, a3),
+                                         (lower, left, a1),
+                                         (lower, right, a2)]:
+            # no structure across the images, so that each image is dilated
+            # separately
+            dilated[:, rows, columns] = ndimage.binary_dilation(
+                marked_maps[:, rows, columns], structure[np.newaxis])
+
+        return dilated
 
     def fix_params(self, model_component, index=None):
         """
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for catalog module.
+"""
+from pathlib import Path
+import os
+import sqlite3
+import pytest
+import numpy as np
+
+from dolphin.analysis.catalog import Catalog
+
+_ROOT_DIR = Path(__file__).resolve().parents[2]
+_TEST_IO_DIR = _ROOT_DIR / 'io_directory_example'
+
+
+class TestCatalog(object):
+
+    def setup_class(self):
+        self.catalog = Catalog(_TEST_IO_DIR)
+        self.file_system = self.catalog.file_system
+
+        self.output = {
+            'settings': {'some': 'settings'},
+            'kwargs_result': {
+                'kwargs_lens': [{'theta_E': 1.2, 'center_x': 0.},
+                                {'gamma_ext': 0.05}],
+                'kwargs_source': [{'R_sersic': 0.3}],
+                'kwargs_ps': [],
+                'kwargs_special': {},
+            },
+            'fit_output': [
+                ['PSO',
+                 [np.array([-30., -20.]), np.ones((2, 3)), np.ones((2, 3))],
+                 ['a', 'b', 'c']
+                 ],
+                ['EMCEE',
+                 np.ones((10, 3)),
+                 ['a', 'b', 'c'],
+                 -np.arange(10.) - 5.
+                 ]
+            ]
+        }
+
+    @classmethod
+    def teardown_class(cls):
+        file_system = Catalog(_TEST_IO_DIR).file_system
+        for model_id in ['catalog_test', 'catalog_test_2']:
+            os.remove(file_system.get_output_file_path(
+                'test_lens', model_id, file_type='h5'))
+        os.remove(file_system.get_catalog_file_path())
+
+    def test_update(self):
+        """
+        Test `update`, `get_table`, and `get_parameter_values` methods.
+        :return:
+        :rtype:
+        """
+        self.file_system.save_output('test_lens', 'catalog_test',
+                                     self.output)
+        assert self.catalog.update() >= 1
+        assert self.catalog.update() == 0
+
+        table = self.catalog.get_table(model_id='catalog_test')
+        assert len(table) == 1
+        assert table[0]['lens_name'] == 'test_lens'
+        assert table[0]['fitting_stages'] == ['PSO', 'EMCEE']
+        assert table[0]['chi2'] == 10.
+        assert table[0]['kwargs_result'] == self.output['kwargs_result']
+
+        self.file_system.save_output('test_lens', 'catalog_test_2',
+                                     self.output)
+        assert self.catalog.update() == 1
+
+        values = self.catalog.get_parameter_values('kwargs_lens', 0,
+                                                   'theta_E',
+                                                   lens_name='test_lens')
+        assert values == {('test_lens', 'catalog_test'): 1.2,
+                          ('test_lens', 'catalog_test_2'): 1.2}
+
+        os.remove(self.file_system.get_output_file_path(
+            'test_lens', 'catalog_test_2', file_type='h5'))
+        assert self.catalog.update() == 0
+        assert self.catalog.get_table(model_id='catalog_test_2') == []
+        self.file_system.save_output('test_lens', 'catalog_test_2',
+                                     self.output)
+
+    def test_connect(self):
+        """
+        Test that `_connect` commits the changes and closes the connection.
+        :return:
+        :rtype:
+        """
+        with self.catalog._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS connect_test '
+                               '(value INTEGER)')
+            connection.execute('INSERT INTO connect_test VALUES (1)')
+
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')
+
+        with self.catalog._connect() as connection:
+            assert connection.execute(
+                'SELECT COUNT(*) FROM connect_test').fetchone()[0] >= 1
+            connection.execute('DROP TABLE connect_test')
+
+    def test_get_chi2(self):
+        """
+        Test `get_chi2` method.
+        :return:
+        :rtype:
+        """
+        assert self.catalog.get_chi2(self.output['fit_output'][:1]) == 20.
+        assert self.catalog.get_chi2(self.output['fit_output']) == 10.
+        assert self.catalog.get_chi2([]) is None
+
+    def test_flatten_kwargs_result(self):
+        """
+        Test `flatten_kwargs_result` method.
+        :return:
+        :rtype:
+        """
+        rows = self.catalog.flatten_kwargs_result(
+            self.output['kwargs_result'])
+
+        assert ('kwargs_lens', 1, 'gamma_ext', 0.05) in rows
+        assert len(rows) == 4
@@ -3,8 +3,11 @@
 Tests for output module.
 """
 from pathlib import Path
+import os
+import resource
 import pytest
 import numpy as np
+import numpy.testing as npt
 import matplotlib.pyplot as plt
 
 from dolphin.processor import Processor
@@ -94,6 +97,88 @@ class TestOutput(object):
                       == save_dict['fit_output'][0][3])
         assert self.output.kwargs_result == save_dict['kwargs_result']
         assert self.output.model_settings == save_dict['settings']
+        assert self.output.stage_metrics == []
+
+    def test_get_stage_metrics(self):
+        """
+        Test `get_stage_metrics` method.
+
+        :return:
+        :rtype:
+        """
+        stage_metrics = [
+            {'fitting_type': 'PSO', 'wall_time': 2., 'rank': [0],
+             'cpu_time': [1.5], 'likelihood_evaluations': [100],
+             'peak_rss': [1024], 'evaluations_per_second': 50.},
+            {'fitting_type': 'EMCEE', 'wall_time': 4., 'rank': [0],
+             'cpu_time': [3.5], 'likelihood_evaluations': [400],
+             'peak_rss': [2048], 'evaluations_per_second': 100.},
+        ]
+        save_dict = {
+            'settings': {'some': 'settings'},
+            'kwargs_result': {},
+            'fit_output': [['EMCEE', [[2, 2], [3, 3]], ['param1', 'param2'],
+                            [0.5, 0.2]]],
+            'stage_metrics': stage_metrics,
+        }
+        self.processor.file_system.save_output('test', 'stage_metrics_test',
+                                               save_dict)
+
+        assert self.output.get_stage_metrics(
+            'test', 'stage_metrics_test') == stage_metrics
+        assert self.output.get_stage_metrics(
+            'test', 'stage_metrics_test',
+            fitting_type='EMCEE') == stage_metrics[1:]
+        assert self.output.stage_metrics == stage_metrics
+
+    def test_load_output_cache(self):
+        """
+        Test that the cache of the loaded outputs is bounded, so that many
+        outputs can be loaded under a low file descriptor limit.
+
+        :return:
+        :rtype:
+        """
+        save_dict = {
+            'settings': {'some': 'settings'},
+            'kwargs_result': {},
+            'fit_output': [
+                ['PSO', [np.ones(5), np.ones((5, 2)), np.ones((5, 2))],
+                 ['a', 'b']],
+                ['EMCEE', np.arange(20.).reshape((10, 2)), ['a', 'b'],
+                 np.arange(10.)],
+            ]
+        }
+        model_ids = ['cache_test_{}'.format(i) for i in range(40)]
+        for model_id in model_ids:
+            self.processor.file_system.save_output('test', model_id,
+                                                   save_dict)
+
+        output = Output(_TEST_IO_DIR, output_cache_size=4)
+
+        num_open = len(os.listdir('/dev/fd'))
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (num_open + 16, hard_limit))
+
+        try:
+            for model_id in model_ids:
+                output.load_output('test', model_id)
+                # the fit output is only read when accessed
+                assert output._fit_output is None
+                npt.assert_array_equal(output.samples_mcmc,
+                                       save_dict['fit_output'][-1][1])
+                assert output.params_mcmc == ['a', 'b']
+
+            assert len(output._output_cache) == 4
+            assert list(output._output_cache.keys())[-1] == ('test',
+                                                             model_ids[-1])
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (soft_limit, hard_limit))
+            for model_id in model_ids:
+                os.remove(self.processor.file_system.get_output_file_path(
+                    'test', model_id, file_type='h5'))
 
     def test_plot_model_overview(self):
         """
@@ -146,14 +231,65 @@ class TestOutput(object):
 
         plt.close(fig)
 
+        fig = self.output.plot_mcmc_trace('lens_system2', 'example', 2,
+                                          verbose=False, thin=2)
+
+        plt.close(fig)
+
+    def test_get_chain_statistics(self):
+        """
+        Test `get_chain_statistics` method.
+
+        :return:
+        :rtype:
+        """
+        statistics = self.output.get_chain_statistics('lens_system2',
+                                                      'example', 2)
+        chain = self.output.get_reshaped_emcee_chain('lens_system2',
+                                                     'example', 2)
+
+        num_walkers, num_step, num_params = chain.shape
+        for key in ['mean', 'median', 'std', 'q16', 'q84']:
+            assert statistics[key].shape == (num_params, num_step)
+
+        for i in [0, num_params - 1]:
+            for j in [0, num_step - 1]:
+                npt.assert_almost_equal(statistics['mean'][i, j],
+                                        np.mean(chain[:, j, i]))
+                npt.assert_almost_equal(statistics['median'][i, j],
+                                        np.median(chain[:, j, i]))
+                npt.assert_almost_equal(statistics['std'][i, j],
+                                        np.std(chain[:, j, i]))
+                npt.assert_almost_equal(statistics['q84'][i, j],
+                                        np.percentile(chain[:, j, i], 84.))
+
+        statistics = self.output.get_chain_statistics('lens_system2',
+                                                      'example', 2, thin=3)
+        npt.assert_array_equal(statistics['steps'],
+                               np.arange(num_step)[::3])
+        npt.assert_almost_equal(statistics['q16'][:, 1],
+                                np.percentile(chain[:, 3, :], 16., axis=0))
+
     def test_get_reshaped_emcee_chain(self):
         """
         Test `get_reshaped_emcee_chain` method.
         :return:
         :rtype:
         """
-        self.output.get_reshaped_emcee_chain('lens_system2',
-                                             'example', 2)
+        chain = self.output.get_reshaped_emcee_chain('lens_system2',
+                                                     'example', 2)
+        samples = self.output.samples_mcmc
+
+        num_walkers = chain.shape[0]
+        assert num_walkers == 2 * self.output.num_params_mcmc
+        assert np.shares_memory(chain, samples)
+        npt.assert_array_equal(chain[1, 2], samples[2 * num_walkers + 1])
+
+        # the second call uses the cached output
+        assert ('lens_system2', 'example') in self.output._output_cache
+        chain2 = self.output.get_reshaped_emcee_chain('lens_system2',
+                                                      'example', 2)
+        assert np.shares_memory(chain2, samples)
 
     def test_get_param_class(self):
         """
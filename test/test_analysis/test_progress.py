@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for progress module.
+"""
+from pathlib import Path
+import os
+
+from dolphin.analysis.progress import Progress
+from dolphin.processor.events import EventLog
+
+_ROOT_DIR = Path(__file__).resolve().parents[2]
+_TEST_IO_DIR = _ROOT_DIR / 'io_directory_example'
+
+
+class TestProgress(object):
+
+    def setup_class(self):
+        self.progress = Progress(_TEST_IO_DIR)
+        self.file_system = self.progress.file_system
+
+        metrics = {'wall_time': 2., 'likelihood_evaluations': [100, 300]}
+
+        file_path = self.file_system.get_event_log_file_path(
+            'test_lens', 'progress_test')
+        with EventLog(file_path, 'test_lens', 'progress_test') as event_log:
+            event_log.write('swim_start', num_completed=0, num_stages=3)
+            event_log.write('stage_start', index=0, fitting_type='PSO')
+            event_log.write('stage_end', index=0, num_stages=3,
+                            metrics=metrics, best_log_likelihood=-50.,
+                            num_iterations=10)
+            event_log.write('stage_start', index=1, fitting_type='PSO')
+            event_log.write('error', exception='ValueError',
+                            message='failed', traceback='')
+
+        # resumed from the checkpoint after the first entry
+        with EventLog(file_path, 'test_lens', 'progress_test',
+                      append=True) as event_log:
+            event_log.write('swim_start', num_completed=1, num_stages=3)
+            event_log.write('stage_start', index=1, fitting_type='PSO')
+            event_log.write('stage_end', index=1, num_stages=3,
+                            metrics=metrics, best_log_likelihood=-20.,
+                            num_iterations=10)
+            event_log.write('stage_start', index=2, fitting_type='MCMC')
+
+        # an incomplete last line
+        with open(file_path, 'a') as f:
+            f.write('{"time": ')
+
+        file_path = self.file_system.get_event_log_file_path(
+            'test_lens', 'progress_test_2')
+        with EventLog(file_path, 'test_lens',
+                      'progress_test_2') as event_log:
+            event_log.write('swim_start', num_completed=0, num_stages=1)
+            event_log.write('stage_start', index=0, fitting_type='PSO')
+            event_log.write('stage_end', index=0, num_stages=1,
+                            metrics=metrics, best_log_likelihood=-10.,
+                            num_iterations=10)
+            event_log.write('swim_end', wall_time=2.,
+                            best_log_likelihood=-9.)
+
+    @classmethod
+    def teardown_class(cls):
+        file_system = Progress(_TEST_IO_DIR).file_system
+        for model_id in ['progress_test', 'progress_test_2']:
+            os.remove(file_system.get_event_log_file_path('test_lens',
+                                                          model_id))
+
+    def test_get_table(self):
+        """
+        Test `get_table`, `read_events`, and `summarize_events` methods.
+        :return:
+        :rtype:
+        """
+        table = self.progress.get_table(lens_name='test_lens')
+        assert [row['model_id'] for row in table] == ['progress_test',
+                                                      'progress_test_2']
+
+        row = table[0]
+        assert row['status'] == 'running'
+        assert row['num_completed'] == 2
+        assert row['num_stages'] == 3
+        assert row['current_stage'] == 'MCMC'
+        assert row['best_log_likelihood'] == -20.
+        assert row['likelihood_evaluations'] == 800
+        assert row['evaluations_per_second'] == 200.
+        assert row['error'] is None
+
+        row = table[1]
+        assert row['status'] == 'completed'
+        assert row['best_log_likelihood'] == -9.
+        assert row['current_stage'] is None
+
+        assert self.progress.get_table(model_id='progress_test_2') == [row]
+        assert self.progress.get_table(lens_name='invalid') == []
+
+        events = self.progress.read_events(
+            self.file_system.get_event_log_file_path('test_lens',
+                                                     'progress_test'))
+        assert len(events) == 9
+
+        summary = self.progress.summarize_events(events[:5])
+        assert summary['status'] == 'failed'
+        assert summary['error'] == 'ValueError: failed'
+
+    def test_get_summary(self):
+        """
+        Test `get_summary` method.
+        :return:
+        :rtype:
+        """
+        summary = self.progress.get_summary(model_id='progress_test')
+        assert summary['num_runs'] == 1
+        assert summary['num_running'] == 1
+        assert summary['num_stages_completed'] == 2
+        assert summary['likelihood_evaluations'] == 800
+
+        table = self.progress.get_table()
+        summary = self.progress.get_summary()
+        assert summary['num_runs'] == len(table)
+        assert summary['num_runs'] == summary['num_running'] \
+            + summary['num_completed'] + summary['num_failed']
+        assert summary['elapsed_time'] >= 0.
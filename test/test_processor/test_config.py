@@ -2,10 +2,16 @@
 """
 Tests for config module.
 """
+import os
+import tempfile
 import pytest
+import h5py
 from copy import deepcopy
 import numpy as np
 from pathlib import Path
+from lenstronomy.Data.coord_transforms import Coordinates
+import lenstronomy.Util.mask_util as mask_util
+from lenstronomy.Util import simulation_util
 
 from dolphin.processor.config import Config
 from dolphin.processor.config import ModelConfig
@@ -32,7 +38,44 @@ class TestConfig(object):
         test_setting_file = _ROOT_DIR / 'io_directory_example' \
             / 'settings' / 'lens_system1_config.yml'
         config = Config()
-        config.load(str(test_setting_file.resolve()))
+        settings = config.load(str(test_setting_file.resolve()))
+
+        # the second load is served from the process-level cache
+        num_cached = len(Config._load_cache)
+        settings2 = config.load(str(test_setting_file.resolve()))
+        assert len(Config._load_cache) == num_cached
+        assert settings2 == settings
+        assert settings2 is not settings
+
+    def test_load_compiled_cache(self):
+        """
+        Test the compiled cache of the `load` method.
+        :return:
+        :rtype:
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file = os.path.join(temp_dir, 'test_config.yml')
+            with open(file, 'w') as f:
+                f.write('band: [F390W]\npixel_size: 0.04\n')
+
+            settings = Config.load(file, use_compiled_cache=True)
+            assert settings == {'band': ['F390W'], 'pixel_size': 0.04}
+
+            cache_path = Config.get_compiled_cache_path(file)
+            assert os.path.exists(cache_path)
+
+            stat = os.stat(file)
+            key = (os.path.abspath(file), stat.st_mtime, stat.st_size)
+            assert Config.read_compiled_cache(file, key) == settings
+
+            # a cache for an outdated version of the file is not used
+            assert Config.read_compiled_cache(file, key[:2] + (0,)) is None
+
+            Config._load_cache.clear()
+            assert Config.load(file, use_compiled_cache=True) == settings
+
+            os.remove(cache_path)
+            assert Config.read_compiled_cache(file, key) is None
 
 
 class TestModelConfig(object):
@@ -62,6 +105,38 @@ class TestModelConfig(object):
 
         assert test_config.settings is not None
 
+    def test_get_memoized(self):
+        """
+        Test memoization of the derived products with `get_memoized`.
+        :return:
+        :rtype:
+        """
+        config = ModelConfig(settings={
+            'band': ['F390W'],
+            'kwargs_numerics': {'supersampling_factor': [2]}
+        })
+
+        kwargs_numerics = config.get_kwargs_numerics()
+        assert kwargs_numerics[0]['supersampling_factor'] == 2
+        assert 'get_kwargs_numerics' in config._memo
+
+        # the returned value is a copy
+        kwargs_numerics[0]['supersampling_factor'] = 5
+        assert config.get_kwargs_numerics()[0]['supersampling_factor'] == 2
+
+        # in-place changes of the settings invalidate the memoized values
+        config.settings['kwargs_numerics']['supersampling_factor'] = [4]
+        assert config.get_kwargs_numerics()[0]['supersampling_factor'] == 4
+
+        config.settings['kwargs_numerics']['supersampling_factor'][0] = 3
+        assert config.get_kwargs_numerics()[0]['supersampling_factor'] == 3
+
+        # copies of the settings are plain containers
+        assert type(deepcopy(config.settings)['kwargs_numerics']) is dict
+
+        config.settings = {'band': ['F390W', 'F555W']}
+        assert len(config.get_kwargs_numerics()) == 2
+
     def test_pixel_size(self):
         """
         Test the `pixel_size` property.
@@ -340,6 +415,116 @@ class TestModelConfig(object):
         assert masks3[1][5, 0:6].tolist() == [0., 0., 1., 1., 1., 1.]
         assert masks3[1][5, -6:].tolist() == [1., 1., 1., 1., 0., 0.]
 
+    def test_load_mask_file(self):
+        """
+        Test `load_mask_file` method and masks referenced from files in
+        `get_masks`.
+        :return:
+        :rtype:
+        """
+        mask = np.zeros((4, 4))
+        mask[1:3, 1:3] = 1.
+
+        with tempfile.TemporaryDirectory() as data_directory:
+            np.save(os.path.join(data_directory, 'mask.npy'), mask)
+            with h5py.File(os.path.join(data_directory, 'mask.h5'),
+                           'w') as f:
+                f.create_dataset('mask', data=mask)
+            with h5py.File(os.path.join(data_directory, 'no_mask.h5'),
+                           'w') as f:
+                f.create_dataset('image', data=mask)
+
+            config = ModelConfig(settings={
+                'band': ['F390W', 'F555W'],
+                'mask': {'provided': ['mask.npy', 'mask.h5']}
+            }, data_directory=data_directory)
+
+            masks = config.get_masks()
+            assert len(masks) == 2
+            for n in range(2):
+                assert np.all(masks[n] == mask)
+
+            # a single file has a 2D mask for one band, or a 3D stack of
+            # the masks of all the bands
+            np.save(os.path.join(data_directory, 'masks.npy'),
+                    np.stack([mask, 1. - mask]))
+
+            config.settings['mask']['provided'] = 'masks.npy'
+            masks = config.get_masks()
+            assert len(masks) == 2
+            assert np.all(masks[0] == mask)
+            assert np.all(masks[1] == 1. - mask)
+
+            with pytest.raises(ValueError):
+                config.settings['mask']['provided'] = 'mask.npy'
+                config.get_masks()
+
+            config.settings['band'] = ['F390W']
+            masks = config.get_masks()
+            assert len(masks) == 1
+            assert np.all(masks[0] == mask)
+
+            with pytest.raises(ValueError):
+                config.settings['mask']['provided'] = 'masks.npy'
+                config.get_masks()
+
+            np.save(os.path.join(data_directory, 'mask_1d.npy'), mask[0])
+            with pytest.raises(ValueError):
+                config.settings['mask']['provided'] = 'mask_1d.npy'
+                config.get_masks()
+
+            config.settings['band'] = ['F390W', 'F555W']
+
+            config.settings['mask'] = {
+                'size': [4, 4],
+                'ra_at_xy_0': [-0.06, -0.06],
+                'dec_at_xy_0': [-0.06, -0.06],
+                'transform_matrix': [[[0.04, 0.], [0., 0.04]]] * 2,
+                'radius': [1., 1.],
+                'centroid_offset': [[0., 0.], [0., 0.]],
+                'custom_mask': ['mask.h5', None]
+            }
+            masks = config.get_masks()
+            assert np.all(masks[0] == mask)
+            assert np.all(masks[1] == 1.)
+
+            with pytest.raises(ValueError):
+                config.load_mask_file('no_mask.h5')
+
+            with pytest.raises(ValueError):
+                config.load_mask_file('mask.txt')
+
+    def test_rasterize_circles(self):
+        """
+        Test `rasterize_circles` method against `mask_util.mask_center_2d`.
+        :return:
+        :rtype:
+        """
+        config = ModelConfig(settings={
+            'band': ['F390W'],
+            'lens_option': {'centroid_init': [0.03, -0.02]}
+        })
+        coords = Coordinates(np.array([[-0.04, 0.01], [0.01, 0.04]]),
+                             1.2, -1.2)
+        x_coords, y_coords = coords.coordinate_grid(60, 60)
+
+        # the small regions are rasterized over pixel windows, the large
+        # one over the full grid
+        for regions in [[[0.1, 0.2, 0.15], [-1.1, 1.0, 0.2], [3., 3., 0.1]],
+                        [[0., 0., 1.5]]]:
+            expected = np.zeros((60, 60), dtype=bool)
+            for region in regions:
+                expected |= mask_util.mask_center_2d(
+                    0.03 + region[0], -0.02 + region[1], region[2],
+                    x_coords, y_coords) == 0
+
+            mask = config.rasterize_circles(coords, x_coords, y_coords,
+                                            regions)
+            assert np.all(mask == expected)
+
+        assert not np.any(config.rasterize_circles(coords, x_coords,
+                                                   y_coords, []))
+
     def test_get_kwargs_psf_iteration(self):
         """
         Test `get_psf_iteration` method.
@@ -399,6 +584,128 @@ class TestModelConfig(object):
         for kwargs_numerics_band in kwargs_numerics:
             assert kwargs_numerics_band['supersampling_factor'] == 3
 
+        config.settings['kwargs_numerics']['supersampling_convolution'] = [
+            True]
+        config.settings['kwargs_numerics']['supersampling_kernel_size'] = [5]
+        kwargs_numerics = config.get_kwargs_numerics()
+        assert kwargs_numerics[0]['supersampling_convolution']
+        assert kwargs_numerics[0]['supersampling_kernel_size'] == 5
+
+    def test_get_kwargs_numerics_schedule(self):
+        """
+        Test `get_kwargs_numerics_schedule` method.
+        :return:
+        :rtype:
+        """
+        assert self.config.get_kwargs_numerics_schedule() == []
+
+        config = deepcopy(self.config)
+        config.settings['kwargs_numerics']['pso_epochs'] = [
+            {'supersampling_factor': [1]},
+            {'supersampling_factor': [2], 'supersampling_kernel_size': [5]}
+        ]
+        schedule = config.get_kwargs_numerics_schedule()
+        assert len(schedule) == 2
+        assert schedule[0][0]['supersampling_factor'] == 1
+        assert schedule[1][0]['supersampling_factor'] == 2
+        assert schedule[1][0]['supersampling_kernel_size'] == 5
+        assert schedule[1][0] == {'supersampling_factor': 2,
+                                  'supersampling_kernel_size': 5}
+
+        # the configured numerics are not changed
+        assert config.get_kwargs_numerics()[0]['supersampling_factor'] == 3
+
+        config.settings['kwargs_numerics']['pso_epochs'] = [
+            {'supersampling_factor': [1, 1]}]
+        with pytest.raises(ValueError):
+            config.get_kwargs_numerics_schedule()
+
+    def test_get_supersampled_indexes(self):
+        """
+        Test `get_supersampled_indexes` method.
+        :return:
+        :rtype:
+        """
+        kwargs_data = simulation_util.data_configure_simple(20, 0.1, 100.,
+                                                            1.)
+        kwargs_data['image_data'] = np.zeros((20, 20))
+        kwargs_data['image_data'][2, 3] = 100.
+
+        assert self.config.get_supersampled_indexes([kwargs_data]) is None
+        assert not self.config.use_arc_masks_for_supersampling()
+
+        config = deepcopy(self.config)
+        config.settings['mask'] = None
+        config.settings['lens_option'] = {'centroid_init': [0., 0.]}
+        config.settings['kwargs_numerics']['adaptive_supersampling'] = {
+            'radius': [0.3]}
+        assert config.use_arc_masks_for_supersampling()
+
+        indexes = config.get_supersampled_indexes([kwargs_data])[0]
+        assert indexes.dtype == bool
+        assert np.sum(indexes) == 32
+        assert not indexes[2, 3]
+
+        arc_mask = np.ones((20, 20))
+        arc_mask[15, 5:8] = 0.
+        config.settings['kwargs_numerics']['adaptive_supersampling'][
+            'threshold'] = [10.]
+        indexes = config.get_supersampled_indexes([kwargs_data],
+                                                  arc_masks=[arc_mask])[0]
+        assert np.sum(indexes) == 32 + 3 + 1
+        assert np.all(indexes[15, 5:8])
+        assert indexes[2, 3]
+
+    def test_get_psf_encircled_energy(self):
+        """
+        Test `get_psf_encircled_energy` method.
+        :return:
+        :rtype:
+        """
+        assert self.config.get_psf_encircled_energy() is None
+
+        config = deepcopy(self.config)
+        config.settings['psf_truncation'] = {'encircled_energy': [0.99]}
+        assert config.get_psf_encircled_energy() == [0.99]
+
+        config.settings['psf_truncation'] = {'encircled_energy': [0.9, 0.9]}
+        with pytest.raises(ValueError):
+            config.get_psf_encircled_energy()
+
+    def test_crop_to_mask(self):
+        """
+        Test `get_crop_boxes` and `set_crop_boxes` methods.
+        :return:
+        :rtype:
+        """
+        assert not self.config.crop_to_mask
+
+        mask = np.zeros((20, 20))
+        mask[5:12, 8:10] = 1.
+        config = deepcopy(self.config)
+        config.settings['mask'] = {'provided': [mask], 'crop_to_mask': True}
+        assert config.crop_to_mask
+
+        crop_boxes = config.get_crop_boxes([2])
+        assert crop_boxes == [[3, 14, 6, 12]]
+        assert config.get_crop_boxes([10]) == [[0, 20, 0, 20]]
+
+        config.set_crop_boxes(crop_boxes)
+        masks = config.get_masks()
+        assert masks[0].shape == (11, 6)
+        assert np.sum(masks[0]) == np.sum(mask)
+        assert config.get_uncropped_masks()[0].shape == (20, 20)
+        assert config.get_kwargs_likelihood()[
+            'image_likelihood_mask_list'][0].shape == (11, 6)
+
+        # the margin from the settings replaces the given one
+        config.settings['mask']['crop_margin'] = [0]
+        assert config.get_crop_boxes([2]) == [[5, 12, 8, 10]]
+
+        config.settings['mask']['provided'] = [np.zeros((20, 20))]
+        with pytest.raises(ValueError):
+            config.get_crop_boxes([2])
+
     def test_get_point_source_params(self):
         """
         Test `get_point_source_params` method.
@@ -3,13 +3,68 @@
 Tests for data module.
 """
 from pathlib import Path
+import os
+import json
+import shutil
+from copy import deepcopy
+import yaml
+import pytest
+import numpy as np
+import numpy.testing as npt
 
 from dolphin.processor.core import Processor
+from dolphin.processor.fitting import FittingSequence
+from dolphin.processor.config import ModelConfig
 
 _ROOT_DIR = Path(__file__).resolve().parents[2]
 _TEST_IO_DIR = _ROOT_DIR / 'io_directory_example'
 
 
+def _make_io_directory(io_directory, lens_list, settings_update=None):
+    """
+    Copy the data and the settings of lenses from the example input/output
+    directory, with a short PSO-only fit.
+
+    :param io_directory: path to the new input/output directory
+    :type io_directory: `Path`
+    :param lens_list: lens names
+    :type lens_list: `list`
+    :param settings_update: settings to update in the configs, the
+        dictionaries of the settings are updated key by key
+    :type settings_update: `dict`
+    :return: None
+    :rtype:
+    """
+    for directory in ['settings', 'logs', 'outputs']:
+        (io_directory / directory).mkdir()
+
+    for lens_name in lens_list:
+        shutil.copytree(_TEST_IO_DIR / 'data' / lens_name,
+                        io_directory / 'data' / lens_name)
+
+        config_file = '{}_config.yml'.format(lens_name)
+        with open(_TEST_IO_DIR / 'settings' / config_file, 'r') as f:
+            settings = yaml.safe_load(f)
+
+        settings['fitting'].update({
+            'pso': True,
+            'pso_settings': {'num_particle': 4, 'num_iteration': 2},
+            'psf_iteration': False,
+            'sampling': False,
+        })
+        if settings_update is not None:
+            for key, value in deepcopy(settings_update).items():
+                if isinstance(settings.get(key), dict):
+                    settings[key].update(value)
+                else:
+                    settings[key] = value
+        with open(io_directory / 'settings' / config_file, 'w') as f:
+            yaml.safe_dump(settings, f)
+
+    with open(io_directory / 'lens_list.txt', 'w') as f:
+        f.write('\n'.join(lens_list))
+
+
 class TestProcessor(object):
 
     def setup_class(self):
@@ -19,13 +74,259 @@ class TestProcessor(object):
     def teardown_class(cls):
         pass
 
-    def test_swim(self):
+    def test_swim(self, capsys):
         """
         Test `swim` method.
         :return:
         :rtype:
         """
         self.processor.swim('lens_system1', 'test')
+        # the progress is only written into the event log
+        assert capsys.readouterr().out == ''
+
+        stage_metrics = self.processor.file_system.load_output(
+            'lens_system1', 'test')['stage_metrics']
+        assert len(stage_metrics) > 0
+        for metrics in stage_metrics:
+            assert metrics['rank'] == [0]
+            assert metrics['wall_time'] >= 0
+            assert metrics['peak_rss'][0] > 0
+
+        with open(self.processor.file_system.get_event_log_file_path(
+                'lens_system1', 'test'), 'r') as f:
+            events = [json.loads(line) for line in f]
+        assert events[-1]['event'] == 'swim_end'
+        assert len([event for event in events
+                    if event['event'] == 'stage_end']) == len(stage_metrics)
+
+        # resume without an existing checkpoint starts from scratch
+        self.processor.swim('lens_system1', 'test', resume=True)
+        assert self.processor.file_system.load_checkpoint(
+            'lens_system1', 'test') is None
+
+    def test_swim_resume(self, tmp_path, monkeypatch):
+        """
+        Test `swim` method resuming from a checkpoint saved in the middle of
+        a run.
+        :return:
+        :rtype:
+        """
+        _make_io_directory(tmp_path, ['lens_system1'])
+        processor = Processor(tmp_path)
+
+        class Interrupt(Exception):
+            pass
+
+        pso = FittingSequence.pso
+        fixed_kwargs = []
+        interrupt = {'at': 3}
+
+        def interrupted_pso(fitting_sequence, *args, **kwargs):
+            fixed_kwargs.append(
+                deepcopy(fitting_sequence._updateManager.fixed_kwargs))
+            if len(fixed_kwargs) == interrupt['at']:
+                raise Interrupt()
+            return pso(fitting_sequence, *args, **kwargs)
+
+        monkeypatch.setattr(FittingSequence, 'pso', interrupted_pso)
+
+        with pytest.raises(Interrupt):
+            processor.swim('lens_system1', 'test', log=False,
+                           recipe_name='galaxy-galaxy')
+
+        checkpoint = processor.file_system.load_checkpoint('lens_system1',
+                                                           'test')
+        assert len(checkpoint['fit_output']) == 2
+        assert checkpoint['fitting_state'] is not None
+
+        # the resumed run starts at the interrupted PSO, with the parameters
+        # fixed without values at the results of the completed PSOs, not at
+        # the initial values
+        fixed_kwargs_interrupted = fixed_kwargs[-1]
+        fixed_kwargs.clear()
+        interrupt['at'] = 1
+
+        with pytest.raises(Interrupt):
+            processor.swim('lens_system1', 'test', log=False,
+                           recipe_name='galaxy-galaxy', resume=True)
+
+        assert fixed_kwargs[0] == fixed_kwargs_interrupted
+
+    def test_swim_epoch_checks(self, tmp_path, monkeypatch):
+        """
+        Test that the adaptive epoch checks evaluate the log likelihood at
+        the configured numerics when a numerics schedule changes the
+        numerics between the checks.
+        :return:
+        :rtype:
+        """
+        _make_io_directory(tmp_path, ['lens_system1'], settings_update={
+            'fitting': {'epoch_settings': {'min_log_likelihood_gain': 0.,
+                                           'max_epochs': 3}},
+            'kwargs_numerics': {'supersampling_factor': [2],
+                                'pso_epochs': [{'supersampling_factor': [1]}]}
+        })
+        processor = Processor(tmp_path)
+
+        get_best_fit_likelihood = FittingSequence.get_best_fit_likelihood
+        checks = []
+
+        def recorded_get_best_fit_likelihood(fitting_sequence,
+                                             kwargs_numerics=None):
+            log_likelihood = get_best_fit_likelihood(
+                fitting_sequence, kwargs_numerics=kwargs_numerics)
+            checks.append({
+                'supersampling_factor': fitting_sequence.multi_band_list[
+                    0][2]['supersampling_factor'],
+                'kwargs_numerics': kwargs_numerics,
+                'log_likelihood': log_likelihood,
+                'configured_log_likelihood':
+                    get_best_fit_likelihood(fitting_sequence, [
+                        {'supersampling_factor': 2}]),
+            })
+            return log_likelihood
+
+        monkeypatch.setattr(FittingSequence, 'get_best_fit_likelihood',
+                            recorded_get_best_fit_likelihood)
+
+        processor.swim('lens_system1', 'test', log=False)
+
+        # the numerics change between the checks, the likelihoods do not
+        assert len(checks) >= 3
+        assert {check['supersampling_factor'] for check in checks} == {1, 2}
+        for check in checks:
+            assert check['kwargs_numerics'] == [{'supersampling_factor': 2}]
+            assert check['log_likelihood'] \
+                == check['configured_log_likelihood']
+
+    def test_swim_all(self, tmp_path):
+        """
+        Test `swim_all` method on two lenses with a short PSO-only fit.
+        :return:
+        :rtype:
+        """
+        lens_list = ['lens_system1', 'lens_system2']
+        _make_io_directory(tmp_path, lens_list)
+
+        processor = Processor(tmp_path)
+        results = processor.swim_all('test', workers=2)
+
+        assert results == {lens_name: None for lens_name in lens_list}
+        for lens_name in lens_list:
+            output = processor.file_system.load_output(lens_name, 'test')
+            assert {single_output[0] for single_output
+                    in output['fit_output']} == {'PSO'}
+
+    def test_get_stage_metrics(self):
+        """
+        Test `get_stage_metrics` method.
+        :return:
+        :rtype:
+        """
+        usage_start = {
+            0: {'rank': 0, 'cpu_time': 1., 'likelihood_evaluations': 10,
+                'peak_rss': 100},
+            1: {'rank': 1, 'cpu_time': 2., 'likelihood_evaluations': 0,
+                'peak_rss': 100},
+        }
+        usage_end = {
+            0: {'rank': 0, 'cpu_time': 2., 'likelihood_evaluations': 20,
+                'peak_rss': 200},
+            1: {'rank': 1, 'cpu_time': 5., 'likelihood_evaluations': 30,
+                'peak_rss': 300},
+        }
+
+        metrics = self.processor.get_stage_metrics('PSO', 4., usage_start,
+                                                   usage_end)
+        assert metrics['fitting_type'] == 'PSO'
+        assert metrics['rank'] == [0, 1]
+        assert metrics['cpu_time'] == [1., 3.]
+        assert metrics['likelihood_evaluations'] == [10, 30]
+        assert metrics['peak_rss'] == [200, 300]
+        assert metrics['evaluations_per_second'] == 10.
+
+        assert metrics['missing_ranks'] == []
+
+        metrics = self.processor.get_stage_metrics('PSO', 0., usage_start,
+                                                   usage_end)
+        assert metrics['evaluations_per_second'] == 0.
+
+        # the ranks that were not polled are recorded
+        usage_end[1] = None
+        usage_end[2] = usage_end[0]
+        metrics = self.processor.get_stage_metrics('PSO', 4., usage_start,
+                                                   usage_end)
+        assert metrics['rank'] == [0]
+        assert metrics['missing_ranks'] == [1, 2]
+        assert metrics['likelihood_evaluations'] == [10]
+
+    def test_poll_usage(self):
+        """
+        Test `_poll_usage` method with a pool that polls some ranks twice
+        and some not at all.
+        :return:
+        :rtype:
+        """
+        class Pool(object):
+            size = 3
+
+            def __init__(self, rank_lists):
+                self.rank_lists = rank_lists
+
+            def map(self, function, tasks):
+                ranks = self.rank_lists.pop(0)
+                assert len(ranks) == len(tasks)
+                return [dict(function(), rank=rank) for rank in ranks]
+
+        pool = Pool([[1, 1, 2], [3]])
+        usages = self.processor._poll_usage(pool, True)
+        assert sorted(usages.keys()) == [0, 1, 2, 3]
+        assert pool.rank_lists == []
+
+        pool = Pool([[1, 1, 1], [1, 1], [1, 2]])
+        usages = self.processor._poll_usage(pool, True)
+        assert usages[2] is not None
+        assert usages[3] is None
+
+        assert list(self.processor._poll_usage(None, False).keys()) == [0]
+
+    def test_get_job_cost(self):
+        """
+        Test `get_job_cost` method.
+        :return:
+        :rtype:
+        """
+        assert self.processor.get_job_cost('lens_system1') == 120 * 120
+
+    def test_tune_numerics(self):
+        """
+        Test `tune_numerics` method.
+        :return:
+        :rtype:
+        """
+        suggestion, benchmarks = self.processor.tune_numerics(
+            'lens_system1', supersampling_factors=[1, 2],
+            reference_supersampling_factor=4, num_repeats=1)
+
+        assert len(benchmarks) == 1
+        assert [benchmark['supersampling_factor']
+                for benchmark in benchmarks[0]] == [1, 2]
+        assert suggestion['supersampling_factor'][0] in [1, 2]
+
+        file_path = self.processor.file_system.\
+            get_suggested_config_file_path('lens_system1')
+        config = ModelConfig(file_path)
+        assert config.get_kwargs_numerics()[0]['supersampling_factor'] == \
+            suggestion['supersampling_factor'][0]
+        os.remove(file_path)
+
+        # with an infinite tolerance, the fastest option is suggested
+        suggestion, _ = self.processor.tune_numerics(
+            'lens_system1', supersampling_factors=[1, 2],
+            reference_supersampling_factor=4, tolerance=np.inf,
+            num_repeats=1, save_config=False)
+        assert suggestion['supersampling_factor'] == [1]
+        assert not os.path.isfile(file_path)
 
     def test_get_kwargs_data_joint(self):
         """
@@ -41,6 +342,36 @@ class TestProcessor(object):
         assert len(kwargs_data_joint['multi_band_list']) == 1
         assert len(kwargs_data_joint['multi_band_list'][0]) == 3
 
+        kwargs_data_joint = self.processor.get_kwargs_data_joint(
+                                'lens_system1', psf_supersampled_factor=3)
+        assert kwargs_data_joint['multi_band_list'][0][1][
+                   'point_source_supersampling_factor'] == 3
+
+    def test_get_arc_masks(self):
+        """
+        Test `get_arc_masks` method.
+        :return:
+        :rtype:
+        """
+        kwargs_data_joint = self.processor.get_kwargs_data_joint(
+            'lens_system1')
+        arc_masks = self.processor.get_arc_masks('lens_system1',
+                                                 kwargs_data_joint)
+
+        file_path = self.processor.file_system.get_arc_masks_file_path(
+            'lens_system1')
+        assert os.path.isfile(file_path)
+        mtime = os.path.getmtime(file_path)
+
+        # the saved arc masks are used the second time
+        arc_masks2 = self.processor.get_arc_masks('lens_system1',
+                                                  kwargs_data_joint)
+        assert os.path.getmtime(file_path) == mtime
+        for arc_mask, arc_mask2 in zip(arc_masks, arc_masks2):
+            npt.assert_array_equal(arc_mask, arc_mask2)
+
+        os.remove(file_path)
+
     def test_get_image_data(self):
         """
         Test `get_image_data` method.
@@ -50,6 +381,14 @@ class TestProcessor(object):
         image_data = self.processor.get_image_data('lens_system1', 'F390W')
         assert image_data is not None
 
+        # the second call is served from the data cache
+        assert self.processor.get_image_data('lens_system1', 'F390W') \
+            is image_data
+
+        processor = Processor(_TEST_IO_DIR, data_cache_size=0)
+        assert processor.get_image_data('lens_system1', 'F390W') \
+            is not processor.get_image_data('lens_system1', 'F390W')
+
     def test_get_psf_data(self):
         """
         Test `get_image_data` method.
@@ -3,10 +3,21 @@
 Tests for data module.
 """
 from pathlib import Path
+import os
+import tempfile
+import pytest
+import h5py
+import numpy as np
+from lenstronomy.Data.coord_transforms import Coordinates
+from lenstronomy.Data.imaging_data import ImageData as LenstronomyImageData
+from lenstronomy.Data.psf import PSF
+from lenstronomy.ImSim.image_model import ImageModel
+from lenstronomy.LightModel.light_model import LightModel
 
 from dolphin.processor.data import Data
 from dolphin.processor.data import ImageData
 from dolphin.processor.data import PSFData
+from dolphin.processor.data import DataCache
 
 _ROOT_DIR = Path(__file__).resolve().parents[2]
 
@@ -34,6 +45,23 @@ class TestData(object):
             / 'image_lens_system1_F390W.h5'
         data.load_from_file(data_file)
 
+    def test_bin_array(self):
+        """
+        Test `bin_array` method.
+        :return:
+        :rtype:
+        """
+        array = np.arange(35.).reshape((5, 7))
+
+        binned = Data.bin_array(array, 2)
+        assert binned.shape == (2, 3)
+        assert binned[0, 0] == 0. + 1. + 7. + 8.
+        assert binned[1, 2] == 18. + 19. + 25. + 26.
+
+        binned = Data.bin_array(array, 3, np.max)
+        assert binned.shape == (1, 2)
+        assert binned[0, 1] == 19.
+
 
 class TestImageData(object):
 
@@ -68,6 +96,115 @@ class TestImageData(object):
         assert len(image.shape) == 2
         assert image.shape == (120, 120)
 
+        # views are read-only and shared, copies are writable
+        assert not image.flags.writeable
+        assert image is self.image_data.kwargs_data['image_data']
+
+        image_copy = self.image_data.get_image(copy=True)
+        assert image_copy.flags.writeable
+        assert not np.shares_memory(image, image_copy)
+
+        kwargs_data = self.image_data.get_kwargs_data(copy=True)
+        assert kwargs_data['image_data'].flags.writeable
+
+    def test_lenstronomy_image_model(self):
+        """
+        Test that `lenstronomy` classes can be built from `kwargs_data` with
+        an exposure time map, which `lenstronomy` modifies in place.
+        :return:
+        :rtype:
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data_file = os.path.join(temp_dir, 'image.h5')
+            with h5py.File(data_file, 'w') as f:
+                f['image_data'] = np.ones((10, 10))
+                f['background_rms'] = 0.1
+                f['exposure_time'] = np.zeros((10, 10))
+                f['ra_at_xy_0'] = 0.
+                f['dec_at_xy_0'] = 0.
+                f['transform_pix2angle'] = 0.1 * np.eye(2)
+
+            image_data = ImageData(data_file)
+
+        kwargs_data = image_data.kwargs_data
+        assert not kwargs_data['image_data'].flags.writeable
+        assert kwargs_data['exposure_time'].flags.writeable
+
+        image_model = ImageModel(LenstronomyImageData(**kwargs_data),
+                                 PSF(psf_type='GAUSSIAN', fwhm=0.2),
+                                 lens_light_model_class=LightModel(
+                                     ['SERSIC']))
+        image_model.image(kwargs_lens_light=[{
+            'amp': 1., 'R_sersic': 0.3, 'n_sersic': 2., 'center_x': 0.,
+            'center_y': 0.}])
+
+        # the stored exposure time map is not changed
+        assert np.all(image_data.kwargs_data['exposure_time'] == 0.)
+
+    def test_bin_kwargs_data(self):
+        """
+        Test `bin_kwargs_data` method.
+        :return:
+        :rtype:
+        """
+        kwargs_data = {
+            'image_data': np.ones((9, 8)),
+            'background_rms': 0.1,
+            'exposure_time': 2. * np.ones((9, 8)),
+            'noise_map': np.ones((9, 8)),
+            'ra_at_xy_0': 1.,
+            'dec_at_xy_0': -1.,
+            'transform_pix2angle': np.array([[-0.1, 0.], [0., 0.1]])
+        }
+
+        binned = ImageData.bin_kwargs_data(kwargs_data, 2)
+        assert binned['image_data'].shape == (4, 4)
+        assert np.all(binned['image_data'] == 4.)
+        assert binned['background_rms'] == 0.2
+        assert np.all(binned['exposure_time'] == 2.)
+        assert np.all(binned['noise_map'] == 2.)
+        np.testing.assert_allclose(binned['transform_pix2angle'],
+                                   [[-0.2, 0.], [0., 0.2]])
+
+        # the first binned pixel is centered between the first 2 x 2 pixels
+        assert binned['ra_at_xy_0'] == 1. - 0.05
+        assert binned['dec_at_xy_0'] == -1. + 0.05
+
+        # the input is not changed
+        assert kwargs_data['image_data'].shape == (9, 8)
+
+    def test_crop_kwargs_data(self):
+        """
+        Test `crop_kwargs_data` method.
+        :return:
+        :rtype:
+        """
+        kwargs_data = {
+            'image_data': np.arange(72.).reshape((9, 8)),
+            'background_rms': 0.1,
+            'exposure_time': 2.,
+            'noise_map': np.ones((9, 8)),
+            'ra_at_xy_0': 1.,
+            'dec_at_xy_0': -1.,
+            'transform_pix2angle': np.array([[-0.1, 0.], [0., 0.1]])
+        }
+
+        cropped = ImageData.crop_kwargs_data(kwargs_data, [2, 7, 1, 4])
+        assert cropped['image_data'].shape == (5, 3)
+        assert cropped['noise_map'].shape == (5, 3)
+        assert cropped['exposure_time'] == 2.
+        assert cropped['image_data'][0, 0] == kwargs_data['image_data'][2, 1]
+
+        # the cropped pixels keep their coordinates
+        coords = Coordinates(kwargs_data['transform_pix2angle'],
+                             kwargs_data['ra_at_xy_0'],
+                             kwargs_data['dec_at_xy_0'])
+        coords_cropped = Coordinates(cropped['transform_pix2angle'],
+                                     cropped['ra_at_xy_0'],
+                                     cropped['dec_at_xy_0'])
+        np.testing.assert_allclose(coords_cropped.map_pix2coord(2, 3),
+                                   coords.map_pix2coord(3, 5))
+
 
 class TestPSFData(object):
 
@@ -94,3 +231,155 @@ class TestPSFData(object):
         for key in ['psf_type', 'kernel_point_source',
                     'kernel_point_source_init', 'psf_error_map']:
             assert key in psf.kwargs_psf
+
+        kwargs_psf = psf.kwargs_psf
+        assert not kwargs_psf['kernel_point_source'].flags.writeable
+        assert kwargs_psf['kernel_point_source_init'] \
+            is kwargs_psf['kernel_point_source']
+
+        # changing the returned dictionary does not change the stored data
+        kwargs_psf['psf_type'] = 'GAUSSIAN'
+        assert psf.kwargs_psf['psf_type'] == 'PIXEL'
+
+        kwargs_psf = psf.get_kwargs_psf(copy=True)
+        assert kwargs_psf['kernel_point_source'].flags.writeable
+        assert not np.shares_memory(kwargs_psf['kernel_point_source'],
+                                    kwargs_psf['kernel_point_source_init'])
+
+    def test_bin_kwargs_psf(self):
+        """
+        Test `bin_kwargs_psf` method.
+        :return:
+        :rtype:
+        """
+        y, x = np.indices((21, 21)) - 10.
+        kernel = np.exp(-(x**2 + y**2) / 2. / 2.**2)
+        kwargs_psf = {'psf_type': 'PIXEL',
+                      'kernel_point_source': kernel / np.sum(kernel),
+                      'kernel_point_source_init': kernel,
+                      'psf_error_map': np.ones((21, 21))}
+
+        for binning in [2, 3]:
+            binned = PSFData.bin_kwargs_psf(kwargs_psf, binning)
+            binned_kernel = binned['kernel_point_source']
+
+            assert binned_kernel.shape[0] % 2 == 1
+            assert binned_kernel.shape[0] < 21
+            np.testing.assert_almost_equal(np.sum(binned_kernel), 1.)
+            # the kernel stays centered
+            center = binned_kernel.shape[0] // 2
+            assert np.argmax(binned_kernel) == center * (2 * center + 2)
+            assert 'psf_error_map' not in binned
+            assert 'kernel_point_source_init' not in binned
+
+        kwargs_psf = {'psf_type': 'GAUSSIAN', 'fwhm': 0.1}
+        assert PSFData.bin_kwargs_psf(kwargs_psf, 2) == kwargs_psf
+
+    def test_truncate_kwargs_psf(self):
+        """
+        Test `truncate_kwargs_psf` method.
+        :return:
+        :rtype:
+        """
+        y, x = np.indices((41, 41)) - 20.
+        kernel = np.exp(-(x**2 + y**2) / 2. / 2.**2)
+        kernel /= np.sum(kernel)
+        kwargs_psf = {'psf_type': 'PIXEL',
+                      'kernel_point_source': kernel,
+                      'kernel_point_source_init': kernel,
+                      'psf_error_map': np.ones((41, 41))}
+
+        sizes = []
+        for encircled_energy in [0.5, 0.9, 0.99]:
+            truncated = PSFData.truncate_kwargs_psf(kwargs_psf,
+                                                    encircled_energy)
+            truncated_kernel = truncated['kernel_point_source']
+            size = truncated_kernel.shape[0]
+            sizes.append(size)
+
+            assert size % 2 == 1
+            assert truncated['psf_error_map'].shape == (size, size)
+            np.testing.assert_almost_equal(np.sum(truncated_kernel), 1.)
+            assert np.argmax(truncated_kernel) == size**2 // 2
+            # the square contains at least the encircled energy
+            assert np.sum(kernel[20 - size // 2:21 + size // 2,
+                                 20 - size // 2:21 + size // 2]) \
+                >= encircled_energy
+
+        assert sizes == sorted(sizes)
+        assert sizes[-1] < 41
+
+        assert PSFData.truncate_kwargs_psf(kwargs_psf, 1.)[
+            'kernel_point_source'].shape == (41, 41)
+        assert kwargs_psf['kernel_point_source'].shape == (41, 41)
+
+        with pytest.raises(ValueError):
+            PSFData.truncate_kwargs_psf(kwargs_psf, 0.)
+
+    def test_get_kernel_radius(self):
+        """
+        Test `get_kernel_radius` method.
+        :return:
+        :rtype:
+        """
+        kwargs_psf = {'psf_type': 'PIXEL',
+                      'kernel_point_source': np.ones((21, 21))}
+        assert PSFData.get_kernel_radius(kwargs_psf) == 11
+
+        kwargs_psf['point_source_supersampling_factor'] = 3
+        assert PSFData.get_kernel_radius(kwargs_psf) == 4
+
+        assert PSFData.get_kernel_radius({'psf_type': 'GAUSSIAN',
+                                          'fwhm': 0.1}) == 0
+
+
+class TestDataCache(object):
+
+    def setup_class(self):
+        self.data_list = []
+        for i in range(3):
+            data = Data()
+            data._data = {'image_data': np.ones((10, 10)), 'value': 1.}
+            self.data_list.append(data)
+
+    def test_nbytes(self):
+        """
+        Test `nbytes` property of `Data`.
+        :return:
+        :rtype:
+        """
+        assert self.data_list[0].nbytes == 808
+
+    def test_add_get(self):
+        """
+        Test `add`, `get`, and `clear` methods.
+        :return:
+        :rtype:
+        """
+        cache = DataCache(max_bytes=2000)
+
+        assert cache.get(('image', 'lens', 'band', 0.)) is None
+
+        for i, data in enumerate(self.data_list[:2]):
+            cache.add(('image', 'lens', 'band', i), data)
+
+        assert len(cache) == 2
+        assert cache.nbytes == 1616
+        assert cache.get(('image', 'lens', 'band', 0)) \
+            is self.data_list[0]
+
+        # the least recently used entry is dropped
+        cache.add(('image', 'lens', 'band', 2), self.data_list[2])
+        assert len(cache) == 2
+        assert cache.get(('image', 'lens', 'band', 1)) is None
+        assert cache.get(('image', 'lens', 'band', 0)) is not None
+
+        cache = DataCache(max_bytes=0)
+        cache.add(('image', 'lens', 'band', 0), self.data_list[0])
+        assert len(cache) == 0
+
+        cache = DataCache()
+        cache.add(('image', 'lens', 'band', 0), self.data_list[0])
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.nbytes == 0
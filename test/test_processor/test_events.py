@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for events module.
+"""
+
+import os
+import json
+import tempfile
+import pytest
+import numpy as np
+
+from dolphin.processor.events import EventLog
+
+
+class TestEventLog(object):
+
+    def setup_class(self):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_write(self):
+        """
+        Test `write` method.
+        :return:
+        :rtype:
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'events.jsonl')
+
+            with EventLog(file_path, 'lens', 'model') as event_log:
+                event_log.write('stage_start', index=0, fitting_type='PSO')
+                # the event is written before the log is closed
+                with open(file_path, 'r') as f:
+                    assert len(f.readlines()) == 1
+
+                event_log.write('stage_end', index=np.int64(0),
+                                best_log_likelihood=np.float64(-10.),
+                                metrics={'cpu_time': np.ones(2)})
+
+                with pytest.raises(TypeError):
+                    event_log.write('invalid', value=object())
+
+            with open(file_path, 'r') as f:
+                events = [json.loads(line) for line in f]
+
+            assert events[0]['event'] == 'stage_start'
+            assert events[0]['lens_name'] == 'lens'
+            assert events[0]['model_id'] == 'model'
+            assert events[0]['fitting_type'] == 'PSO'
+            assert events[1]['index'] == 0
+            assert events[1]['best_log_likelihood'] == -10.
+            assert events[1]['metrics']['cpu_time'] == [1., 1.]
+            assert events[0]['time'] <= events[1]['time']
+
+            # the events are appended when resuming
+            with EventLog(file_path, 'lens', 'model',
+                          append=True) as event_log:
+                event_log.write('swim_start')
+            with open(file_path, 'r') as f:
+                assert json.loads(f.readlines()[-1])['event'] == \
+                    'swim_start'
+
+            with EventLog(file_path, 'lens', 'model') as event_log:
+                event_log.write('swim_start')
+            with open(file_path, 'r') as f:
+                assert len(f.readlines()) == 1
+
+        # the log is turned off without a file path
+        event_log = EventLog(None, 'lens', 'model')
+        event_log.write('swim_start')
+        event_log.close()
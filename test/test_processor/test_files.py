@@ -6,9 +6,13 @@ Tests for files module.
 import pytest
 from pathlib import Path
 import os
+import resource
 import numpy as np
+import h5py
+import numpy.testing as npt
 
 from dolphin.processor.files import FileSystem
+from dolphin.processor.files import LazyOutput
 
 _ROOT_DIR = Path(__file__).resolve().parents[2]
 _TEST_IO_DIR = _ROOT_DIR / 'io_directory_example'
@@ -104,6 +108,16 @@ class TestFileSystem(object):
 
         assert Path(self.file_system.get_data_directory()) == data_dir
 
+    def test_get_lens_data_directory(self):
+        """
+        Test `get_lens_data_directory` method.
+        :return:
+        :rtype:
+        """
+        path = _TEST_IO_DIR / 'data' / 'test'
+
+        assert Path(self.file_system.get_lens_data_directory('test')) == path
+
     def test_get_image_file_path(self):
         """
         Test `get_image_file_path` method.
@@ -128,6 +142,32 @@ class TestFileSystem(object):
         assert Path(self.file_system.get_psf_file_path('lens_system1',
                                                        'F390W')) == path
 
+    def test_save_load_arc_masks(self):
+        """
+        Test `save_arc_masks` and `load_arc_masks` methods.
+        :return:
+        :rtype:
+        """
+        lens_name = 'DCLS1507+0522'
+        assert self.file_system.load_arc_masks(lens_name) == {}
+
+        arc_masks = {'F140W': ('abc', np.ones((10, 10))),
+                     'F200LP': ('def', np.zeros((12, 12)))}
+        self.file_system.save_arc_masks(lens_name, arc_masks)
+
+        loaded_arc_masks = self.file_system.load_arc_masks(lens_name)
+        assert set(loaded_arc_masks.keys()) == {'F140W', 'F200LP'}
+        for band in arc_masks:
+            assert loaded_arc_masks[band][0] == arc_masks[band][0]
+            npt.assert_array_equal(loaded_arc_masks[band][1],
+                                   arc_masks[band][1])
+
+        os.remove(self.file_system.get_arc_masks_file_path(lens_name))
+
+        # a missing lens data directory is not an error
+        self.file_system.save_arc_masks('missing_lens', arc_masks)
+        assert self.file_system.load_arc_masks('missing_lens') == {}
+
     def test_get_log_file_path(self):
         """
         Test `get_log_file_path` method.
@@ -145,6 +185,25 @@ class TestFileSystem(object):
 
         os.remove(str(path.resolve()))
 
+    def test_get_event_log_file_path(self):
+        """
+        Test `get_event_log_file_path` and `get_event_log_list` methods.
+        :return:
+        :rtype:
+        """
+        path = _TEST_IO_DIR / 'logs' / 'events_name_test.jsonl'
+        assert Path(self.file_system.get_event_log_file_path(
+            'name', 'test')) == path
+
+        with open(str(path.resolve()), 'w'):
+            pass
+
+        assert str(path.resolve()) in self.file_system.get_event_log_list()
+        for file_path in self.file_system.get_event_log_list():
+            assert file_path.endswith('.jsonl')
+
+        os.remove(str(path.resolve()))
+
     def test_get_output_file_path(self):
         """
         Test `get_output_file_path` method.
@@ -220,6 +279,11 @@ class TestFileSystem(object):
         self.file_system.save_output('test', 'save_test', save_dict,
                                      file_type='h5')
 
+        # the number of PSO iterations run is recorded
+        with h5py.File(self.file_system.get_output_file_path(
+                'test', 'save_test', file_type='h5'), 'r') as f:
+            assert f['fit_output']['0'].attrs['num_iteration'] == 1
+
         out = self.file_system.load_output('test', 'save_test', file_type='h5')
 
         assert save_dict['settings'] == out['settings']
@@ -245,6 +309,293 @@ class TestFileSystem(object):
             self.file_system.save_output('test', 'save_test', save_dict,
                                          file_type='h5')
 
+    def test_load_output_h5_lazy(self):
+        """
+        Test lazy loading of h5 output with `LazyOutput`.
+        :return:
+        :rtype:
+        """
+        save_dict = {
+            'settings': {'some': ['settings']},
+            'kwargs_result': {'0': 1, '1': 'str', '2': [3, 4]},
+            'fit_output': [
+                ['EMCEE',
+                 np.random.normal(size=(50, 4)),
+                 ['{}'.format(i) for i in range(4)],
+                 np.random.normal(size=50)
+                 ]
+            ]
+        }
+
+        self.file_system.save_output('test', 'lazy_test', save_dict)
+
+        out = self.file_system.load_output('test', 'lazy_test')
+        assert isinstance(out, LazyOutput)
+        assert out._cache == {}
+        assert set(out.keys()) == {'settings', 'kwargs_result', 'fit_output'}
+
+        assert out['kwargs_result'] == save_dict['kwargs_result']
+        assert 'settings' not in out._cache
+
+        assert isinstance(out['fit_output'][0][1], np.memmap)
+        npt.assert_array_equal(out['fit_output'][0][1],
+                               save_dict['fit_output'][0][1])
+        npt.assert_array_equal(out['fit_output'][0][3],
+                               save_dict['fit_output'][0][3])
+        assert out['fit_output'][0][2] == save_dict['fit_output'][0][2]
+
+        # overwriting the file does not invalidate the mapped arrays
+        samples = out['fit_output'][0][1]
+        self.file_system.save_output('test', 'lazy_test', {
+            'settings': {}, 'kwargs_result': {}, 'fit_output': []})
+        npt.assert_array_equal(samples, save_dict['fit_output'][0][1])
+
+        out = self.file_system.load_output('test', 'lazy_test', lazy=False)
+        assert isinstance(out, dict)
+        assert out['fit_output'] == []
+        assert 'masks' not in out
+
+        # the masks are stored as datasets
+        save_dict['masks'] = [np.ones((3, 3)), np.zeros((2, 2))]
+        self.file_system.save_output('test', 'lazy_test', save_dict)
+
+        out = self.file_system.load_output('test', 'lazy_test')
+        assert 'masks' in out
+        npt.assert_array_equal(out['masks'][0], np.ones((3, 3)))
+        npt.assert_array_equal(out['masks'][1], np.zeros((2, 2)))
+
+        out = self.file_system.load_output('test', 'lazy_test', lazy=False)
+        npt.assert_array_equal(out['masks'][0], np.ones((3, 3)))
+
+        out = LazyOutput(self.file_system.get_output_file_path(
+            'test', 'lazy_test', file_type='h5'))
+        assert len(out) == 4
+
+        # the PSF truncation record is stored as an attribute
+        save_dict['psf_truncation'] = {'band': ['F390W'],
+                                       'encircled_energy': [0.99],
+                                       'stored_kernel_size': [41],
+                                       'kernel_size': [13]}
+        self.file_system.save_output('test', 'lazy_test', save_dict)
+
+        out = self.file_system.load_output('test', 'lazy_test')
+        assert len(out) == 5
+        assert out['psf_truncation'] == save_dict['psf_truncation']
+
+        out = self.file_system.load_output('test', 'lazy_test', lazy=False)
+        assert out['psf_truncation'] == save_dict['psf_truncation']
+
+        with pytest.raises(KeyError):
+            _ = out['invalid']
+
+        with pytest.raises(FileNotFoundError):
+            LazyOutput('not_a_file.h5')
+
+    def test_load_output_h5_lazy_file_descriptors(self):
+        """
+        Test that lazily loaded outputs hold at most one file descriptor
+        each, and none after `close()`, under a low file descriptor limit.
+        :return:
+        :rtype:
+        """
+        save_dict = {
+            'settings': {'some': 'settings'},
+            'kwargs_result': {},
+            'fit_output': [
+                ['PSO', [np.ones(5), np.ones((5, 2)), np.ones((5, 2))],
+                 ['a', 'b']],
+                ['PSO', [np.ones(5), np.ones((5, 2)), np.ones((5, 2))],
+                 ['a', 'b']],
+                ['EMCEE', np.arange(20.).reshape((10, 2)), ['a', 'b'],
+                 np.arange(10.)],
+            ]
+        }
+        self.file_system.save_output('test', 'fd_test', save_dict)
+        file_path = self.file_system.get_output_file_path('test', 'fd_test',
+                                                          file_type='h5')
+
+        num_open = len(os.listdir('/dev/fd'))
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (num_open + 64, hard_limit))
+
+        try:
+            # 8 mapped datasets per output
+            outputs = [LazyOutput(file_path) for _ in range(40)]
+            for out in outputs:
+                npt.assert_array_equal(out['fit_output'][2][1],
+                                       save_dict['fit_output'][2][1])
+                assert isinstance(out['fit_output'][0][1][0], np.memmap)
+            assert len(os.listdir('/dev/fd')) <= num_open + 41
+
+            for out in outputs:
+                out.close()
+            assert len(os.listdir('/dev/fd')) <= num_open + 1
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (soft_limit, hard_limit))
+            os.remove(file_path)
+
+    def test_get_checkpoint_file_path(self):
+        """
+        Test `get_checkpoint_file_path` method.
+        :return:
+        :rtype:
+        """
+        path = _TEST_IO_DIR / 'outputs' / 'checkpoint_name_test.h5'
+
+        assert Path(self.file_system.get_checkpoint_file_path(
+            'name', 'test')) == path
+
+    def test_save_load_checkpoint(self):
+        """
+        Test `save_checkpoint`, `load_checkpoint`, and `remove_checkpoint`
+        methods.
+        :return:
+        :rtype:
+        """
+        assert self.file_system.load_checkpoint('test',
+                                                'checkpoint_test') is None
+
+        checkpoint = {
+            'settings': {'some': ['settings']},
+            'kwargs_result': {'0': 1, '1': 'str', '2': [3, 4]},
+            'fit_output': [
+                ['PSO',
+                 [np.ones((1, 50)), np.ones((4, 50)), np.ones((1, 50))],
+                 ['{}'.format(i) for i in range(4)]
+                 ],
+            ],
+            'num_completed': 2,
+            'kwargs_psf_list': [{'kernel_point_source': np.ones((3, 3)),
+                                 'psf_type': 'PIXEL'}]
+        }
+
+        self.file_system.save_checkpoint('test', 'checkpoint_test',
+                                         checkpoint)
+        out = self.file_system.load_checkpoint('test', 'checkpoint_test')
+
+        assert out['num_completed'] == 2
+        assert out['kwargs_result'] == checkpoint['kwargs_result']
+        assert out['fit_output'][0][0] == 'PSO'
+        assert np.all(out['kwargs_psf_list'][0]['kernel_point_source']
+                      == np.ones((3, 3)))
+        assert out['epoch_log_likelihoods'] == []
+        assert 'fitting_state' not in out
+
+        checkpoint['epoch_log_likelihoods'] = [-100., -20.5]
+        checkpoint['stage_metrics'] = [
+            {'fitting_type': 'PSO', 'wall_time': 2., 'rank': [0],
+             'cpu_time': [1.5], 'likelihood_evaluations': [100],
+             'peak_rss': [1024], 'evaluations_per_second': 50.}
+        ]
+        checkpoint['fitting_state'] = {
+            'kwargs_fixed': {'lens': [{'theta_E': 1.}], 'special': {}},
+            'kwargs_shift_list': [{'ra_shift': 0.01, 'dec_shift': 0}],
+            'kwargs_result': {'kwargs_lens': [{'theta_E': 1.}]},
+        }
+        self.file_system.save_checkpoint('test', 'checkpoint_test',
+                                         checkpoint)
+        out = self.file_system.load_checkpoint('test', 'checkpoint_test')
+        assert out['epoch_log_likelihoods'] == [-100., -20.5]
+        assert out['stage_metrics'] == checkpoint['stage_metrics']
+        assert out['fitting_state'] == checkpoint['fitting_state']
+
+        # only the new entries of the fit output are written
+        stage_file = self.file_system.get_checkpoint_stage_file_path(
+            'test', 'checkpoint_test', 0)
+        inode = os.stat(stage_file).st_ino
+
+        checkpoint['fit_output'].append(
+            ['EMCEE', np.ones((10, 4)), ['{}'.format(i) for i in range(4)],
+             np.ones(10)])
+        checkpoint['num_completed'] = 3
+        self.file_system.save_checkpoint('test', 'checkpoint_test',
+                                         checkpoint)
+        assert os.stat(stage_file).st_ino == inode
+
+        out = self.file_system.load_checkpoint('test', 'checkpoint_test')
+        assert out['num_completed'] == 3
+        assert out['fit_output'][0][0] == 'PSO'
+        assert out['fit_output'][1][0] == 'EMCEE'
+        assert np.all(out['fit_output'][1][1] == np.ones((10, 4)))
+
+        # a failed write leaves the previous checkpoint and no temporary
+        # file
+        checkpoint['fit_output'].append(['invalid'])
+        with pytest.raises(ValueError):
+            self.file_system.save_checkpoint('test', 'checkpoint_test',
+                                             checkpoint)
+        outputs_directory = self.file_system.get_outputs_directory()
+        assert not [name for name in os.listdir(outputs_directory)
+                    if name.endswith('.tmp')]
+        out = self.file_system.load_checkpoint('test', 'checkpoint_test')
+        assert len(out['fit_output']) == 2
+
+        self.file_system.remove_checkpoint('test', 'checkpoint_test')
+        assert self.file_system.load_checkpoint('test',
+                                                'checkpoint_test') is None
+        assert not os.path.isfile(stage_file)
+
+    def test_get_checkpoint_stage_file_path(self):
+        """
+        Test `get_checkpoint_stage_file_path` method.
+        :return:
+        :rtype:
+        """
+        path = _TEST_IO_DIR / 'outputs' / 'checkpoint_name_test_fit_1.h5'
+
+        assert Path(self.file_system.get_checkpoint_stage_file_path(
+            'name', 'test', 1)) == path
+
+    def test_get_samples_file_path(self):
+        """
+        Test `get_samples_file_path` method.
+        :return:
+        :rtype:
+        """
+        path = _TEST_IO_DIR / 'outputs' / 'samples_name_test.h5'
+
+        assert Path(self.file_system.get_samples_file_path(
+            'name', 'test')) == path
+
+    def test_append_read_samples_h5(self):
+        """
+        Test `append_samples_h5`, `read_samples_h5`, `load_samples`, and
+        `remove_samples_h5` methods.
+        :return:
+        :rtype:
+        """
+        file_path = self.file_system.get_samples_file_path('test',
+                                                           'samples_test')
+        self.file_system.remove_samples_h5(file_path)
+
+        samples = np.random.normal(size=(12, 3))
+        log_likelihood = np.random.normal(size=12)
+
+        self.file_system.append_samples_h5(file_path, samples[:8],
+                                           log_likelihood[:8])
+        self.file_system.append_samples_h5(file_path, samples[8:],
+                                           log_likelihood[8:])
+        self.file_system.append_samples_h5(file_path, samples[:4],
+                                           log_likelihood[:4], name='mcmc_1')
+
+        out_samples, out_log_likelihood = self.file_system.load_samples(
+            'test', 'samples_test')
+        npt.assert_array_equal(out_samples, samples)
+        npt.assert_array_equal(out_log_likelihood, log_likelihood)
+
+        out_samples, _ = self.file_system.read_samples_h5(file_path,
+                                                          name='mcmc_1')
+        npt.assert_array_equal(out_samples, samples[:4])
+
+        self.file_system.remove_samples_h5(file_path, name='mcmc_1')
+        with pytest.raises(KeyError):
+            self.file_system.read_samples_h5(file_path, name='mcmc_1')
+
+        self.file_system.remove_samples_h5(file_path)
+        assert not Path(file_path).exists()
+
     def test_numpy_to_json_encoding(self):
         """
         Test `class NumpyEncoder` and `hook_json_to_numpy` function.
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for fitting module.
+"""
+
+import os
+import tempfile
+from copy import deepcopy
+import pytest
+import numpy as np
+import numpy.testing as npt
+from lenstronomy.Util import simulation_util
+from lenstronomy.ImSim.image_model import ImageModel
+from lenstronomy.Data.imaging_data import ImageData
+from lenstronomy.Data.psf import PSF
+from lenstronomy.LensModel.lens_model import LensModel
+from lenstronomy.LightModel.light_model import LightModel
+
+from dolphin.processor.fitting import FittingSequence
+from dolphin.processor.fitting import LikelihoodCounter
+from dolphin.processor.files import FileSystem
+
+
+class TestFittingSequence(object):
+    """
+    Test the `FittingSequence` class on a small simulated lens.
+    """
+    def setup_class(self):
+        np.random.seed(42)
+
+        kwargs_data = simulation_util.data_configure_simple(20, 0.1, 100.,
+                                                            0.05)
+        kwargs_psf = {'psf_type': 'GAUSSIAN', 'fwhm': 0.2}
+        kwargs_numerics = {'supersampling_factor': 1}
+
+        kwargs_lens = [{'theta_E': 0.6, 'center_x': 0., 'center_y': 0.}]
+        kwargs_source = [{'amp': 10., 'R_sersic': 0.2, 'n_sersic': 1.,
+                          'center_x': 0.05, 'center_y': 0.}]
+
+        image_model = ImageModel(ImageData(**kwargs_data), PSF(**kwargs_psf),
+                                 LensModel(['SIS']), LightModel(['SERSIC']),
+                                 kwargs_numerics=kwargs_numerics)
+        image = image_model.image(kwargs_lens, kwargs_source)
+        kwargs_data['image_data'] = image + np.random.normal(
+            0., 0.05, size=image.shape)
+
+        self.kwargs_data_joint = {
+            'multi_band_list': [[kwargs_data, kwargs_psf, kwargs_numerics]],
+            'multi_band_type': 'multi-linear'
+        }
+        self.kwargs_model = {'lens_model_list': ['SIS'],
+                             'source_light_model_list': ['SERSIC']}
+        self.kwargs_params = {
+            'lens_model': [[{'theta_E': 0.5, 'center_x': 0.,
+                             'center_y': 0.}],
+                           [{'theta_E': 0.1, 'center_x': 0.05,
+                             'center_y': 0.05}],
+                           [{}],
+                           [{'theta_E': 0.1, 'center_x': -0.5,
+                             'center_y': -0.5}],
+                           [{'theta_E': 1., 'center_x': 0.5,
+                             'center_y': 0.5}]],
+            'source_model': [[{'R_sersic': 0.3, 'n_sersic': 1.,
+                               'center_x': 0., 'center_y': 0.}],
+                             [{'R_sersic': 0.05, 'n_sersic': 0.5,
+                               'center_x': 0.05, 'center_y': 0.05}],
+                             [{'n_sersic': 1.}],
+                             [{'R_sersic': 0.01, 'n_sersic': 0.5,
+                               'center_x': -0.5, 'center_y': -0.5}],
+                             [{'R_sersic': 1., 'n_sersic': 5.,
+                               'center_x': 0.5, 'center_y': 0.5}]],
+        }
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def get_fitting_sequence(self, samples_file=None):
+        """
+        Get a `FittingSequence` instance for the simulated lens.
+
+        :param samples_file: path to the samples file
+        :type samples_file: `str`
+        :return: fitting sequence
+        :rtype: `FittingSequence`
+        """
+        # `lenstronomy` changes the fixed parameters and the bands in place
+        return FittingSequence(deepcopy(self.kwargs_data_joint),
+                               self.kwargs_model, {}, {'check_bounds': True},
+                               deepcopy(self.kwargs_params), verbose=False,
+                               samples_file=samples_file)
+
+    def test_pso(self):
+        """
+        Test `pso` method with early stopping.
+        :return:
+        :rtype:
+        """
+        fitting_sequence = self.get_fitting_sequence()
+
+        # a huge tolerance stops the PSO after the first window
+        fit_output = fitting_sequence.fit_sequence([
+            ['PSO', {'sigma_scale': 1., 'n_particles': 10,
+                     'n_iterations': 50, 'early_stop_tolerance': 1e10,
+                     'early_stop_window': 3}]
+        ])
+        chi2_list = fit_output[0][1][0]
+        assert len(chi2_list) == 4
+        assert len(fit_output[0][1][1]) == 4
+        assert np.all(np.diff(chi2_list) >= 0)
+
+        # a negative tolerance never stops early
+        fit_output = fitting_sequence.fit_sequence([
+            ['PSO', {'sigma_scale': 1., 'n_particles': 10,
+                     'n_iterations': 6, 'early_stop_tolerance': -1.,
+                     'early_stop_window': 3}]
+        ])
+        assert len(fit_output[0][1][0]) == 6
+
+        kwargs_result = fitting_sequence.best_fit()
+        assert set(kwargs_result['kwargs_lens'][0].keys()) == {
+            'theta_E', 'center_x', 'center_y'}
+
+    def test_set_resolution(self):
+        """
+        Test `set_resolution` method and the binned PSO stages.
+        :return:
+        :rtype:
+        """
+        fitting_sequence = self.get_fitting_sequence()
+        mask = np.ones((20, 20))
+        mask[:, :3] = 0
+        fitting_sequence.update_settings(kwargs_likelihood={
+            'image_likelihood_mask_list': [mask]})
+
+        fit_output = fitting_sequence.fit_sequence([
+            ['set_resolution', {'binning': 2}],
+            ['PSO', {'sigma_scale': 1., 'n_particles': 4,
+                     'n_iterations': 2}],
+        ])
+        assert len(fit_output) == 1
+
+        binned_band = fitting_sequence.kwargs_data_joint[
+            'multi_band_list'][0]
+        assert binned_band[0]['image_data'].shape == (10, 10)
+        assert fitting_sequence.multi_band_list[0][0][
+            'image_data'].shape == (20, 20)
+
+        # the masks are binned, including the ones updated later
+        binned_mask = fitting_sequence._updateManager.kwargs_likelihood[
+            'image_likelihood_mask_list'][0]
+        assert binned_mask.shape == (10, 10)
+        assert np.all(binned_mask[:, :2] == 0)
+        assert np.all(binned_mask[:, 2:] == 1)
+
+        fitting_sequence.update_settings(kwargs_likelihood={
+            'image_likelihood_mask_list': [np.ones((20, 20))]})
+        assert np.all(fitting_sequence._updateManager.kwargs_likelihood[
+            'image_likelihood_mask_list'][0] == np.ones((10, 10)))
+
+        # PSF iteration is not allowed on the binned images
+        with pytest.raises(ValueError):
+            fitting_sequence.fit_sequence([['psf_iteration', {}]])
+
+        fitting_sequence.fit_sequence([['set_resolution', {'binning': 1}]])
+        assert fitting_sequence.kwargs_data_joint['multi_band_list'][0][0][
+            'image_data'].shape == (20, 20)
+        assert fitting_sequence._updateManager.kwargs_likelihood[
+            'image_likelihood_mask_list'][0].shape == (20, 20)
+
+        # the best-fit likelihood is always at full resolution
+        fitting_sequence = self.get_fitting_sequence()
+        log_likelihood = fitting_sequence.best_fit_likelihood
+        fitting_sequence.set_resolution(2)
+        assert fitting_sequence.best_fit_likelihood == log_likelihood
+        assert fitting_sequence.kwargs_data_joint['multi_band_list'][0][0][
+            'image_data'].shape == (10, 10)
+
+        with pytest.raises(ValueError):
+            fitting_sequence.set_resolution(0)
+
+    def test_update_numerics(self):
+        """
+        Test updating the `kwargs_numerics` with `update_settings`.
+        :return:
+        :rtype:
+        """
+        fitting_sequence = self.get_fitting_sequence()
+        log_likelihood = fitting_sequence.best_fit_likelihood
+
+        fitting_sequence.fit_sequence([
+            ['update_settings', {'kwargs_numerics': [
+                {'supersampling_factor': 2}]}],
+            ['set_resolution', {'binning': 2}],
+        ])
+        assert fitting_sequence.kwargs_data_joint['multi_band_list'][0][2][
+            'supersampling_factor'] == 2
+        assert fitting_sequence.multi_band_list[0][2][
+            'supersampling_factor'] == 2
+        assert fitting_sequence.best_fit_likelihood != log_likelihood
+
+        # the provided `kwargs_data_joint` is not changed
+        assert self.kwargs_data_joint['multi_band_list'][0][2][
+            'supersampling_factor'] == 1
+
+        fitting_sequence.update_settings(kwargs_numerics=[
+            {'supersampling_factor': 1}])
+        assert fitting_sequence.kwargs_data_joint['multi_band_list'][0][0][
+            'image_data'].shape == (10, 10)
+        fitting_sequence.set_resolution(1)
+        assert fitting_sequence.best_fit_likelihood == log_likelihood
+
+        with pytest.raises(ValueError):
+            fitting_sequence.update_settings(kwargs_numerics=[None, None])
+
+    def test_get_best_fit_likelihood(self):
+        """
+        Test `get_best_fit_likelihood` method.
+        :return:
+        :rtype:
+        """
+        fitting_sequence = self.get_fitting_sequence()
+        log_likelihood = fitting_sequence.get_best_fit_likelihood()
+        assert log_likelihood == fitting_sequence.best_fit_likelihood
+
+        fitting_sequence.fit_sequence([
+            ['update_settings', {'kwargs_numerics': [
+                {'supersampling_factor': 2}]}],
+            ['set_resolution', {'binning': 2}],
+        ])
+        log_likelihood_2 = fitting_sequence.best_fit_likelihood
+        assert log_likelihood_2 != log_likelihood
+
+        # the likelihood at other numerics does not change the current ones
+        assert fitting_sequence.get_best_fit_likelihood(
+            kwargs_numerics=[{'supersampling_factor': 1}]) == log_likelihood
+        assert fitting_sequence.multi_band_list[0][2][
+            'supersampling_factor'] == 2
+        assert fitting_sequence.kwargs_data_joint['multi_band_list'][0][0][
+            'image_data'].shape == (10, 10)
+        assert fitting_sequence.best_fit_likelihood == log_likelihood_2
+
+    def test_get_set_state(self):
+        """
+        Test `get_state` and `set_state` methods.
+        :return:
+        :rtype:
+        """
+        fitting_sequence = self.get_fitting_sequence()
+        fitting_sequence.fit_sequence([
+            ['PSO', {'sigma_scale': 1., 'n_particles': 4,
+                     'n_iterations': 2}],
+            ['update_settings', {'lens_add_fixed': [[0, ['theta_E']]],
+                                 'source_add_fixed': [[0, ['n_sersic'],
+                                                       [2.]]]}],
+        ])
+        fitting_sequence.multi_band_list[0][0] = dict(
+            fitting_sequence.multi_band_list[0][0], ra_shift=0.01)
+        state = fitting_sequence.get_state()
+
+        assert state['kwargs_fixed']['lens'][0]['theta_E'] \
+            == state['kwargs_result']['kwargs_lens'][0]['theta_E']
+        assert state['kwargs_fixed']['source'][0]['n_sersic'] == 2.
+        assert state['kwargs_shift_list'] == [{'ra_shift': 0.01,
+                                               'dec_shift': 0}]
+
+        # the state is restored in a new fitting sequence, also after the
+        # same fixing is replayed from the initial values
+        restored = self.get_fitting_sequence()
+        restored.fit_sequence([
+            ['update_settings', {'lens_add_fixed': [[0, ['theta_E']]]}],
+        ])
+        restored.set_state(FileSystem.decode_numpy_arrays(
+            FileSystem.encode_numpy_arrays(state)))
+
+        assert restored.get_state() == state
+        assert restored.best_fit_likelihood \
+            == fitting_sequence.best_fit_likelihood
+
+    def test_likelihood_counter(self):
+        """
+        Test that the likelihood evaluations are counted.
+        :return:
+        :rtype:
+        """
+        fitting_sequence = self.get_fitting_sequence()
+
+        # only the evaluations of the samplers and optimizers are counted
+        num_evaluations = LikelihoodCounter.num_evaluations
+        _ = fitting_sequence.best_fit_likelihood
+        assert LikelihoodCounter.num_evaluations == num_evaluations
+
+        num_evaluations = LikelihoodCounter.num_evaluations
+        fitting_sequence.fit_sequence([
+            ['PSO', {'sigma_scale': 1., 'n_particles': 4,
+                     'n_iterations': 3}]
+        ])
+        # the initial position, and the particles of each iteration
+        assert LikelihoodCounter.num_evaluations \
+            >= num_evaluations + 1 + 4 * 3
+
+    def test_mcmc(self):
+        """
+        Test `mcmc` method with streaming of the samples.
+        :return:
+        :rtype:
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            samples_file = os.path.join(temp_dir, 'samples.h5')
+            fitting_sequence = self.get_fitting_sequence(
+                samples_file=samples_file)
+
+            fit_output = fitting_sequence.fit_sequence([
+                ['MCMC', {'n_burn': 1, 'n_run': 5, 'walkerRatio': 2,
+                          'sigma_scale': 0.1, 'save_every': 2,
+                          'progress': False}]
+            ])
+
+            samples, log_likelihood = FileSystem.read_samples_h5(
+                samples_file, name='mcmc_0')
+
+        num_param = len(fit_output[0][2])
+        assert fit_output[0][1].shape == (5 * 2 * num_param, num_param)
+        npt.assert_array_equal(fit_output[0][1], samples)
+        npt.assert_array_equal(fit_output[0][3], log_likelihood)
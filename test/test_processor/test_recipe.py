@@ -142,6 +142,126 @@ class TestRecipe(object):
         fitting_kwargs_list = self.recipe.get_default_recipe()
         assert isinstance(fitting_kwargs_list, list)
 
+        # test early stopping of the PSO stages
+        config = deepcopy(self.config)
+        config.settings['fitting']['pso'] = True
+        config.settings['fitting']['pso_settings'][
+            'early_stop_tolerance'] = 0.5
+        recipe = Recipe(config)
+        for fitting_kwargs in recipe.get_default_recipe():
+            if fitting_kwargs[0] == 'PSO':
+                assert fitting_kwargs[1]['early_stop_tolerance'] == 0.5
+                assert fitting_kwargs[1]['early_stop_window'] == 10
+
+    def test_pyramid_binning(self):
+        """
+        Test the coarse-to-fine image pyramid in the recipes.
+        :return:
+        :rtype:
+        """
+        config = deepcopy(self.config)
+        config.settings['fitting']['pso'] = True
+        config.settings['fitting']['psf_iteration'] = True
+        config.settings['fitting']['pso_settings']['pyramid_binning'] = [2]
+        recipe = Recipe(config)
+
+        fitting_kwargs_list = recipe.get_default_recipe()
+        resolutions = [fitting_kwargs[1]['binning'] for fitting_kwargs
+                       in fitting_kwargs_list
+                       if fitting_kwargs[0] == 'set_resolution']
+        assert fitting_kwargs_list[0] == ['set_resolution', {'binning': 2}]
+        assert fitting_kwargs_list[-1] == ['set_resolution', {'binning': 1}]
+        assert 2 in resolutions
+
+        # the PSF iteration is run at full resolution
+        binning = 1
+        for fitting_kwargs in fitting_kwargs_list:
+            if fitting_kwargs[0] == 'set_resolution':
+                binning = fitting_kwargs[1]['binning']
+            elif fitting_kwargs[0] == 'psf_iteration':
+                assert binning == 1
+
+    def test_numerics_schedule(self):
+        """
+        Test the `kwargs_numerics` schedule in the recipes.
+        :return:
+        :rtype:
+        """
+        config = deepcopy(self.config)
+        config.settings['fitting']['pso'] = True
+        config.settings['kwargs_numerics']['pso_epochs'] = [
+            {'supersampling_factor': [1]}]
+        recipe = Recipe(config)
+
+        fitting_kwargs_list = recipe.get_default_recipe()
+        supersampling_factors = [
+            fitting_kwargs[1]['kwargs_numerics'][0]['supersampling_factor']
+            for fitting_kwargs in fitting_kwargs_list
+            if fitting_kwargs[0] == 'update_settings'
+            and 'kwargs_numerics' in fitting_kwargs[1]]
+        assert fitting_kwargs_list[0][1]['kwargs_numerics'][0][
+            'supersampling_factor'] == 1
+        supersampling_factor = config.get_kwargs_numerics()[0][
+            'supersampling_factor']
+        # only the scheduled settings are updated
+        assert fitting_kwargs_list[-1][1]['kwargs_numerics'] == [
+            {'supersampling_factor': supersampling_factor}]
+        assert supersampling_factors == [1] + [supersampling_factor] * 2
+
+        # the epoch checks evaluate the likelihood at the configured
+        # numerics
+        config.settings['fitting']['epoch_settings'] = {
+            'min_log_likelihood_gain': 2., 'max_epochs': 3}
+        recipe = Recipe(config)
+        fitting_kwargs_list = recipe.get_default_recipe()
+        epoch_check = [fitting_kwargs for fitting_kwargs in fitting_kwargs_list
+                       if fitting_kwargs[0] == 'epoch_check'][0]
+        assert epoch_check[1]['kwargs_numerics'] == [
+            {'supersampling_factor': supersampling_factor}]
+        del config.settings['fitting']['epoch_settings']
+
+        # the recipe is unchanged without a schedule
+        del config.settings['kwargs_numerics']['pso_epochs']
+        recipe = Recipe(config)
+        for fitting_kwargs in recipe.get_default_recipe():
+            assert 'kwargs_numerics' not in fitting_kwargs[1]
+
+    def test_adaptive_epochs(self):
+        """
+        Test the recipes with adaptive epochs.
+        :return:
+        :rtype:
+        """
+        config = deepcopy(self.config)
+        config.settings['fitting']['pso'] = True
+        config.settings['fitting']['epoch_settings'] = {
+            'min_log_likelihood_gain': 2., 'max_epochs': 3}
+        recipe = Recipe(config)
+
+        fitting_kwargs_list = recipe.get_default_recipe()
+        assert fitting_kwargs_list[-1][0] == 'epoch_check'
+        epoch_check = fitting_kwargs_list[-1][1]
+        assert epoch_check['min_epochs'] == 2
+        assert epoch_check['max_epochs'] == 3
+        assert epoch_check['fitting_kwargs_list'] == \
+            recipe._get_default_epoch(1)
+        assert epoch_check['kwargs_numerics'] is None
+
+        num_entries = len(fitting_kwargs_list)
+        recipe.insert_epoch(fitting_kwargs_list, num_entries - 1)
+        assert len(fitting_kwargs_list) == 2 * num_entries
+        assert fitting_kwargs_list[-1][0] == 'epoch_check'
+
+        settings = {'min_log_likelihood_gain': 2., 'min_epochs': 1,
+                    'max_epochs': 3}
+        assert recipe.continue_epochs([-100., -50.], **settings)
+        assert not recipe.continue_epochs([-100., -50., -49.], **settings)
+        assert recipe.continue_epochs([-100., -50., -40.], **settings)
+        assert not recipe.continue_epochs([-100., -50., -40., -20.],
+                                          **settings)
+        settings['min_epochs'] = 2
+        assert recipe.continue_epochs([-100., -99.5], **settings)
+
     def test_get_sampling_sequence(self):
         """
         Test `get_sampling_sequence` method.
@@ -174,6 +294,14 @@ class TestRecipe(object):
             np.zeros(20)
         )
 
+        # test streaming the samples into file
+        config = deepcopy(self.config)
+        config.settings['fitting']['mcmc_settings']['save_every'] = 10
+
+        recipe = Recipe(config)
+        sequence = recipe.get_sampling_sequence()
+        assert sequence[0][1]['save_every'] == 10
+
     def test_get_galaxy_galaxy_recipe(self):
         """
         Test `get_galaxy_galaxy_recipe` method.
@@ -228,6 +356,23 @@ class TestRecipe(object):
         mask = self.recipe.get_arc_mask(image, mask=np.ones_like(image))
         assert mask.shape == (100, 100)
 
+        # a ring around the center is masked as an arc in any image size
+        for shape in [(60, 60), (51, 80)]:
+            y, x = np.indices(shape)
+            r = np.hypot(x - (shape[1] - 1) / 2, y - (shape[0] - 1) / 2)
+            image = np.exp(-(r - 15.)**2 / 8.)
+
+            arc_masks = self.recipe.get_arc_masks([image, 2 * image])
+            assert len(arc_masks) == 2
+            assert arc_masks[0].shape == shape
+            npt.assert_array_equal(arc_masks[0], arc_masks[1])
+            assert np.all(arc_masks[0][np.abs(r - 15.) < 1.] == 0)
+            assert np.all(arc_masks[0][r < 5.] == 1)
+            assert np.all(arc_masks[0][r > 26.] == 1)
+
+            npt.assert_array_equal(self.recipe.get_arc_mask(image),
+                                   arc_masks[0])
+
     def test_fix_params(self):
         """
         Test `fix_params` method.